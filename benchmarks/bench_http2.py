@@ -0,0 +1,145 @@
+# coding: utf-8
+"""
+Compare the HTTP/1.1 image path against the opt-in HTTP/2 mode.
+
+A local stand-in image host answers every page after a fixed latency, once over HTTP/1.1
+and once over cleartext HTTP/2 (prior knowledge), and the same AsyncTransport used by
+Downloader fetches a gallery worth of pages through it.
+
+    python benchmarks/bench_http2.py --pages 200 --latency 0.05
+"""
+import argparse
+import asyncio
+import time
+
+import httpx
+
+from nhentai.transport import AsyncTransport
+
+try:
+    import h2.config
+    import h2.connection
+    import h2.events
+except ImportError:
+    raise SystemExit('Please install h2 package by using pip to run this benchmark.')
+
+
+PAGE = b'\xff\xd8\xff' + b'\x00' * 64 * 1024
+
+
+class H2ImageServer(asyncio.Protocol):
+    latency = 0.05
+
+    def __init__(self):
+        self.conn = h2.connection.H2Connection(config=h2.config.H2Configuration(client_side=False))
+        self.transport = None
+        self.pending = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.conn.initiate_connection()
+        self.transport.write(self.conn.data_to_send())
+
+    def data_received(self, data):
+        for event in self.conn.receive_data(data):
+            if isinstance(event, h2.events.RequestReceived):
+                asyncio.ensure_future(self.respond(event.stream_id))
+            elif isinstance(event, h2.events.WindowUpdated):
+                self.flush()
+        self.transport.write(self.conn.data_to_send())
+
+    async def respond(self, stream_id):
+        await asyncio.sleep(self.latency)
+        self.conn.send_headers(stream_id, [(':status', '200'), ('content-type', 'image/jpeg'),
+                                           ('content-length', str(len(PAGE)))])
+        self.pending[stream_id] = PAGE
+        self.flush()
+
+    def flush(self):
+        for stream_id, data in list(self.pending.items()):
+            while data:
+                window = min(self.conn.local_flow_control_window(stream_id), self.conn.max_outbound_frame_size)
+                if window <= 0:
+                    break
+                chunk, data = data[:window], data[window:]
+                self.conn.send_data(stream_id, chunk, end_stream=not data)
+            if data:
+                self.pending[stream_id] = data
+            else:
+                del self.pending[stream_id]
+        self.transport.write(self.conn.data_to_send())
+
+
+async def handle_http11(reader, writer):
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            while (await reader.readline()) not in (b'\r\n', b''):
+                pass
+            await asyncio.sleep(H2ImageServer.latency)
+            writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: image/jpeg\r\n'
+                         b'Content-Length: %d\r\n\r\n' % len(PAGE) + PAGE)
+            await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+class PriorKnowledgeTransport(AsyncTransport):
+    """ Cleartext HTTP/2 needs prior knowledge, real image hosts negotiate it through TLS ALPN instead. """
+
+    def _create_client(self):
+        return httpx.AsyncClient(limits=self.limits, http1=False, http2=True)
+
+
+async def fetch_gallery(transport, base_url, pages, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def fetch(i):
+        async with semaphore:
+            response = await transport.request('GET', f'{base_url}/galleries/1/{i}.jpg', timeout=30)
+            assert response.status_code == 200 and len(response.content) == len(PAGE)
+
+    start = time.perf_counter()
+    try:
+        await asyncio.gather(*(fetch(i) for i in range(1, pages + 1)))
+    finally:
+        await transport.aclose()
+    return time.perf_counter() - start
+
+
+async def main(pages, latency, http11_threads, http2_threads):
+    H2ImageServer.latency = latency
+    loop = asyncio.get_running_loop()
+    http11_server = await asyncio.start_server(handle_http11, '127.0.0.1', 0)
+    http2_server = await loop.create_server(H2ImageServer, '127.0.0.1', 0)
+
+    http11_url = f'http://127.0.0.1:{http11_server.sockets[0].getsockname()[1]}'
+    http2_url = f'http://127.0.0.1:{http2_server.sockets[0].getsockname()[1]}'
+
+    runs = [
+        ('HTTP/1.1', AsyncTransport(max_connections=http11_threads, proxy=''), http11_url, http11_threads),
+        ('HTTP/2', PriorKnowledgeTransport(max_connections=1, http2=True), http2_url, http2_threads),
+    ]
+
+    print(f'{pages} pages of {len(PAGE) // 1024} KiB, {latency * 1000:.0f} ms server latency')
+    for name, transport, url, concurrency in runs:
+        elapsed = await fetch_gallery(transport, url, pages, concurrency)
+        print(f'{name:<9} concurrency {concurrency:>3}: {pages / elapsed:8.1f} pages/sec, '
+              f'{transport.stats.connections} connections, {elapsed:.2f}s')
+
+    http11_server.close()
+    http2_server.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='HTTP/1.1 vs HTTP/2 image download benchmark')
+    parser.add_argument('--pages', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0.05, help='server latency per page in seconds')
+    parser.add_argument('--http11-threads', type=int, default=15)
+    parser.add_argument('--http2-threads', type=int, default=100)
+    args = parser.parse_args()
+    asyncio.run(main(args.pages, args.latency, args.http11_threads, args.http2_threads))
@@ -0,0 +1,56 @@
+# coding: utf-8
+"""
+Galleries per second of doujinshi_parser's extraction, the whole BeautifulSoup tree against GalleryTreeBuilder.
+
+Parses each saved gallery page with both extractors, checks they read the same doujinshi and
+reports how many galleries a second each gets through.
+
+    python benchmarks/bench_parser.py --seconds 2 tests/fixtures/gallery-*.html
+"""
+import argparse
+import glob
+import logging
+import os
+import time
+
+from nhentai.extract import scan_gallery_page, soup_gallery_page
+from nhentai.logger import logger
+from nhentai.parser import parse_doujinshi_page
+
+
+FIXTURES = os.path.join(os.path.dirname(__file__), os.pardir, 'tests', 'fixtures', 'gallery-*.html')
+EXTRACTORS = (('soup', soup_gallery_page), ('scan', scan_gallery_page))
+
+
+def rate(content, extract, seconds):
+    count = 0
+    start = time.perf_counter()
+    while True:
+        parse_doujinshi_page(1, content, extract)
+        count += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= seconds:
+            return count / elapsed
+
+
+def main(filenames, seconds):
+    # the thumbnails of some fixtures make the parser warn on every run
+    logger.setLevel(logging.ERROR)
+    for filename in filenames:
+        with open(filename, 'rb') as f:
+            content = f.read()
+        if parse_doujinshi_page(1, content, scan_gallery_page) != parse_doujinshi_page(1, content, soup_gallery_page):
+            raise SystemExit(f'{filename}: the extractors disagree')
+
+        rates = {name: rate(content, extract, seconds) for name, extract in EXTRACTORS}
+        print(f'{os.path.basename(filename):<24} {len(content) / 1024:6.1f} KiB: '
+              + ', '.join(f'{name} {value:7.1f} galleries/sec' for name, value in rates.items())
+              + f', {rates["scan"] / rates["soup"]:4.1f}x')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Gallery page extraction speed')
+    parser.add_argument('filenames', nargs='*', help='saved gallery pages, the test fixtures by default')
+    parser.add_argument('--seconds', type=float, default=2, help='time spent on each page and extractor')
+    args = parser.parse_args()
+    main(args.filenames or sorted(glob.glob(FIXTURES)), args.seconds)
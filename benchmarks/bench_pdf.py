@@ -0,0 +1,62 @@
+# coding: utf-8
+"""
+Peak memory of writing a PDF as the page count grows.
+
+Writes the same gallery at several lengths with the streaming PDF writer and reports the peak
+Python allocation while writing, which should stay at about one page whatever the page count.
+
+    python benchmarks/bench_pdf.py --pages 25 100 400 --format png
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+from nhentai.pdf import write_pdf
+
+try:
+    from PIL import Image
+except ImportError:
+    raise SystemExit('Please install Pillow package by using pip to run this benchmark.')
+
+
+def make_pages(folder, count, width, height, image_format):
+    image = Image.merge('RGB', [Image.effect_noise((width, height), 48)] * 3)
+    first = os.path.join(folder, f'1.{image_format}')
+    image.save(first)
+    pages = [first]
+    for i in range(2, count + 1):
+        pages.append(os.path.join(folder, f'{i}.{image_format}'))
+        shutil.copyfile(first, pages[-1])
+    return pages
+
+
+def main(counts, width, height, image_format):
+    folder = tempfile.mkdtemp()
+    try:
+        pages = make_pages(folder, max(counts), width, height, image_format)
+        print(f'{image_format} pages of {os.path.getsize(pages[0]) // 1024} KiB ({width}x{height})')
+        for count in counts:
+            filename = os.path.join(folder, f'{count}.pdf')
+            tracemalloc.start()
+            start = time.perf_counter()
+            write_pdf(filename, pages[:count])
+            elapsed = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print(f'{count:>5} pages: peak {peak / 1024 / 1024:7.1f} MiB, '
+                  f'PDF {os.path.getsize(filename) / 1024 / 1024:8.1f} MiB, {count / elapsed:8.1f} pages/sec')
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='PDF writer memory against page count')
+    parser.add_argument('--pages', type=int, nargs='+', default=[25, 100, 400])
+    parser.add_argument('--format', dest='image_format', choices=('jpg', 'png', 'webp'), default='jpg')
+    parser.add_argument('--width', type=int, default=960)
+    parser.add_argument('--height', type=int, default=1360)
+    args = parser.parse_args()
+    main(args.pages, args.width, args.height, args.image_format)
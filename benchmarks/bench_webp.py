@@ -0,0 +1,102 @@
+# coding: utf-8
+"""
+Compare --webp encoding on the event loop against the WebP process pool.
+
+A local stand-in image host serves the same JPEG page after a fixed latency, and a Downloader
+with --webp stores a gallery worth of pages from it, once encoding inline (--webp-processes 0)
+and once with the process pool.
+
+    python benchmarks/bench_webp.py --pages 40 --latency 0.05
+"""
+import argparse
+import io
+import os
+import shutil
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from nhentai import constant
+from nhentai.downloader import Downloader
+
+try:
+    from PIL import Image
+except ImportError:
+    raise SystemExit('Please install Pillow package by using pip to run this benchmark.')
+
+
+def make_page(width, height):
+    # noise keeps the encoder busy about as long as a scanned page does
+    image = Image.merge('RGB', [Image.effect_noise((width, height), 48)] * 3)
+    with io.BytesIO() as output:
+        image.save(output, format='JPEG', quality=90)
+        return output.getvalue()
+
+
+class PageHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    page = b''
+    latency = 0.05
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', str(len(self.page)))
+        self.end_headers()
+        self.wfile.write(self.page)
+
+    def log_message(self, *args):
+        pass
+
+
+def download(name, processes, pages, threads, output):
+    # Downloader is a singleton, every run gets its own subclass
+    downloader = type(name, (Downloader,), {})(path=output, threads=threads, adaptive=False, webp=True,
+                                               webp_processes=processes)
+    downloader.transport.proxy = ''
+    queue = [f'{constant.IMAGE_URL}/1/{i}.jpg' for i in range(1, pages + 1)]
+
+    start = time.perf_counter()
+    try:
+        downloader.start_download(queue, name)
+    finally:
+        downloader.shutdown()
+    elapsed = time.perf_counter() - start
+
+    converted = [f for f in os.listdir(os.path.join(output, name)) if f.endswith('.webp')]
+    assert len(converted) == pages, f'{len(converted)} of {pages} pages converted'
+    return elapsed
+
+
+def main(pages, latency, threads, processes, width, height):
+    PageHandler.page = make_page(width, height)
+    PageHandler.latency = latency
+    server = ThreadingHTTPServer(('127.0.0.1', 0), PageHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    constant.IMAGE_URL = f'http://127.0.0.1:{server.server_address[1]}/galleries'
+    constant.IMAGE_URL_MIRRORS = []
+
+    output = tempfile.mkdtemp()
+    print(f'{pages} pages of {len(PageHandler.page) // 1024} KiB ({width}x{height}), '
+          f'{latency * 1000:.0f} ms server latency, {threads} threads, {os.cpu_count()} CPU cores')
+    try:
+        for name, count in (('Inline', 0), ('ProcessPool', processes)):
+            elapsed = download(name, count, pages, threads, output)
+            print(f'{name:<12} processes {count:>2}: {pages / elapsed:8.1f} pages/sec, {elapsed:.2f}s')
+    finally:
+        server.shutdown()
+        shutil.rmtree(output, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='WebP encoding on the event loop vs a process pool')
+    parser.add_argument('--pages', type=int, default=40)
+    parser.add_argument('--latency', type=float, default=0.05, help='server latency per page in seconds')
+    parser.add_argument('--threads', type=int, default=10)
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--width', type=int, default=960)
+    parser.add_argument('--height', type=int, default=1360)
+    args = parser.parse_args()
+    main(args.pages, args.latency, args.threads, args.processes, args.width, args.height)
@@ -0,0 +1,249 @@
+# coding: utf-8
+import asyncio
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+from rich.progress import Progress, BarColumn, TextColumn, TimeRemainingColumn
+
+from nhentai import constant
+from nhentai.downloader import ExitOnFail
+from nhentai.logger import logger, console
+
+
+# returned in place of a loaded item once the items ran out
+EXHAUSTED = object()
+
+
+async def prefetch(load, items, executor, window):
+    """
+    Run ``load`` over ``items`` in ``executor`` with at most ``window`` calls started ahead of the
+    consumer, and yield the results in the order they complete rather than the order of ``items``.
+    ``items`` is advanced in the executor as well, since an iterator may block for its next item,
+    e.g. while it claims doujinshi from a shared job queue.
+    """
+    loop = asyncio.get_running_loop()
+    items = iter(items)
+    lock = threading.Lock()
+    pending = set()
+    exhausted = False
+
+    def load_next():
+        with lock:
+            item = next(items, EXHAUSTED)
+        return item if item is EXHAUSTED else load(item)
+
+    def fill():
+        while not exhausted and len(pending) < window:
+            pending.add(loop.run_in_executor(executor, load_next))
+
+    fill()
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                loaded = future.result()
+                if loaded is EXHAUSTED:
+                    exhausted = True
+                    continue
+                yield loaded
+            fill()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+class PostProcessPool(object):
+    """
+    Post-processing of finished doujinshi on ``threads`` background threads. At most ``backlog``
+    doujinshi wait for a free thread; beyond that ``submit`` blocks, which holds back the download
+    workers instead of piling up finished galleries.
+    """
+
+    def __init__(self, threads=1, backlog=None):
+        self.threads = threads
+        self.backlog = threads * 2 if backlog is None else backlog
+        self.executor = None
+        self.slots = None
+        self.futures = []
+
+    def __enter__(self):
+        self.executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix='post-process')
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.executor.shutdown(wait=True)
+
+    async def submit(self, fn, *args):
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.threads + self.backlog)
+
+        await self.slots.acquire()
+        future = asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+        future.add_done_callback(lambda _: self.slots.release())
+        self.futures.append(future)
+
+    async def join(self):
+        await asyncio.gather(*self.futures)
+
+
+class BatchDownload(object):
+    """
+    Downloads many doujinshi on the downloader's event loop through a single page queue.
+
+    Metadata is fetched by ``metadata_threads`` threads while pages are downloading, and each
+    doujinshi joins the back of the page queue as soon as its metadata is ready, so the connection
+    pool does not drain between galleries. Both the page queue and the number of metadata requests
+    started ahead are bounded, so a list of thousands of ids is not fetched all at once.
+
+    ``load(item)`` runs in a metadata thread and returns ``(doujinshi, queue)``, or None to skip
+    the item. An empty queue skips the download but still finishes the doujinshi.
+    ``finish(doujinshi, gallery)`` runs the post-processing on a PostProcessPool as soon as the
+    last page of a doujinshi is done; ``gallery`` is None when nothing was downloaded. Doujinshi
+    whose post-processing raised are collected in ``failures``.
+
+    ``items`` may also be an iterator of unknown length, e.g. doujinshi claimed from a shared job
+    queue a few at a time; it is only advanced as metadata threads free up.
+    """
+
+    def __init__(self, downloader, load, finish, metadata_threads=1, post_threads=1):
+        self.downloader = downloader
+        self.load = load
+        self.finish = finish
+        self.metadata_threads = metadata_threads
+        self.post_threads = post_threads
+        self.pages = None
+        self.owners = {}
+        self.failures = []
+        self.progress = None
+        self.rows = {}
+
+    def run(self, items):
+        self.downloader.run(self._run(items))
+
+    async def _run(self, items):
+        workers_count = self.downloader.limiter.maximum
+        self.pages = asyncio.Queue(maxsize=workers_count * 2)
+
+        with ThreadPoolExecutor(max_workers=self.metadata_threads, thread_name_prefix='metadata') as metadata, \
+                PostProcessPool(self.post_threads) as post_process, \
+                Progress(
+                    TextColumn("[progress.description]{task.description}"),
+                    BarColumn(),
+                    TextColumn("[progress.percentage]{task.percentage:>3.0f}%"),
+                    TextColumn("•"),
+                    TextColumn("[cyan]{task.completed}/{task.total}"),
+                    TextColumn("{task.fields[unit]}"),
+                    TextColumn("{task.fields[limit]}"),
+                    TimeRemainingColumn(),
+                    console=console,
+                    refresh_per_second=10,
+                    transient=False,
+                ) as progress:
+            self.progress = progress
+            sized = hasattr(items, '__len__')
+            self.rows['galleries'] = progress.add_task("[green]Doujinshi", total=len(items) if sized else 0,
+                                                       unit='doujinshi', limit='')
+            self.rows['pages'] = progress.add_task("[green]Downloading", total=0, unit='pages', limit=self.limit())
+            if not sized:
+                items = self.counted(items)
+
+            producer = asyncio.create_task(self.produce(items, metadata, post_process))
+            workers = [asyncio.create_task(self.worker(post_process)) for _ in range(workers_count)]
+            try:
+                await self.watch(producer, workers)
+                await self.watch(asyncio.create_task(self.pages.join()), workers)
+                await post_process.join()
+            finally:
+                for task in [producer] + workers:
+                    task.cancel()
+                await asyncio.gather(producer, *workers, return_exceptions=True)
+                # an interrupted archive still gets its central directory, so the next run can resume it
+                for gallery in self.owners:
+                    gallery.storage.close()
+
+    def limit(self):
+        """ The concurrency the downloader's limiter allows right now, for the Downloading row. """
+        return f'• [magenta]{self.downloader.limiter.limit} concurrent'
+
+    def counted(self, items):
+        """ Grow the doujinshi total as an iterator of unknown length yields them. """
+        for item in items:
+            self.progress.update(self.rows['galleries'], total=self.progress.tasks[self.rows['galleries']].total + 1)
+            yield item
+
+    @staticmethod
+    async def watch(task, workers):
+        """ Wait for ``task``, re-raising right away if a worker fails in the meantime. """
+        done, _ = await asyncio.wait([task] + workers, return_when=asyncio.FIRST_COMPLETED)
+        for finished in done:
+            if finished is not task and finished.exception() is not None:
+                task.cancel()
+                raise finished.exception()
+        await task
+
+    async def produce(self, items, metadata, post_process):
+        loop = asyncio.get_running_loop()
+        async for loaded in prefetch(self.load, items, metadata, self.metadata_threads * 2):
+            if loaded is None:
+                self.progress.update(self.rows['galleries'], advance=1)
+                continue
+
+            doujinshi, queue = loaded
+            if not queue:
+                await post_process.submit(self.finished, doujinshi, None)
+                continue
+
+            # hashing stored pages and verifying an archive may take a while, keep it off the loop
+            gallery = await loop.run_in_executor(metadata, self.downloader.open_gallery, queue,
+                                                 doujinshi.filename, doujinshi.name, doujinshi)
+            if gallery.finished:
+                await post_process.submit(self.finished, doujinshi, gallery)
+                continue
+
+            self.owners[gallery] = doujinshi
+            self.rows[gallery] = self.progress.add_task(f'  {str(doujinshi.name)[:40]}',
+                                                        total=len(gallery.pending), unit='pages', limit='')
+            self.progress.update(self.rows['pages'], total=self.progress.tasks[self.rows['pages']].total
+                                 + len(gallery.pending))
+            for url, filename in gallery.pending:
+                await self.pages.put((gallery, url, filename))
+
+    async def worker(self, post_process):
+        while True:
+            gallery, url, filename = await self.pages.get()
+            try:
+                result = await self.downloader.download(url, gallery, filename=filename)
+                if constant.STOP_REQUESTED:
+                    raise KeyboardInterrupt
+
+                gallery.page_done(result[0] > 0)
+                self.progress.update(self.rows['pages'], advance=1, limit=self.limit())
+                self.progress.update(self.rows[gallery], advance=1)
+                if result[0] <= 0:
+                    self.progress.console.print(f'[red]Error:[/red] {result[1]} download failed, '
+                                                f'return value {result[0]}')
+                    if self.downloader.exit_on_fail:
+                        raise ExitOnFail(f'{result[1]} download failed')
+
+                if gallery.finished:
+                    self.progress.update(self.rows.pop(gallery), visible=False)
+                    await post_process.submit(self.finished, self.owners.pop(gallery), gallery)
+            finally:
+                self.pages.task_done()
+
+    def finished(self, doujinshi, gallery):
+        if gallery is not None:
+            gallery.storage.close()
+            if gallery.failed:
+                logger.warning(f'Finished {doujinshi.name}: {gallery.failed} of {gallery.total} pages failed')
+            else:
+                logger.info(f'Finished {doujinshi.name}: {gallery.total} pages')
+
+        try:
+            self.finish(doujinshi, gallery)
+        except Exception as e:
+            logger.error(f'Post-processing of {doujinshi.name} failed: {type(e).__name__}: {e}')
+            self.failures.append(doujinshi)
+        finally:
+            self.progress.update(self.rows['galleries'], advance=1)
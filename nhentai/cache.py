@@ -0,0 +1,127 @@
+# coding: utf-8
+import json
+import sqlite3
+import threading
+import time
+
+from nhentai import constant
+from nhentai.logger import logger
+
+
+DEFAULT_TTL = 7 * 24 * 3600
+DEFAULT_SIZE = 64 * 1024 ** 2
+
+
+class MetadataCache(object):
+    """
+    The doujinshi dicts of galleries fetched before, by gallery id, with the time they were
+    fetched and how long they stay fresh. An entry lives as long as the shorter of its own TTL
+    and the current one. Once the entries take more than ``size`` bytes the least recently
+    used ones are evicted.
+
+    With ``refresh`` nothing is read from the cache, what is fetched instead replaces it.
+    Processes sharing the cache file see each other's entries. A cache that cannot be read or
+    written, e.g. locked by another process for too long or corrupt, is a miss or skips the store.
+    """
+
+    def __init__(self, path=None, ttl=DEFAULT_TTL, size=DEFAULT_SIZE, refresh=False):
+        self.path = path or constant.NHENTAI_METADATA_CACHE
+        self.ttl = ttl
+        self.size = size
+        self.refresh = refresh
+        self.hits = self.misses = self.expired = self.evicted = self.errors = 0
+        self.lock = threading.Lock()
+        # the metadata threads look up and store through the same connection
+        self.conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+        if self.path != ':memory:':
+            self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS metadata (id INTEGER PRIMARY KEY, doujinshi TEXT NOT NULL, '
+                          'size INTEGER NOT NULL, fetched REAL NOT NULL, ttl REAL NOT NULL, used REAL NOT NULL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS metadata_used ON metadata (used)')
+        self.conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    def get(self, doujinshi_id):
+        """ The cached doujinshi dict, or None when it is missing, stale or the cache is refreshed. """
+        if self.refresh:
+            with self.lock:
+                self.misses += 1
+            return None
+
+        try:
+            return self._get(doujinshi_id)
+        except sqlite3.Error as e:
+            with self.lock:
+                self.misses += 1
+                self.errors += 1
+            logger.warning(f'Cannot read doujinshi {doujinshi_id} from the metadata cache: {e}')
+            return None
+
+    def _get(self, doujinshi_id):
+        now = time.time()
+        with self.lock, self.conn:
+            row = self.conn.execute('SELECT doujinshi, fetched, ttl FROM metadata WHERE id = ?',
+                                    (int(doujinshi_id),)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+
+            doujinshi, fetched, ttl = row
+            if now - fetched >= min(ttl, self.ttl):
+                self.conn.execute('DELETE FROM metadata WHERE id = ?', (int(doujinshi_id),))
+                self.misses += 1
+                self.expired += 1
+                return None
+
+            self.conn.execute('UPDATE metadata SET used = ? WHERE id = ?', (now, int(doujinshi_id)))
+            self.hits += 1
+        return json.loads(doujinshi)
+
+    def put(self, doujinshi_id, doujinshi):
+        data = json.dumps(doujinshi, ensure_ascii=False)
+        size = len(data.encode('utf-8'))
+        now = time.time()
+        try:
+            with self.lock, self.conn:
+                self.conn.execute('INSERT OR REPLACE INTO metadata (id, doujinshi, size, fetched, ttl, used) '
+                                  'VALUES (?, ?, ?, ?, ?, ?)', (int(doujinshi_id), data, size, now, self.ttl, now))
+                self._evict(now)
+        except sqlite3.Error as e:
+            with self.lock:
+                self.errors += 1
+            logger.warning(f'Cannot store doujinshi {doujinshi_id} in the metadata cache: {e}')
+
+    def _evict(self, now):
+        total = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM metadata').fetchone()[0]
+        if total <= self.size:
+            return
+
+        # stale entries go first, then the least recently used ones
+        evicted = []
+        for doujinshi_id, size in self.conn.execute(
+                'SELECT id, size FROM metadata ORDER BY (? - fetched >= MIN(ttl, ?)) DESC, used',
+                (now, self.ttl)).fetchall():
+            if total <= self.size:
+                break
+            evicted.append((doujinshi_id,))
+            total -= size
+        self.conn.executemany('DELETE FROM metadata WHERE id = ?', evicted)
+        self.evicted += len(evicted)
+
+    def __str__(self):
+        counters = (f'{self.hits} hits, {self.misses} misses ({self.expired} expired, {self.errors} errors), '
+                    f'{self.evicted} evicted')
+        try:
+            with self.lock:
+                count, total = self.conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM metadata').fetchone()
+        except sqlite3.Error:
+            return counters
+        return f'{counters}, {count} galleries in {total / 1024 ** 2:.1f} of {self.size / 1024 ** 2:.0f} MiB'
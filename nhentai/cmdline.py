@@ -9,8 +9,12 @@ from urllib.parse import urlparse
 from argparse import ArgumentParser
 
 from nhentai import __version__
-from nhentai.utils import generate_html, generate_main_html, DB, EXTENSIONS, validate_template_name
+from nhentai.utils import generate_html, generate_main_html, DB, EXTENSIONS, validate_template_name, parse_size, \
+    parse_duration
 from nhentai.logger import logger
+from nhentai.daemon import DEFAULT_ADDRESS
+from nhentai.coordinator import DEFAULT_ADDRESS as COORDINATOR_ADDRESS
+from nhentai.jobs import JobQueue
 
 
 def banner():
@@ -71,6 +75,22 @@ def cmd_parser():
                         help='download doujinshi (for search results)')
     parser.add_argument('--show', '-S', dest='is_show', action='store_true',
                         help='just show the doujinshi information')
+    parser.add_argument('--daemon', type=str, dest='daemon', nargs='?', const=DEFAULT_ADDRESS, default=None,
+                        metavar='ADDRESS',
+                        help='keep running and download the jobs submitted to a local HTTP API on ADDRESS, '
+                             f'host:port or unix:/path/to/socket (default: {DEFAULT_ADDRESS})')
+    parser.add_argument('--daemon-token', type=str, dest='daemon_token', default=None, metavar='TOKEN',
+                        help='shared secret the --daemon refuses API requests without, sent as an X-Daemon-Token '
+                             'header')
+    parser.add_argument('--coordinator', type=str, dest='coordinator', nargs='?', const=COORDINATOR_ADDRESS,
+                        default=None, metavar='ADDRESS',
+                        help='hand out the doujinshi to download to --worker-of processes on other machines, '
+                             f'listening on ADDRESS (default: {COORDINATOR_ADDRESS})')
+    parser.add_argument('--worker-of', type=str, dest='worker_of', default=None, metavar='URL',
+                        help='download the doujinshi handed out by the --coordinator at URL, e.g. http://host:7381')
+    parser.add_argument('--coordinator-token', type=str, dest='coordinator_token', default=None, metavar='TOKEN',
+                        help='shared secret the --worker-of processes send to the --coordinator, '
+                             'which refuses requests without it')
 
     # doujinshi options
     parser.add_argument('--id', dest='id', nargs='+', type=int,
@@ -96,12 +116,39 @@ def cmd_parser():
                         help='output dir')
     parser.add_argument('--threads', '-t', type=int, dest='threads', default=5,
                         help='thread count for downloading doujinshi')
+    parser.add_argument('--metadata-threads', type=int, dest='metadata_threads', default=4,
+                        help='number of gallery metadata requests fetched ahead of the downloads')
+    parser.add_argument('--post-threads', type=int, dest='post_threads', default=2,
+                        help='number of doujinshi post-processed (HTML, CBZ, PDF) while downloads continue')
+    parser.add_argument('--workers', type=int, dest='workers', default=1,
+                        help='split the doujinshi between this many processes sharing a job queue')
     parser.add_argument('--timeout', '-T', type=int, dest='timeout', default=30,
                         help='timeout for downloading doujinshi')
-    parser.add_argument('--delay', '-d', type=int, dest='delay', default=0,
-                        help='slow down between downloading every doujinshi')
+    parser.add_argument('--delay', '-d', type=float, dest='delay', default=0,
+                        help='minimum seconds between two image requests across all threads')
+    parser.add_argument('--image-rate', type=float, dest='image_rate', default=None,
+                        help='maximum image requests per second across all threads')
+    parser.add_argument('--image-bandwidth', type=parse_size, dest='image_bandwidth', default=None,
+                        help='maximum image download bandwidth in bytes per second, e.g. 512K, 2M')
+    parser.add_argument('--metadata-rate', type=float, dest='metadata_rate', default=None,
+                        help='maximum requests per second to gallery, search and favorites pages')
+    parser.add_argument('--max-connections', type=int, dest='max_connections', default=0,
+                        help='size of the pooled image connection pool (default: the most concurrent downloads '
+                             f'the thread limit adapts up to, {constant.MAX_THREADS} or {constant.MAX_HTTP2_THREADS} '
+                             'with --http2)')
+    parser.add_argument('--fixed-threads', dest='adaptive', action='store_false', default=True,
+                        help='keep exactly --threads concurrent downloads instead of adapting to the network')
+    parser.add_argument('--hedge', type=int, dest='hedge', nargs='?', const=95, default=None, metavar='PERCENTILE',
+                        help='send a duplicate request to another mirror for pages slower than this percentile '
+                             'of observed latency (default: 95)')
+    parser.add_argument('--hedge-budget', type=float, dest='hedge_budget', default=0.1,
+                        help='maximum share of extra requests sent by --hedge (default: 0.1)')
+    parser.add_argument('--http2', dest='http2', action='store_true', default=False,
+                        help='multiplex image downloads over HTTP/2 connections, allows more threads')
+    parser.add_argument('--keepalive', type=float, dest='keepalive_expiry', default=30,
+                        help='seconds an idle pooled image connection is kept alive')
     parser.add_argument('--retry', type=int, dest='retry', default=3,
-                        help='retry times when downloading failed')
+                        help='retry times per error class, with exponential backoff')
     parser.add_argument('--exit-on-fail', dest='exit_on_fail', action='store_true', default=False,
                         help='exit on fail to prevent generating incomplete files')
     parser.add_argument('--proxy', type=str, dest='proxy',
@@ -115,6 +162,9 @@ def cmd_parser():
                         default=False, help='no padding in the images filename, such as \'001.jpg\'')
     parser.add_argument('--webp', action='store_true', dest='webp', default=False,
                         help='convert PNG/JPEG downloads to WebP (PNG quality 100, JPEG quality 90)')
+    parser.add_argument('--webp-processes', type=int, dest='webp_processes', default=None,
+                        help='number of processes encoding WebP pages (default: one per CPU core, '
+                             '0 encodes in the download thread)')
 
     # generate options
     parser.add_argument('--html', dest='html_viewer', type=str, nargs='?', const='.',
@@ -127,6 +177,9 @@ def cmd_parser():
                         help='generate a main viewer contain all the doujin in the folder')
     parser.add_argument('--cbz', '-C', dest='is_cbz', action='store_true',
                         help='generate Comic Book CBZ File')
+    parser.add_argument('--direct-cbz', dest='direct_cbz', action='store_true', default=False,
+                        help='write pages straight into the CBZ file while downloading, without the '
+                             'doujinshi dir (implies --cbz and --no-html)')
     parser.add_argument('--pdf', '-P', dest='is_pdf', action='store_true',
                         help='generate PDF file')
 
@@ -143,6 +196,9 @@ def cmd_parser():
     parser.add_argument('--regenerate', dest='regenerate', action='store_true', default=False,
                         help='regenerate the cbz or pdf file if exists')
     parser.add_argument('--zip', action='store_true', help='Package into a single zip file')
+    parser.add_argument('--zip-compression', dest='zip_compression', choices=('stored', 'deflated'),
+                        default='stored', help='how pages are added to the --zip or --direct-cbz file, images are '
+                                               'already compressed so the default is stored')
 
     # nhentai options
     parser.add_argument('--cookie', type=str, dest='cookie',
@@ -155,12 +211,29 @@ def cmd_parser():
                         help='set DEFAULT as language to parse doujinshis')
     parser.add_argument('--save-download-history', dest='is_save_download_history', action='store_true',
                         default=False, help='save downloaded doujinshis, whose will be skipped if you re-download them')
+    parser.add_argument('--resume', dest='resume', action='store_true', default=False,
+                        help='download the doujinshi earlier runs with --save-download-history did not finish '
+                             '(implies --save-download-history)')
+    parser.add_argument('--save-mirror-stats', dest='save_mirror_stats', action='store_true', default=False,
+                        help='remember image host latency and failures between runs to pick the fastest hosts')
     parser.add_argument('--clean-download-history', action='store_true', default=False, dest='clean_download_history',
                         help='clean download history')
     parser.add_argument('--template', dest='viewer_template', type=str, default='',
                         help='set viewer template')
     parser.add_argument('--legacy', dest='legacy', action='store_true', default=False,
                         help='use legacy searching method')
+    parser.add_argument('--metadata-backend', dest='metadata_backend', choices=('auto', 'api', 'html'),
+                        default='auto',
+                        help='read gallery metadata from the JSON API or the gallery pages, auto uses the API '
+                             'and falls back to the pages when it is unavailable (default: auto)')
+    parser.add_argument('--metadata-ttl', type=parse_duration, dest='metadata_ttl', default='7d',
+                        help='how long fetched gallery metadata is reused instead of fetched again, e.g. 12h, '
+                             '30d (default: 7d, 0 turns the metadata cache off)')
+    parser.add_argument('--metadata-cache-size', type=parse_size, dest='metadata_cache_size', default='64M',
+                        help='evict the least recently used gallery metadata beyond this size (default: 64M)')
+    parser.add_argument('--no-metadata-cache', dest='refresh_metadata', action='store_true', default=False,
+                        help='fetch gallery metadata again rather than reading it from the metadata cache, '
+                             'which is updated with it')
 
     args = parser.parse_args()
 
@@ -194,6 +267,8 @@ def cmd_parser():
     if args.clean_download_history:
         with DB() as db:
             db.clean_all()
+        with JobQueue() as jobs:
+            jobs.clear()
 
         logger.info('Download history cleaned.')
         sys.exit(0)
@@ -260,12 +335,35 @@ def cmd_parser():
             _ = [i.strip() for i in f.readlines()]
             args.id = set(int(i) for i in _ if i.isdigit())
 
-    if (args.is_download or args.is_show) and not args.id and not args.keyword and not args.favorites and not args.artist:
+    if args.daemon:
+        if args.id or args.keyword or args.favorites or args.artist or args.resume:
+            logger.critical('--daemon takes the doujinshi to download from its jobs, not from the command line')
+            sys.exit(1)
+        if args.is_show:
+            logger.critical('Cannot use --daemon together with --show')
+            sys.exit(1)
+
+    if args.workers < 1:
+        logger.critical('--workers must be at least 1')
+        sys.exit(1)
+    if sum(bool(mode) for mode in (args.daemon, args.coordinator, args.worker_of, args.workers > 1)) > 1:
+        logger.critical('Use only one of --daemon, --coordinator, --worker-of and --workers')
+        sys.exit(1)
+    if args.worker_of and (args.id or args.keyword or args.favorites or args.artist or args.resume or args.is_show):
+        logger.critical('--worker-of takes the doujinshi to download from the coordinator, not from the command line')
+        sys.exit(1)
+
+    if args.resume:
+        args.is_save_download_history = True
+
+    if (args.is_download or args.is_show) and not args.id and not args.keyword and not args.favorites \
+            and not args.artist and not args.daemon and not args.resume and not args.worker_of:
         logger.critical('Doujinshi id(s) are required for downloading')
         parser.print_help()
         sys.exit(1)
 
-    if not args.keyword and not args.id and not args.favorites and not args.artist:
+    if not args.keyword and not args.id and not args.favorites and not args.artist and not args.daemon \
+            and not args.resume and not args.worker_of:
         modifier_flags = []
         if args.is_nohtml:
             modifier_flags.append('--no-html')
@@ -273,6 +371,8 @@ def cmd_parser():
             modifier_flags.append('--meta')
         if args.is_cbz:
             modifier_flags.append('--cbz')
+        if args.direct_cbz:
+            modifier_flags.append('--direct-cbz')
         if args.is_pdf:
             modifier_flags.append('--pdf')
         if args.rm_origin_dir:
@@ -300,8 +400,27 @@ def cmd_parser():
     if args.threads <= 0:
         args.threads = 1
 
-    elif args.threads > 15:
-        logger.critical('Maximum number of used threads is 15')
+    if args.metadata_threads <= 0:
+        args.metadata_threads = 1
+
+    if args.post_threads <= 0:
+        args.post_threads = 1
+
+    if args.webp_processes is not None and args.webp_processes < 0:
+        args.webp_processes = 0
+
+    if args.metadata_threads > constant.MAX_THREADS:
+        logger.critical(f'Maximum number of metadata threads is {constant.MAX_THREADS}')
+        sys.exit(1)
+
+    if args.hedge is not None and not 0 < args.hedge < 100:
+        logger.critical('--hedge percentile must be between 1 and 99')
+        sys.exit(1)
+
+    max_threads = constant.MAX_HTTP2_THREADS if args.http2 else constant.MAX_THREADS
+    if args.threads > max_threads:
+        logger.critical(f'Maximum number of used threads is {max_threads}'
+                        f'{"" if args.http2 else " (use --http2 for more)"}')
         sys.exit(1)
 
     return args
@@ -1,23 +1,34 @@
 # coding: utf-8
+import contextlib
+import copy
 import os
 import shutil
 import sys
 import signal
 import platform
+import sqlite3
+import tempfile
+import uuid
 import urllib3.exceptions
-from contextlib import nullcontext
-from enum import Enum
 
 from nhentai import constant
 from nhentai.cmdline import cmd_parser, banner, write_config
-from nhentai.parser import doujinshi_parser, search_parser, legacy_search_parser, print_doujinshi, favorites_parser
+from nhentai.parser import search_parser, legacy_search_parser, print_doujinshi, favorites_parser
 from nhentai.doujinshi import Doujinshi
-from nhentai.downloader import Downloader, CompressedDownloader
+from nhentai.downloader import Downloader, CompressedDownloader, CbzDownloader, ExitOnFail
+from nhentai.batch import BatchDownload
+from nhentai.cache import MetadataCache
+from nhentai.coordinator import Coordinator, RemoteJobQueue
+from nhentai.daemon import Daemon
+from nhentai.metadata import metadata_source
+from nhentai.jobs import JobQueue, METADATA, DOWNLOADING, POST_PROCESSING, DONE, FAILED
+from nhentai.workers import Shard, WorkerPool
 from nhentai.logger import logger, console
+from nhentai.ratelimit import rate_limiter, METADATA as METADATA_PAGES, IMAGE
+from nhentai.retry import retry_policy
 from nhentai.constant import BASE_URL
 from nhentai.utils import generate_html, generate_doc, generate_main_html, generate_metadata, \
-    paging, check_cookie, signal_handler, DB, move_to_folder
-from rich.progress import Progress, BarColumn, TextColumn, TimeRemainingColumn
+    paging, check_cookie, signal_handler, DB, move_to_folder, session_manager
 
 
 def configure_runtime(options):
@@ -35,10 +46,32 @@ def configure_runtime(options):
 
     logger.info(f'Using viewer template "{constant.CONFIG["template"]}"')
 
+    configure_rate_limits(options)
+    configure_metadata(options)
+
     # check your cookie
     check_cookie()
 
 
+def configure_rate_limits(options):
+    if options.metadata_rate:
+        rate_limiter.configure(METADATA_PAGES, requests_per_second=options.metadata_rate)
+    if options.image_rate or options.image_bandwidth:
+        rate_limiter.configure(IMAGE, requests_per_second=options.image_rate,
+                               bytes_per_second=options.image_bandwidth)
+
+
+def configure_metadata(options):
+    cache = None
+    if options.metadata_ttl > 0:
+        try:
+            cache = MetadataCache(ttl=options.metadata_ttl, size=options.metadata_cache_size,
+                                  refresh=options.refresh_metadata)
+        except sqlite3.Error as e:
+            logger.warning(f'Metadata cache unavailable, fetching every gallery: {e}')
+    metadata_source.configure(options.metadata_backend, cache=cache)
+
+
 def resolve_doujinshi_ids(options):
     doujinshis = []
     doujinshi_ids = []
@@ -72,27 +105,25 @@ def resolve_doujinshi_ids(options):
         doujinshi_ids = [i['id'] for i in doujinshis]
 
     if options.is_save_download_history:
-        with DB() as db:
-            data = set(map(int, db.get_all()))
-
-        doujinshi_ids = list(set(map(int, doujinshi_ids)) - set(data))
+        with JobQueue() as jobs:
+            doujinshi_ids = jobs.enqueue(doujinshi_ids or [])
+            if options.resume:
+                doujinshi_ids = jobs.unfinished()
         logger.info(f'New doujinshis account: {len(doujinshi_ids)}')
 
     return doujinshi_ids
 
 
-class DownloadStatus(Enum):
-    SUCCESS = 'success'
-    SKIPPED = 'skipped'
-    FAILED = 'failed'
-
-
 def validate_options(options):
     errors = []
     if options.move_to_folder and options.rm_origin_dir:
         errors.append('Cannot use --move-to-folder together with --rm-origin-dir.')
     if options.zip and options.is_nohtml:
         errors.append('Cannot use --zip together with --nohtml (zip already disables HTML).')
+    if options.direct_cbz and options.zip:
+        errors.append('Cannot use --direct-cbz together with --zip.')
+    if options.direct_cbz and options.is_pdf:
+        errors.append('Cannot use --direct-cbz together with --pdf, the PDF is made from the doujinshi dir.')
 
     if errors:
         for message in errors:
@@ -100,125 +131,167 @@ def validate_options(options):
         sys.exit(1)
 
 
-def download_one(doujinshi, options):
+def load_doujinshi(doujinshi_id, options, downloader, failed_downloads, jobs):
+    jobs.update(doujinshi_id, METADATA)
+    doujinshi_info = metadata_source.fetch(doujinshi_id)
+    if not doujinshi_info:
+        logger.error(f'Failed to get info for doujinshi {doujinshi_id}')
+        jobs.update(doujinshi_id, FAILED, 'no gallery metadata')
+        failed_downloads.append(doujinshi_id)
+        if options.exit_on_fail:
+            sys.exit(1)
+        return None
+
+    doujinshi = Doujinshi(name_format=options.name_format, **doujinshi_info)
+    doujinshi.downloader = downloader
+
+    if options.is_save_download_history and not options.regenerate:
+        # the folder of a doujinshi an earlier run was working on is resumed rather than taken as done
+        resumed = jobs.get(doujinshi_id)['attempts'] > 1
+        if doujinshi.has_existing_artifacts(options, include_directory=not resumed):
+            logger.info(
+                'Skip download doujinshi because output already exists for '
+                f'{doujinshi.name}'
+            )
+            with DB() as db:
+                db.add_one(doujinshi.id)
+            jobs.update(doujinshi_id, DONE)
+            return None
+
     if not doujinshi.check_if_need_download(options):
-        return (
-            DownloadStatus.SKIPPED,
-            f'Skip download doujinshi because a PDF/CBZ file exists of doujinshi {doujinshi.name}',
-            doujinshi,
-        )
+        logger.info(f'Skip download doujinshi because a PDF/CBZ file exists of doujinshi {doujinshi.name}')
+        return doujinshi, []
 
-    try:
-        result = doujinshi.download()
-    except Exception as e:
-        return DownloadStatus.FAILED, f'Exception during download: {e}', doujinshi
+    logger.info(f'Starting to download doujinshi: {doujinshi.name}')
+    download_queue = doujinshi.download_queue()
+    if download_queue is None:
+        logger.error(f'Download failed for {doujinshi.name}')
+        jobs.update(doujinshi_id, FAILED, 'invalid gallery metadata')
+        failed_downloads.append(doujinshi_id)
+        if options.exit_on_fail:
+            sys.exit(1)
+        return None
+
+    jobs.update(doujinshi_id, DOWNLOADING)
+    return doujinshi, download_queue
+
+
+def post_process(doujinshi, options, generated=()):
+    if options.generate_metadata:
+        generate_metadata(options.output_dir, doujinshi)
+
+    if options.is_save_download_history:
+        with DB() as db:
+            db.add_one(doujinshi.id)
+
+    if not options.is_nohtml:
+        generate_html(options.output_dir, doujinshi, template=constant.CONFIG['template'])
+
+    # --direct-cbz already wrote the CBZ file while downloading
+    if options.is_cbz and not options.direct_cbz:
+        generate_doc('cbz', options.output_dir, doujinshi, options.regenerate)
 
-    if result is False or (isinstance(result, int) and result < 0):
-        return DownloadStatus.FAILED, f'Download failed for {doujinshi.name}', doujinshi
+    # the PDF is written while downloading when every page made it, otherwise from the pages on disk
+    if options.is_pdf and 'pdf' not in generated:
+        generate_doc('pdf', options.output_dir, doujinshi, options.regenerate)
 
-    return DownloadStatus.SUCCESS, None, doujinshi
+    if options.move_to_folder:
+        if options.is_cbz:
+            move_to_folder(options.output_dir, doujinshi, 'cbz')
+        if options.is_pdf:
+            move_to_folder(options.output_dir, doujinshi, 'pdf')
 
+    if options.rm_origin_dir:
+        shutil.rmtree(os.path.join(options.output_dir, doujinshi.filename), ignore_errors=True)
 
-def run_downloads(options, doujinshi_ids):
+
+def create_downloader(options):
     if options.zip:
         options.is_nohtml = True
+    if options.direct_cbz:
+        options.is_cbz = True
+        options.is_nohtml = True
 
-    downloader = (CompressedDownloader if options.zip else Downloader)(path=options.output_dir, threads=options.threads,
-                            timeout=options.timeout, delay=options.delay,
-                            exit_on_fail=options.exit_on_fail,
-                            no_filename_padding=options.no_filename_padding,
-                            webp=options.webp)
+    if options.zip:
+        downloader_class = CompressedDownloader
+    elif options.direct_cbz:
+        downloader_class = CbzDownloader
+    else:
+        downloader_class = Downloader
+
+    downloader = downloader_class(path=options.output_dir, threads=options.threads,
+                                  timeout=options.timeout, delay=options.delay,
+                                  exit_on_fail=options.exit_on_fail,
+                                  no_filename_padding=options.no_filename_padding,
+                                  webp=options.webp,
+                                  webp_processes=options.webp_processes,
+                                  zip_compression=options.zip_compression,
+                                  pdf=options.is_pdf,
+                                  max_connections=options.max_connections,
+                                  keepalive_expiry=options.keepalive_expiry,
+                                  http2=options.http2,
+                                  adaptive=options.adaptive,
+                                  save_mirror_stats=options.save_mirror_stats,
+                                  hedge=options.hedge,
+                                  hedge_budget=options.hedge_budget)
+    return downloader
+
+
+def run_downloads(options, doujinshi_ids, downloader=None, jobs=None):
+    """
+    Download and post-process ``doujinshi_ids``, returns the ids that failed. A ``downloader`` passed
+    in is left running for the next call, otherwise one is created for this call and shut down.
+    With a ``jobs`` queue the ids are already queued in it, and may be an iterator of claimed ids.
+    """
+    owned = downloader is None
+    if owned:
+        downloader = create_downloader(options)
+    owned_jobs = jobs is None
+    if owned_jobs:
+        # without the download history the states only live as long as this run
+        jobs = JobQueue(None if options.is_save_download_history else ':memory:')
+        jobs.enqueue(doujinshi_ids)
 
     failed_downloads = []
 
-    progress_context = (
-        Progress(
-            TextColumn("[progress.description]{task.description}"),
-            BarColumn(),
-            TextColumn("[progress.percentage]{task.percentage:>3.0f}%"),
-            TextColumn("•"),
-            TextColumn("[cyan]{task.completed}/{task.total}"),
-            TextColumn("favorites"),
-            TimeRemainingColumn(),
-            console=console,
-            refresh_per_second=10,
-            transient=False,
-        )
-        if options.favorites and options.is_download and doujinshi_ids
-        else nullcontext()
-    )
-
-    with progress_context as progress:
-        favorites_task = (
-            progress.add_task("[green]Favorites", total=len(doujinshi_ids))
-            if progress is not None
-            else None
-        )
-        for doujinshi_id in doujinshi_ids:
-            doujinshi_info = doujinshi_parser(doujinshi_id)
-            if not doujinshi_info:
-                logger.error(f'Failed to get info for doujinshi {doujinshi_id}')
-                failed_downloads.append(doujinshi_id)
-                if options.exit_on_fail:
-                    sys.exit(1)
-                if favorites_task is not None:
-                    progress.update(favorites_task, advance=1)
-                continue
-
-            doujinshi = Doujinshi(name_format=options.name_format, **doujinshi_info)
-            doujinshi.downloader = downloader
-
-            if options.is_save_download_history and not options.regenerate:
-                if doujinshi.has_existing_artifacts(options, include_directory=True):
-                    logger.info(
-                        'Skip download doujinshi because output already exists for '
-                        f'{doujinshi.name}'
-                    )
-                    with DB() as db:
-                        db.add_one(doujinshi.id)
-                    if favorites_task is not None:
-                        progress.update(favorites_task, advance=1)
-                    continue
-
-            status, message, doujinshi = download_one(doujinshi, options)
-            if status is DownloadStatus.FAILED:
-                logger.error(message)
-                failed_downloads.append(doujinshi_id)
-                if options.exit_on_fail:
-                    sys.exit(1)
-                if favorites_task is not None:
-                    progress.update(favorites_task, advance=1)
-                continue
-            if status is DownloadStatus.SKIPPED and message:
-                logger.info(message)
-
-            if options.generate_metadata:
-                generate_metadata(options.output_dir, doujinshi)
-
-            if options.is_save_download_history:
-                with DB() as db:
-                    db.add_one(doujinshi.id)
-
-            if not options.is_nohtml:
-                generate_html(options.output_dir, doujinshi, template=constant.CONFIG['template'])
-
-            if options.is_cbz:
-                generate_doc('cbz', options.output_dir, doujinshi, options.regenerate)
-
-            if options.is_pdf:
-                generate_doc('pdf', options.output_dir, doujinshi, options.regenerate)
-
-            if options.move_to_folder:
-                if options.is_cbz:
-                    move_to_folder(options.output_dir, doujinshi, 'cbz')
-                if options.is_pdf:
-                    move_to_folder(options.output_dir, doujinshi, 'pdf')
-
-            if options.rm_origin_dir:
-                shutil.rmtree(os.path.join(options.output_dir, doujinshi.filename), ignore_errors=True)
-
-            if favorites_task is not None:
-                progress.update(favorites_task, advance=1)
+    def finish(doujinshi, gallery):
+        jobs.update(doujinshi.id, POST_PROCESSING)
+        try:
+            post_process(doujinshi, options, generated=gallery.storage.generated if gallery is not None else ())
+        except Exception as e:
+            jobs.update(doujinshi.id, FAILED, f'post-processing: {type(e).__name__}: {e}')
+            raise
+
+        if gallery is not None and gallery.failed:
+            failed_downloads.append(doujinshi.id)
+            jobs.update(doujinshi.id, FAILED, f'{gallery.failed} of {gallery.total} pages failed')
+        else:
+            jobs.update(doujinshi.id, DONE)
+
+    # every doujinshi shares one event loop and one page queue, see BatchDownload
+    batch = BatchDownload(downloader,
+                          load=lambda doujinshi_id: load_doujinshi(doujinshi_id, options, downloader,
+                                                                   failed_downloads, jobs),
+                          finish=finish,
+                          metadata_threads=options.metadata_threads,
+                          post_threads=options.post_threads)
+    try:
+        batch.run(doujinshi_ids)
+    except ExitOnFail as e:
+        if not owned:
+            # the caller decides, a daemon only fails the job
+            raise
+        logger.critical(f'{e}, exiting because of --exit-on-fail')
+        sys.exit(1)
+    finally:
+        if owned_jobs:
+            jobs.close()
+        if owned:
+            downloader.shutdown()
+    if retry_policy.retries or retry_policy.failures:
+        logger.info(f'Retries: {retry_policy}')
+    if metadata_source.cache is not None:
+        logger.info(f'Metadata cache: {metadata_source.cache}')
 
     if options.main_viewer:
         generate_main_html(options.output_dir)
@@ -226,22 +299,189 @@ def run_downloads(options, doujinshi_ids):
     # Print summary of failed downloads
     if failed_downloads:
         logger.error(f'Failed to download {len(failed_downloads)} doujinshi: {failed_downloads}')
+    if batch.failures:
+        logger.error(f'Failed to post-process {len(batch.failures)} doujinshi: {[i.id for i in batch.failures]}')
+
+    if not platform.system() == 'Windows':
+        logger.log(16, '🍻 All done.')
+    else:
+        logger.log(16, 'All done.')
+
+    return failed_downloads + [i.id for i in batch.failures if i.id not in failed_downloads]
+
+
+def shard_options(options, workers):
+    """ Options of one of ``workers`` processes, which split the rate limits between them. """
+    options = copy.copy(options)
+    options.delay = options.delay * workers
+    for name in ('metadata_rate', 'image_rate', 'image_bandwidth'):
+        if getattr(options, name):
+            setattr(options, name, getattr(options, name) / workers)
+    # written once by the parent when every worker is done
+    options.main_viewer = False
+    return options
+
+
+def run_shard(options, config, history, queue_path, run):
+    """ Entry point of a --workers process, started with a fresh interpreter. """
+    constant.CONFIG.update(config)
+    constant.NHENTAI_HISTORY = history
+    if options.retry:
+        constant.RETRY_TIMES = int(options.retry)
+    configure_rate_limits(options)
+    configure_metadata(options)
+    # the parent shows the progress of every worker, errors are kept in the job queue
+    console.quiet = True
+
+    try:
+        with JobQueue(queue_path, run=run) as jobs:
+            work_shard(options, jobs)
+    finally:
+        metadata_source.close()
+        session_manager.close()
+
+
+def work_shard(options, jobs):
+    """ Download what can be claimed from ``jobs``, local or a RemoteJobQueue, until it is drained. """
+    downloader = create_downloader(options)
+    try:
+        Shard(jobs, downloader, batch=options.metadata_threads).run(
+            lambda ids: run_downloads(options, ids, downloader=downloader, jobs=jobs))
+    except ExitOnFail as e:
+        logger.critical(f'{e}, exiting because of --exit-on-fail')
+        sys.exit(1)
+    finally:
+        downloader.shutdown()
+
+
+@contextlib.contextmanager
+def batch_queue(options, doujinshi_ids):
+    """
+    A job queue of a new run holding ``doujinshi_ids``, for the processes a batch is spread across.
+    It is kept in the download history with --save-download-history, otherwise in a database of
+    its own that is removed afterwards.
+    """
+    path = None
+    if not options.is_save_download_history:
+        handle, path = tempfile.mkstemp(prefix='nhentai-jobs-', suffix='.sqlite3')
+        os.close(handle)
+    try:
+        with JobQueue(path, run=uuid.uuid4().hex) as jobs:
+            jobs.enqueue(doujinshi_ids)
+            # whatever an earlier run left half done or failed is free to claim again
+            jobs.requeue(doujinshi_ids)
+            yield jobs
+    finally:
+        if path is not None:
+            for suffix in ('', '-wal', '-shm'):
+                with contextlib.suppress(OSError):
+                    os.remove(f'{path}{suffix}')
+
+
+def run_sharded(options, doujinshi_ids):
+    """
+    Download ``doujinshi_ids`` with ``options.workers`` processes that claim them from a job
+    queue, returns the ids that failed.
+    """
+    with batch_queue(options, doujinshi_ids) as jobs:
+        # doujinshi earlier runs left unfinished are only part of the batch with --resume
+        pool = WorkerPool(jobs, options.workers, run_shard,
+                          args=(shard_options(options, options.workers), dict(constant.CONFIG),
+                                constant.NHENTAI_HISTORY, jobs.path, jobs.run),
+                          total=jobs.pending())
+        pool.run()
+        failures = jobs.failures(since=pool.started)
+        unfinished = jobs.pending()
+
+    if options.main_viewer:
+        generate_main_html(options.output_dir)
+
+    for doujinshi_id, error in failures:
+        logger.error(f'Doujinshi {doujinshi_id}: {error}')
+    if failures:
+        logger.error(f'Failed to download {len(failures)} doujinshi: {[i for i, _ in failures]}')
+    if unfinished:
+        logger.warning(f'{unfinished} doujinshi were not finished, run again with --resume')
 
     if not platform.system() == 'Windows':
         logger.log(16, '🍻 All done.')
     else:
         logger.log(16, 'All done.')
+    return [i for i, _ in failures]
+
+
+def run_coordinator(options, doujinshi_ids):
+    """ Serve ``doujinshi_ids`` to --worker-of processes until every one of them is finished. """
+    with batch_queue(options, doujinshi_ids) as jobs:
+        coordinator = Coordinator(options.coordinator, jobs, total=jobs.pending(), token=options.coordinator_token)
+        try:
+            coordinator.listen()
+        except (ValueError, OSError) as e:
+            logger.critical(f'Cannot listen on {options.coordinator}: {e}')
+            sys.exit(1)
+
+        signal.signal(signal.SIGTERM, signal_handler)
+        coordinator.serve()
+        failures = jobs.failures(since=coordinator.started)
+        unfinished = jobs.pending()
+        workers = jobs.workers(since=coordinator.started)
+
+    logger.info(f'{len(workers)} workers downloaded {sum(w["pages"] for w in workers)} pages, '
+                f'{sum(w["bytes"] for w in workers)} bytes')
+    for doujinshi_id, error in failures:
+        logger.error(f'Doujinshi {doujinshi_id}: {error}')
+    if failures:
+        logger.error(f'Failed to download {len(failures)} doujinshi: {[i for i, _ in failures]}')
+    if unfinished:
+        logger.warning(f'{unfinished} doujinshi were not finished, run again with --resume')
+    return [i for i, _ in failures]
+
+
+def run_remote_worker(options):
+    logger.info(f'Working for the coordinator at {options.worker_of}')
+    with RemoteJobQueue(options.worker_of, token=options.coordinator_token) as jobs:
+        try:
+            work_shard(options, jobs)
+        except PermissionError as e:
+            logger.critical(f'{e}, check --coordinator-token')
+            sys.exit(1)
+
+
+def run_daemon(options):
+    # built before the API threads start, the WebP process pool is forked from here
+    downloader = create_downloader(options)
+
+    def run_job(job_options):
+        doujinshi_ids = resolve_doujinshi_ids(job_options)
+        return doujinshi_ids, run_downloads(job_options, doujinshi_ids, downloader=downloader)
+
+    daemon = Daemon(options.daemon, options, downloader, run_job, token=options.daemon_token)
+    try:
+        daemon.listen()
+    except (ValueError, OSError) as e:
+        logger.critical(f'Cannot listen on {options.daemon}: {e}')
+        downloader.shutdown()
+        sys.exit(1)
+
+    signal.signal(signal.SIGTERM, signal_handler)
+    try:
+        daemon.serve()
+    finally:
+        downloader.shutdown()
 
 
 def show_doujinshi(options, doujinshi_ids):
     for doujinshi_id in doujinshi_ids:
-        doujinshi_info = doujinshi_parser(doujinshi_id)
+        doujinshi_info = metadata_source.fetch(doujinshi_id)
         if doujinshi_info:
             doujinshi = Doujinshi(name_format=options.name_format, **doujinshi_info)
         else:
             continue
         doujinshi.show()
 
+    if metadata_source.cache is not None:
+        logger.info(f'Metadata cache: {metadata_source.cache}')
+
 
 def main():
     banner()
@@ -257,13 +497,27 @@ def main():
     if options.retry:
         constant.RETRY_TIMES = int(options.retry)
 
-    configure_runtime(options)
-    doujinshi_ids = resolve_doujinshi_ids(options)
-
-    if options.is_show:
-        show_doujinshi(options, doujinshi_ids)
-    else:
-        run_downloads(options, doujinshi_ids)
+    try:
+        configure_runtime(options)
+        if options.daemon:
+            run_daemon(options)
+            return
+        if options.worker_of:
+            run_remote_worker(options)
+            return
+
+        doujinshi_ids = resolve_doujinshi_ids(options)
+        if options.is_show:
+            show_doujinshi(options, doujinshi_ids)
+        elif options.coordinator:
+            run_coordinator(options, doujinshi_ids)
+        elif options.workers > 1:
+            run_sharded(options, doujinshi_ids)
+        else:
+            run_downloads(options, doujinshi_ids)
+    finally:
+        metadata_source.close()
+        session_manager.close()
 
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
@@ -0,0 +1,156 @@
+# coding: utf-8
+import asyncio
+import statistics
+import time
+
+
+class AdaptiveLimiter(object):
+    """
+    An AIMD concurrency limit used in place of a fixed ``asyncio.Semaphore``.
+
+    Every window of completed requests the limit grows by one while throughput keeps improving
+    and latency stays within ``latency_tolerance`` of the best latency seen so far. Timeouts,
+    429s and 5xx responses cut the limit by ``backoff`` at most once per window.
+    """
+
+    def __init__(self, initial, minimum=1, maximum=None, adaptive=True, backoff=0.5, latency_tolerance=1.5):
+        self.minimum = max(1, minimum)
+        self.maximum = max(maximum or initial, initial)
+        self.limit = min(max(initial, self.minimum), self.maximum)
+        self.adaptive = adaptive
+        self.backoff = backoff
+        self.latency_tolerance = latency_tolerance
+
+        self.in_flight = 0
+        self.condition = None  # Will be initialized in async context
+
+        self.peak = self.limit
+        self.lowest = self.limit
+        self.increases = 0
+        self.decreases = 0
+        self.throttled = 0
+
+        self._latencies = []
+        self._window_count = 0
+        self._window_start = time.monotonic()
+        self._window_throttled = False
+        self._best_latency = None
+        self._last_throughput = 0.0
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.release()
+
+    async def acquire(self):
+        if self.condition is None:
+            self.condition = asyncio.Condition()
+
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+
+    async def release(self):
+        async with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def record(self, latency, status=None, timeout=False):
+        self._window_count += 1
+        if timeout or (status is not None and (status == 429 or status >= 500)):
+            self.throttled += 1
+            if self.adaptive and not self._window_throttled:
+                self._window_throttled = True
+                self._set_limit(int(self.limit * self.backoff))
+        else:
+            self._latencies.append(latency)
+
+        if self._window_count >= max(self.limit, 5):
+            self._end_window()
+
+    def _end_window(self):
+        now = time.monotonic()
+        throughput = len(self._latencies) / max(now - self._window_start, 1e-6)
+
+        if self._latencies and self.adaptive and not self._window_throttled:
+            latency = statistics.median(self._latencies)
+            if self._best_latency is None or latency < self._best_latency:
+                self._best_latency = latency
+
+            latency_flat = latency <= self._best_latency * self.latency_tolerance
+            if latency_flat and throughput >= self._last_throughput * 0.95:
+                self._set_limit(self.limit + 1)
+            elif not latency_flat and throughput < self._last_throughput:
+                self._set_limit(self.limit - 1)
+
+        self._last_throughput = throughput
+        self._latencies = []
+        self._window_count = 0
+        self._window_start = now
+        self._window_throttled = False
+
+    def _set_limit(self, limit):
+        limit = min(max(limit, self.minimum), self.maximum)
+        if limit > self.limit:
+            self.increases += 1
+        elif limit < self.limit:
+            self.decreases += 1
+        else:
+            return
+
+        self.limit = limit
+        self.peak = max(self.peak, limit)
+        self.lowest = min(self.lowest, limit)
+
+        if self.condition is not None:
+            # wake up waiters, which can run now that the limit was raised
+            asyncio.ensure_future(self._notify())
+
+    async def _notify(self):
+        async with self.condition:
+            self.condition.notify_all()
+
+    def __str__(self):
+        mode = 'adaptive' if self.adaptive else 'fixed'
+        return (f'{mode} limit {self.limit} (range {self.lowest}-{self.peak}, max {self.maximum}), '
+                f'{self.increases} increases, {self.decreases} backoffs, {self.throttled} throttled responses')
+
+
+class HedgeBudget(object):
+    """
+    Decides when a slow page gets a duplicate request to another mirror.
+
+    A page is hedged once it has been pending longer than the ``percentile`` of recently observed
+    latencies. Hedges are capped at ``ratio`` of all hedge-eligible requests (plus a small burst),
+    so extra traffic stays bounded even when a host stalls.
+    """
+
+    def __init__(self, percentile=95, ratio=0.1, burst=2, min_samples=20):
+        self.percentile = percentile
+        self.ratio = ratio
+        self.burst = burst
+        self.min_samples = min_samples
+        self.requests = 0
+        self.hedges = 0
+        self.wins = 0
+
+    def delay(self, latencies):
+        self.requests += 1
+        if len(latencies) < self.min_samples:
+            return None
+
+        ordered = sorted(latencies)
+        index = min(len(ordered) - 1, int(len(ordered) * self.percentile / 100))
+        return ordered[index]
+
+    def spend(self):
+        if self.hedges >= self.requests * self.ratio + self.burst:
+            return False
+        self.hedges += 1
+        return True
+
+    def __str__(self):
+        return (f'{self.hedges} hedged out of {self.requests} requests, {self.wins} won by the hedge '
+                f'(p{self.percentile}, budget {self.ratio:.0%})')
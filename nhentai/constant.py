@@ -26,6 +26,7 @@ DEBUG = os.getenv('DEBUG', False)
 BASE_URL = os.getenv('NHENTAI', 'https://nhentai.net')
 
 DETAIL_URL = f'{BASE_URL}/g'
+API_DETAIL_URL = f'{BASE_URL}/api/gallery'
 LEGACY_SEARCH_URL = f'{BASE_URL}/search/'
 SEARCH_URL = f'{BASE_URL}/api/galleries/search'
 ARTIST_URL = f'{BASE_URL}/artist/'
@@ -38,6 +39,8 @@ FAV_URL = f'{BASE_URL}/favorites/'
 PATH_SEPARATOR = os.path.sep
 
 RETRY_TIMES = 3
+MAX_THREADS = 15
+MAX_HTTP2_THREADS = 100
 STOP_REQUESTED = False
 
 
@@ -54,8 +57,8 @@ IMAGE_URL_MIRRORS = [
 NHENTAI_HOME = get_nhentai_home()
 NHENTAI_HISTORY = os.path.join(NHENTAI_HOME, 'history.sqlite3')
 NHENTAI_CONFIG_FILE = os.path.join(NHENTAI_HOME, 'config.json')
-
-__api_suspended_DETAIL_URL = f'{BASE_URL}/api/gallery'
+NHENTAI_MIRROR_STATS = os.path.join(NHENTAI_HOME, 'mirrors.json')
+NHENTAI_METADATA_CACHE = os.path.join(NHENTAI_HOME, 'metadata.sqlite3')
 
 CONFIG = {
     'proxy': '',
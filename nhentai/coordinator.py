@@ -0,0 +1,195 @@
+# coding: utf-8
+import json
+import os
+import threading
+import time
+
+import httpx
+
+from nhentai import constant
+from nhentai.daemon import JobHandler, UnixHTTPServer, create_server, is_local
+from nhentai.jobs import LEASE_SECONDS, STATES
+from nhentai.logger import logger
+from nhentai.retry import retry_policy, classify, sleep
+from nhentai.workers import BatchProgress
+
+
+DEFAULT_ADDRESS = '127.0.0.1:7381'
+COORDINATOR = 'coordinator'
+MAX_CLAIM = 100
+MAX_LEASE = 600
+TOKEN_HEADER = 'X-Coordinator-Token'
+
+
+class CoordinatorHandler(JobHandler):
+    """
+    ``POST /<call>`` makes one of the JobQueue calls a worker needs on the coordinator's queue,
+    with the keyword arguments as a JSON object in and ``{"result": ...}`` out. ``GET /status``
+    reports on the batch and its workers. With a token every request has to carry it in the
+    ``X-Coordinator-Token`` header.
+    """
+    calls = ('claim', 'renew', 'release', 'leased', 'report', 'update', 'get')
+    token_header = TOKEN_HEADER
+
+    def do_GET(self):
+        if not self.authorized():
+            return
+        if self.path.rstrip('/') in ('', '/status'):
+            return self.reply(200, self.server.coordinator.status())
+        self.reply(404, {'error': 'not found'})
+
+    def do_POST(self):
+        if not self.authorized():
+            return
+        call = self.path.strip('/')
+        if call not in self.calls:
+            return self.reply(404, {'error': 'not found'})
+
+        length = self.headers.get('Content-Length', '')
+        try:
+            body = self.rfile.read(int(length)) if length.isdigit() else b''
+            arguments = json.loads(body) if body else {}
+            if not isinstance(arguments, dict):
+                raise ValueError('arguments are a JSON object')
+            result = self.server.coordinator.call(call, arguments)
+        except (ValueError, TypeError) as e:
+            return self.reply(400, {'error': str(e)})
+        self.reply(200, {'result': result})
+
+
+class Coordinator(object):
+    """
+    Hands out the doujinshi of a job queue to workers on other machines, see RemoteJobQueue.
+    The queue does the leasing: a worker that stops renewing its leases loses its doujinshi to
+    the others. Serving stops once nothing is left to download and every worker has left.
+    Workers have to send ``token`` when one is set.
+    """
+
+    def __init__(self, address, jobs, total=0, token=None):
+        self.address = address
+        self.jobs = jobs
+        self.total = total
+        self.token = token or None
+        self.started = time.time()
+        self.server = None
+        self.lock = threading.Lock()
+        # worker -> time its latest lease runs out, while it has not left
+        self.active = {}
+
+    def call(self, name, arguments):
+        owner = arguments.get('owner')
+        if name in ('claim', 'renew'):
+            arguments['lease'] = min(max(float(arguments.get('lease', LEASE_SECONDS)), 1), MAX_LEASE)
+            with self.lock:
+                self.active[owner] = time.time() + arguments['lease']
+        if name == 'claim':
+            arguments['count'] = min(max(int(arguments.get('count', 1)), 1), MAX_CLAIM)
+        if name == 'release':
+            with self.lock:
+                self.active.pop(owner, None)
+        if name == 'update' and arguments.get('state') not in STATES:
+            raise ValueError(f'"state" must be one of {", ".join(STATES)}')
+        return getattr(self.jobs, name)(**arguments)
+
+    def workers(self):
+        now = time.time()
+        with self.lock:
+            return [owner for owner, until in self.active.items() if until > now]
+
+    def status(self):
+        return {
+            'address': self.address,
+            'uptime': round(time.time() - self.started, 3),
+            'total': self.total,
+            'jobs': self.jobs.counts(),
+            'workers': self.jobs.workers(since=self.started),
+            'active': self.workers(),
+        }
+
+    def listen(self):
+        self.server = create_server(self.address, CoordinatorHandler, token=self.token)
+        self.server.coordinator = self
+        if self.token is None and not is_local(self.address):
+            logger.warning(f'Anyone who can reach {self.address} can claim and update the doujinshi, '
+                           f'set a --coordinator-token')
+
+    def serve(self):
+        if self.server is None:
+            self.listen()
+        threading.Thread(target=self.server.serve_forever, name='coordinator-api', daemon=True).start()
+        logger.log(16, f'Serving {self.total} doujinshi to workers on {self.address}')
+
+        try:
+            with BatchProgress(self.jobs, self.total, self.started) as progress:
+                while not constant.STOP_REQUESTED:
+                    workers = self.workers()
+                    progress.update(len(workers))
+                    if not workers and not self.jobs.pending():
+                        break
+                    time.sleep(0.5)
+        finally:
+            self.server.shutdown()
+            self.server.server_close()
+            if isinstance(self.server, UnixHTTPServer):
+                os.remove(self.server.server_address)
+
+
+class RemoteJobQueue(object):
+    """
+    The JobQueue calls of a Shard and of run_downloads, made on a Coordinator at ``url``.
+    Connection errors and server errors are retried like any other request, a coordinator that
+    does not accept ``token`` raises PermissionError.
+    """
+
+    def __init__(self, url, token=None, timeout=30):
+        self.url = (url if '://' in url else f'http://{url}').rstrip('/')
+        headers = {TOKEN_HEADER: token} if token else {}
+        self.client = httpx.Client(timeout=timeout, headers=headers, trust_env=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.client.close()
+
+    def call(self, name, **arguments):
+        retry = retry_policy.start(COORDINATOR)
+        while True:
+            try:
+                response = self.client.post(f'{self.url}/{name}', json=arguments)
+                if response.status_code == 400:
+                    raise ValueError(f'Coordinator refused {name}: {response.json()["error"]}')
+                if response.status_code == 401:
+                    raise PermissionError(f'Coordinator refused {name}: {response.json()["error"]}')
+                response.raise_for_status()
+                return response.json()['result']
+            except httpx.HTTPError as e:
+                delay = retry.backoff(classify(e))
+                if delay is None:
+                    raise
+                logger.warning(f'Coordinator call {name} failed: {e}, retrying in {delay:.1f}s ...')
+                sleep(delay)
+
+    def claim(self, owner, count=1, lease=LEASE_SECONDS):
+        return self.call('claim', owner=owner, count=count, lease=lease)
+
+    def renew(self, owner, lease=LEASE_SECONDS):
+        self.call('renew', owner=owner, lease=lease)
+
+    def release(self, owner):
+        self.call('release', owner=owner)
+
+    def leased(self, exclude=None):
+        return self.call('leased', exclude=exclude)
+
+    def report(self, owner, pages, received):
+        self.call('report', owner=owner, pages=pages, received=received)
+
+    def update(self, doujinshi_id, state, error=None):
+        self.call('update', doujinshi_id=int(doujinshi_id), state=state, error=error)
+
+    def get(self, doujinshi_id):
+        return self.call('get', doujinshi_id=int(doujinshi_id))
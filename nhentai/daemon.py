@@ -0,0 +1,353 @@
+# coding: utf-8
+import copy
+import hmac
+import ipaddress
+import itertools
+import json
+import os
+import queue
+import socket
+import socketserver
+import stat
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from nhentai import constant, __version__
+from nhentai.logger import logger
+
+
+DEFAULT_ADDRESS = '127.0.0.1:7380'
+SORTING = ('recent', 'popular', 'popular-today', 'popular-week', 'date')
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def job_options(options, request):
+    """
+    Options of one job: the daemon's own, with the doujinshi to download taken from ``request``,
+    e.g. ``{"ids": [1, 2]}``, ``{"search": "tag:full color", "page": "1-3"}``, ``{"favorites": true}``
+    or ``{"artist": "name"}``. Raises ValueError for anything else.
+    """
+    if not isinstance(request, dict):
+        raise ValueError('a job is a JSON object')
+
+    options = copy.copy(options)
+    options.id, options.keyword, options.favorites, options.artist = None, None, False, None
+    options.is_download = True
+
+    if 'ids' in request:
+        if not isinstance(request['ids'], list) or not request['ids']:
+            raise ValueError('"ids" must be a non-empty list of doujinshi ids')
+        options.id = [int(i) for i in request['ids']]
+    elif 'search' in request:
+        options.keyword = str(request['search'])
+    elif request.get('favorites'):
+        if not constant.CONFIG['cookie']:
+            raise ValueError('cookie has not been set, favorites cannot be synced')
+        options.favorites = True
+    elif 'artist' in request:
+        options.artist = str(request['artist'])
+    else:
+        raise ValueError('a job needs "ids", "search", "favorites" or "artist"')
+
+    if 'page' in request:
+        options.page = str(request['page'])
+    if 'page_all' in request:
+        options.page_all = bool(request['page_all'])
+    if 'sorting' in request:
+        if request['sorting'] not in SORTING:
+            raise ValueError(f'"sorting" must be one of {", ".join(SORTING)}')
+        options.sorting = request['sorting']
+    return options
+
+
+class Job(object):
+    """ One submitted request and how far it got. Pages and bytes are counted while it runs. """
+
+    def __init__(self, id_, request, options):
+        self.id = id_
+        self.request = request
+        self.options = options
+        self.state = QUEUED
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.doujinshi = None
+        self.failed = []
+        self.downloader = None
+        self.baseline = (0, 0)
+        self.counted = (0, 0)
+
+    def begin(self, downloader):
+        self.state = RUNNING
+        self.started = time.time()
+        self.downloader = downloader
+        self.baseline = (downloader.pages_saved, downloader.received_bytes)
+
+    def end(self, state, error=None):
+        self.counted = self.progress()
+        self.downloader = None
+        self.state = state
+        self.error = error
+        self.finished = time.time()
+
+    def progress(self):
+        """ (pages, bytes) downloaded by this job, jobs run one at a time on the daemon's downloader. """
+        downloader = self.downloader
+        if downloader is None:
+            return self.counted
+        return downloader.pages_saved - self.baseline[0], downloader.received_bytes - self.baseline[1]
+
+    def to_dict(self):
+        pages, received = self.progress()
+        elapsed = ((self.finished or time.time()) - self.started) if self.started else 0
+        return {
+            'id': self.id,
+            'request': self.request,
+            'state': self.state,
+            'error': self.error,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished,
+            'doujinshi': self.doujinshi,
+            'failed': self.failed,
+            'pages': pages,
+            'bytes': received,
+            'elapsed': round(elapsed, 3),
+            'pages_per_second': round(pages / elapsed, 2) if elapsed else 0.0,
+            'bytes_per_second': round(received / elapsed) if elapsed else 0,
+        }
+
+
+class JobHandler(BaseHTTPRequestHandler):
+    """
+    ``POST /jobs`` submits a job, ``GET /jobs`` and ``GET /jobs/<id>`` report on them and
+    ``GET /status`` on the daemon itself. Bodies are JSON both ways. When the server has a token
+    every request has to carry it in the ``token_header`` header.
+    """
+    server_version = f'nhentai/{__version__}'
+    token_header = 'X-Daemon-Token'
+
+    def authorized(self):
+        token = self.server.token
+        if token is None or hmac.compare_digest(self.headers.get(self.token_header, '').encode(), token.encode()):
+            return True
+        self.reply(401, {'error': f'missing or wrong {self.token_header} header'})
+        return False
+
+    def do_GET(self):
+        if not self.authorized():
+            return
+        daemon = self.server.daemon
+        path = self.path.rstrip('/')
+        if path in ('', '/status'):
+            return self.reply(200, daemon.status())
+        if path == '/jobs':
+            return self.reply(200, [job.to_dict() for job in daemon.list_jobs()])
+        if path.startswith('/jobs/') and path[6:].isdigit():
+            job = daemon.get_job(int(path[6:]))
+            if job is not None:
+                return self.reply(200, job.to_dict())
+        self.reply(404, {'error': 'not found'})
+
+    def do_POST(self):
+        if not self.authorized():
+            return
+        if self.path.rstrip('/') != '/jobs':
+            return self.reply(404, {'error': 'not found'})
+
+        length = self.headers.get('Content-Length', '')
+        try:
+            body = self.rfile.read(int(length)) if length.isdigit() else b''
+            job = self.server.daemon.submit(json.loads(body) if body else {})
+        except (ValueError, TypeError) as e:
+            return self.reply(400, {'error': str(e)})
+        self.reply(201, job.to_dict())
+
+    def reply(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def address_string(self):
+        # clients of a Unix socket have no address
+        return self.client_address[0] if isinstance(self.client_address, tuple) else 'unix'
+
+    def log_message(self, format, *args):
+        logger.debug(f'{self.address_string()} {format % args}')
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def create_server(address, handler=JobHandler, token=None):
+    """
+    ``host:port``, ``port`` or ``unix:/path/to/socket``. Requests without ``token`` are refused
+    when one is set, see JobHandler.
+    """
+    if address.startswith('unix:'):
+        path = address[5:]
+        remove_stale_socket(path)
+        # other users of the machine should not be able to queue downloads, the socket is created
+        # without their permissions rather than restricted after it already accepts connections
+        umask = os.umask(0o177)
+        try:
+            server = UnixHTTPServer(path, handler)
+        finally:
+            os.umask(umask)
+    else:
+        host, _, port = address.rpartition(':')
+        if not port.isdigit():
+            raise ValueError(f'Invalid daemon address "{address}", expected host:port or unix:/path')
+        server = ThreadingHTTPServer((host or '127.0.0.1', int(port)), handler)
+    server.token = token or None
+    return server
+
+
+def remove_stale_socket(path):
+    """ Remove the socket a server left behind at ``path``, raises ValueError for anything else there. """
+    try:
+        mode = os.lstat(path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise ValueError(f'{path} exists and is not a socket')
+
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except ConnectionRefusedError:
+        os.remove(path)
+        return
+    finally:
+        probe.close()
+    raise ValueError(f'another server is listening on {path}')
+
+
+def is_local(address):
+    """ Whether only this machine can connect to a create_server address. """
+    if address.startswith('unix:'):
+        return True
+    host = address.rpartition(':')[0].strip('[]') or '127.0.0.1'
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+class Daemon(object):
+    """
+    Runs download jobs submitted over a local HTTP API, one at a time, on a single long-lived
+    downloader, so its connection pool, concurrency limit, mirror scores and rate limits stay warm
+    from one job to the next. ``run_job(options)`` resolves and downloads the doujinshi of a job
+    and returns ``(doujinshi_ids, failed_ids)``. Clients have to send ``token`` when one is set.
+    """
+
+    def __init__(self, address, options, downloader, run_job, token=None):
+        self.address = address
+        self.token = token
+        self.options = options
+        self.downloader = downloader
+        self.run_job = run_job
+        self.jobs = {}
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.started = time.time()
+        self.server = None
+        self.stopping = threading.Event()
+
+    def submit(self, request):
+        options = job_options(self.options, request)
+        with self.lock:
+            job = Job(next(self.ids), request, options)
+            self.jobs[job.id] = job
+        self.queue.put(job)
+        logger.info(f'Job {job.id} queued: {json.dumps(request)}')
+        return job
+
+    def get_job(self, id_):
+        with self.lock:
+            return self.jobs.get(id_)
+
+    def list_jobs(self):
+        with self.lock:
+            return list(self.jobs.values())
+
+    def status(self):
+        jobs = self.list_jobs()
+        return {
+            'address': self.address,
+            'uptime': round(time.time() - self.started, 3),
+            'jobs': {state: sum(job.state == state for job in jobs) for state in (QUEUED, RUNNING, DONE, FAILED)},
+            'pages': self.downloader.pages_saved,
+            'bytes': self.downloader.received_bytes,
+            'connections': str(self.downloader.transport.stats),
+            'concurrency': str(self.downloader.limiter),
+        }
+
+    def work(self):
+        while not constant.STOP_REQUESTED:
+            job = self.queue.get()
+            if job is None or self.stopping.is_set():
+                return
+
+            logger.info(f'Job {job.id} started')
+            job.begin(self.downloader)
+            try:
+                doujinshi_ids, failed = self.run_job(job.options)
+            except KeyboardInterrupt:
+                job.end(FAILED, 'interrupted')
+                return
+            except Exception as e:
+                logger.error(f'Job {job.id} failed: {type(e).__name__}: {e}')
+                job.end(FAILED, f'{type(e).__name__}: {e}')
+                continue
+
+            job.doujinshi = len(doujinshi_ids)
+            job.failed = list(failed)
+            job.end(DONE)
+            logger.info(f'Job {job.id} done: {job.doujinshi} doujinshi, {job.counted[0]} pages')
+
+    def stop(self):
+        """ Stop serving once the running job is done, jobs still queued are not started. """
+        self.stopping.set()
+
+    def listen(self):
+        self.server = create_server(self.address, token=self.token)
+        self.server.daemon = self
+        if self.server.token is None and not is_local(self.address):
+            logger.warning(f'Anyone who can reach {self.address} can queue downloads, set a --daemon-token')
+
+    def serve(self):
+        if self.server is None:
+            self.listen()
+        threading.Thread(target=self.server.serve_forever, name='daemon-api', daemon=True).start()
+        worker = threading.Thread(target=self.work, name='daemon-jobs', daemon=True)
+        worker.start()
+        logger.log(16, f'Accepting jobs on {self.address}')
+
+        try:
+            # Ctrl-C only sets STOP_REQUESTED, the running job notices it and stops the worker
+            while worker.is_alive() and not constant.STOP_REQUESTED:
+                if self.stopping.wait(0.5):
+                    break
+        finally:
+            self.server.shutdown()
+            self.server.server_close()
+            if isinstance(self.server, UnixHTTPServer):
+                os.remove(self.server.server_address)
+            self.queue.put(None)
+            worker.join()
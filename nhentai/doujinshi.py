@@ -143,38 +143,46 @@ class Doujinshi(object):
         # fallback
         return True
 
-    def download(self):
-        logger.info(f'Starting to download doujinshi: {self.name}')
-        if self.downloader:
-            download_queue = []
-            if len(self.ext) != self.pages:
-                logger.warning(f'Page count ({self.pages}) != ext count ({len(self.ext)})')
+    def download_queue(self):
+        """ Image URLs of every page, or None when the gallery data cannot be trusted. """
+        download_queue = []
+        if len(self.ext) != self.pages:
+            logger.warning(f'Page count ({self.pages}) != ext count ({len(self.ext)})')
+
+        if not self.ext:
+            logger.error('No extensions found, cannot download')
+            return None
 
-            if not self.ext:
-                logger.error('No extensions found, cannot download')
-                return False
+        # Validate image ID is numeric (SEC-06)
+        if not str(self.img_id).isdigit():
+            logger.error(f'Invalid image ID: {self.img_id} - must be numeric')
+            return None
 
-            # Validate image ID is numeric (SEC-06)
-            if not str(self.img_id).isdigit():
-                logger.error(f'Invalid image ID: {self.img_id} - must be numeric')
-                return False
+        # Define allowed extensions (SEC-06)
+        ALLOWED_EXT = {'jpg', 'jpeg', 'png', 'gif', 'webp'}
+        DEFAULT_EXT = 'jpg'
+
+        # Validate all extensions before constructing URLs
+        for ext in self.ext:
+            if ext not in ALLOWED_EXT:
+                logger.error(f'Invalid extension detected: {ext} - only {ALLOWED_EXT} allowed')
+                return None
 
-            # Define allowed extensions (SEC-06)
-            ALLOWED_EXT = {'jpg', 'jpeg', 'png', 'gif', 'webp'}
-            DEFAULT_EXT = 'jpg'
+        for i in range(1, self.pages + 1):
+            # Use extension from array if available, otherwise default
+            ext = self.ext[i-1] if i <= len(self.ext) else DEFAULT_EXT
+            download_queue.append(f'{IMAGE_URL}/{self.img_id}/{i}.{ext}')
 
-            # Validate all extensions before constructing URLs
-            for ext in self.ext:
-                if ext not in ALLOWED_EXT:
-                    logger.error(f'Invalid extension detected: {ext} - only {ALLOWED_EXT} allowed')
-                    return False
+        return download_queue
 
-            for i in range(1, self.pages + 1):
-                # Use extension from array if available, otherwise default
-                ext = self.ext[i-1] if i <= len(self.ext) else DEFAULT_EXT
-                download_queue.append(f'{IMAGE_URL}/{self.img_id}/{i}.{ext}')
+    def download(self):
+        logger.info(f'Starting to download doujinshi: {self.name}')
+        if self.downloader:
+            download_queue = self.download_queue()
+            if download_queue is None:
+                return False
 
-            return self.downloader.start_download(download_queue, self.filename)
+            return self.downloader.start_download(download_queue, self.filename, doujinshi=self)
         else:
             logger.critical('Downloader has not been loaded')
             return False
@@ -1,18 +1,34 @@
 # coding: utf-8
 
+import abc
 import os
+import re
+import queue
+import signal
 import asyncio
+import threading
+import hashlib
 import httpx
 import urllib3.exceptions
 import zipfile
 import io
+import time
 import aiofiles
 
+from concurrent.futures import ProcessPoolExecutor
 from urllib.parse import urlparse
 from rich.progress import Progress, BarColumn, TextColumn, TimeRemainingColumn
 from nhentai import constant
 from nhentai.logger import logger, console
-from nhentai.utils import Singleton, async_request
+from nhentai.utils import Singleton, raise_if_stop_requested
+from nhentai.concurrency import AdaptiveLimiter, HedgeBudget
+from nhentai.mirrors import MirrorScoreboard, origin_of
+from nhentai.ratelimit import rate_limiter, IMAGE
+from nhentai.serializer import comic_xml
+from nhentai.pdf import PdfWriter
+from nhentai.manifest import PageManifest, file_digest, directory_manifest_path, archive_manifest_path
+from nhentai.retry import retry_policy, classify, async_sleep, INCOMPLETE
+from nhentai.transport import AsyncTransport, DEFAULT_KEEPALIVE_EXPIRY
 
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
@@ -21,6 +37,18 @@ PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
 JPEG_SIGNATURE = b"\xff\xd8\xff"
 RIFF_SIGNATURE = b"RIFF"
 WEBP_SIGNATURE = b"WEBP"
+# enough bytes to tell every supported format apart
+SNIFF_LENGTH = 16
+CHUNK_SIZE = 64 * 1024
+PART_SUFFIX = '.part'
+# 206 answers a Range request when resuming a part file
+SUCCESS_STATUS = (200, 206)
+# downloaded pages handed to the zip writer thread before downloads have to wait for it
+ZIP_QUEUE_SIZE = 16
+ZIP_COMPRESSION = {
+    'stored': zipfile.ZIP_STORED,
+    'deflated': zipfile.ZIP_DEFLATED,
+}
 
 CONTENT_TYPE_TO_FORMAT = {
     "image/png": "png",
@@ -92,21 +120,123 @@ def convert_to_webp(image_bytes, quality):
                 return output.getvalue()
 
 
-def prepare_image_payload(filename, response, webp):
-    content = response.content if response is not None else b""
-    detected_format = detect_image_format(response.headers.get("content-type") if response else None, content)
+def convert_file_to_webp(path, quality):
+    # runs in a worker process, the result replaces the original file
+    with open(path, "rb") as f:
+        content = convert_to_webp(f.read(), quality=quality)
+    temp_path = f"{path}.webp"
+    with open(temp_path, "wb") as f:
+        f.write(content)
+    os.replace(temp_path, path)
+
+
+def ignore_interrupts():
+    # Ctrl-C is handled by the parent, which shuts the pool down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+class WebpConverter(object):
+    """
+    Re-encodes pages to WebP in a pool of ``processes`` worker processes (one per core by default),
+    so encoding neither blocks the event loop nor is limited to one core. At most ``backlog`` pages
+    wait for a free process; past that, ``convert`` blocks the download that wants to save, which
+    keeps downloaded pages from piling up on disk faster than they can be encoded.
+    ``processes=0`` encodes on the event loop thread.
+    """
+
+    def __init__(self, processes=None, backlog=None):
+        self.processes = (os.cpu_count() or 1) if processes is None else processes
+        self.backlog = max(self.processes, 1) * 2 if backlog is None else backlog
+        self.executor = None
+        self.slots = None
+
+    def start(self):
+        """
+        Start the worker processes. Called before the download threads exist, since forking a
+        process that already runs other threads can leave locks held in the child.
+        """
+        if self.processes and self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.processes, initializer=ignore_interrupts)
+            for future in [self.executor.submit(int) for _ in range(self.processes)]:
+                future.result()
+
+    async def convert(self, path, quality):
+        try:
+            if not self.processes:
+                convert_file_to_webp(path, quality)
+                return True
+
+            self.start()
+            if self.slots is None:
+                self.slots = asyncio.Semaphore(self.processes + self.backlog)
+
+            async with self.slots:
+                await asyncio.get_running_loop().run_in_executor(self.executor, convert_file_to_webp, path, quality)
+            return True
+        except Exception as exc:
+            logger.error(f"WebP conversion failed for {os.path.basename(path)}: {exc}")
+            return False
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.executor = None
+
+
+async def prepare_image_file(filename, path, content_type, converter=None):
+    """
+    Decide the final name of a page already written to ``path``. The format is sniffed from the
+    first bytes only; with a ``converter``, PNG and JPEG pages are re-encoded to WebP in place.
+    """
+    with open(path, "rb") as f:
+        head = f.read(SNIFF_LENGTH)
+
+    detected_format = detect_image_format(content_type, head)
     filename = normalize_filename_extension(filename, detected_format)
 
-    if webp and detected_format in {"png", "jpeg"} and content:
+    if converter is not None and detected_format in {"png", "jpeg"} and head:
         quality = 100 if detected_format == "png" else 90
-        try:
-            content = convert_to_webp(content, quality=quality)
+        if await converter.convert(path, quality):
             base, _extension = os.path.splitext(filename)
-            filename = f"{base}.webp"
-        except Exception as exc:
-            logger.error(f"WebP conversion failed for {filename}: {exc}")
+            return f"{base}.webp"
+
+    return filename
+
+
+class IncompleteDownloadError(Exception):
+    retry_class = INCOMPLETE
 
-    return filename, content
+
+class ExitOnFail(Exception):
+    """ A page failed with --exit-on-fail, the run stops. """
+
+
+def parse_content_range(content_range):
+    # bytes 100-1999/2000 -> (100, 2000)
+    match = re.match(r'bytes (\d+)-\d+/(\d+|\*)', content_range or '')
+    if not match:
+        raise IncompleteDownloadError(f'invalid Content-Range header "{content_range}"')
+    total = match.group(2)
+    return int(match.group(1)), int(total) if total.isdigit() else None
+
+
+def unsatisfied_range_length(content_range):
+    # bytes */2000 -> 2000
+    match = re.match(r'bytes \*/(\d+)$', (content_range or '').strip())
+    return int(match.group(1)) if match else None
+
+
+def page_order(name):
+    # 2.jpg before 10.jpg, also without zero padding
+    base = os.path.splitext(name)[0]
+    return (0, int(base), name) if base.isdigit() else (1, 0, name)
+
+
+def remove_quietly(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
 
 
 def download_callback(result):
@@ -126,22 +256,74 @@ def download_callback(result):
 
 class Downloader(Singleton):
     def __init__(self, path='', threads=5, timeout=30, delay=0, exit_on_fail=False,
-                 no_filename_padding=False, webp=False):
+                 no_filename_padding=False, webp=False, max_connections=None,
+                 keepalive_expiry=DEFAULT_KEEPALIVE_EXPIRY, http2=False, adaptive=True,
+                 save_mirror_stats=False, hedge=None, hedge_budget=0.1, webp_processes=None,
+                 zip_compression='stored', pdf=False):
         self.threads = threads
         self.path = str(path)
         self.timeout = timeout
         self.delay = delay
+        if delay and IMAGE not in rate_limiter.classes:
+            # --delay spaces out page requests across all workers instead of sleeping in each of them
+            rate_limiter.configure(IMAGE, requests_per_second=1 / delay)
         self.exit_on_fail = exit_on_fail
-        self.folder = None
-        self.semaphore = None  # Will be initialized in async context
         self.no_filename_padding = no_filename_padding
         self.webp = webp
+        self.zip_compression = ZIP_COMPRESSION[zip_compression]
+        self.pdf = pdf
+        # totals over the downloader's lifetime, a daemon job reports the difference
+        self.pages_saved = 0
+        self.received_bytes = 0
+        self.converter = WebpConverter(processes=webp_processes) if webp else None
+        if self.converter is not None:
+            self.converter.start()
+        # --threads is where the limit starts, it then follows the observed throughput
+        self.limiter = AdaptiveLimiter(threads, adaptive=adaptive,
+                                       maximum=constant.MAX_HTTP2_THREADS if http2 else constant.MAX_THREADS)
+        if not max_connections:
+            # HTTP/2 multiplexes every page of a host over one connection anyway, the pool only fills up
+            # when a host falls back to HTTP/1.1, which must not cap the downloads below the limiter
+            max_connections = self.limiter.maximum
+        self.transport = AsyncTransport(max_connections=max_connections,
+                                        max_keepalive_connections=max_connections,
+                                        keepalive_expiry=keepalive_expiry, http2=http2)
+        self.mirrors = MirrorScoreboard(path=constant.NHENTAI_MIRROR_STATS if save_mirror_stats else None)
+        self.hedge = HedgeBudget(percentile=hedge, ratio=hedge_budget) if hedge else None
+        # One event loop for the whole run, so pooled connections outlive a single doujinshi
+        self.loop = None
 
-    async def fiber(self, tasks):
-        # Initialize semaphore in async context to use the current event loop
-        if self.semaphore is None:
-            self.semaphore = asyncio.Semaphore(self.threads)
+    def run(self, coroutine):
+        if self.loop is None or self.loop.is_closed():
+            self.loop = asyncio.new_event_loop()
+        return self.loop.run_until_complete(coroutine)
 
+    def shutdown(self):
+        if self.converter is not None:
+            self.converter.shutdown()
+
+        if self.loop is None or self.loop.is_closed():
+            return
+
+        try:
+            self.loop.run_until_complete(self.transport.aclose())
+            self.loop.run_until_complete(self.loop.shutdown_asyncgens())
+        finally:
+            self.loop.close()
+            self.loop = None
+
+        if self.transport.stats.requests:
+            logger.info(f'Image connections: {self.transport.stats}')
+            logger.info(f'Download concurrency: {self.limiter}')
+            logger.info(f'Image hosts: {self.mirrors}')
+            if rate_limiter.classes:
+                logger.info(f'Rate limits: {rate_limiter}')
+            if self.hedge is not None:
+                logger.info(f'Hedged requests: {self.hedge}')
+
+        self.mirrors.save()
+
+    async def fiber(self, tasks):
         download_tasks = [asyncio.create_task(task) for task in tasks]
         with Progress(
             TextColumn("[progress.description]{task.description}"),
@@ -150,12 +332,15 @@ class Downloader(Singleton):
             TextColumn("•"),
             TextColumn("[cyan]{task.completed}/{task.total}"),
             TextColumn("pages"),
+            TextColumn("•"),
+            TextColumn("[magenta]{task.fields[limit]} concurrent"),
             TimeRemainingColumn(),
             console=console,
             refresh_per_second=10,
             transient=False,
         ) as progress:
-            download_task = progress.add_task("[green]Downloading", total=len(download_tasks))
+            download_task = progress.add_task("[green]Downloading", total=len(download_tasks),
+                                              limit=self.limiter.limit)
 
             for completed_task in asyncio.as_completed(download_tasks):
                 if constant.STOP_REQUESTED:
@@ -166,9 +351,9 @@ class Downloader(Singleton):
                 try:
                     result = await completed_task
                     if result[0] > 0:
-                        progress.update(download_task, advance=1)
+                        progress.update(download_task, advance=1, limit=self.limiter.limit)
                     else:
-                        progress.update(download_task, advance=1)
+                        progress.update(download_task, advance=1, limit=self.limiter.limit)
                         raise Exception(f'{result[1]} download failed, return value {result[0]}')
                 except KeyboardInterrupt:
                     for task in download_tasks:
@@ -179,100 +364,229 @@ class Downloader(Singleton):
                     # Log errors using logger, rich will handle the display
                     progress.console.print(f'[red]Error:[/red] {e}')
                     if self.exit_on_fail:
-                        raise Exception('User intends to exit on fail')
+                        raise ExitOnFail(str(e))
 
-    async def _semaphore_download(self, *args, **kwargs):
-        async with self.semaphore:
-            return await self.download(*args, **kwargs)
+    async def fetch(self, url, part_path):
+        """
+        Stream ``url`` into ``part_path``. When the part file already holds bytes from an earlier
+        attempt or run, only the rest is requested with a Range header. Part files survive errors
+        and interruptions so the next attempt can pick them up. A range the host cannot satisfy means
+        the part file is either complete already or does not belong to the page, then it is started over.
+        """
+        reservation = await rate_limiter.async_wait(IMAGE)
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        # ranges count raw bytes, so the body must not be content-encoded
+        headers = {'Accept-Encoding': 'identity'}
+        if offset:
+            headers['Range'] = f'bytes={offset}-'
 
-    async def download(self, url, folder='', filename='', retried=0, proxy=None, length=0):
-        # Suppress verbose logging during downloads - progress bar shows status
-        if self.delay:
-            await asyncio.sleep(self.delay)
+        host = origin_of(url)
+        self.mirrors.started(host)
+        start = time.monotonic()
+        try:
+            async with self.transport.stream('GET', url, timeout=self.timeout, headers=headers) as response:
+                if response.status_code in SUCCESS_STATUS:
+                    await self.write_part(response, part_path, offset, reservation)
+                else:
+                    # drain the short error body so the connection goes back to the pool
+                    await response.aread()
+        except (httpx.TransportError, IncompleteDownloadError) as e:
+            latency = time.monotonic() - start
+            self.limiter.record(latency, timeout=isinstance(e, httpx.TimeoutException))
+            self.mirrors.record(host, latency, ok=False)
+            raise
+        except BaseException:
+            self.mirrors.cancelled(host)
+            raise
+        finally:
+            rate_limiter.settle(reservation)
 
-        filename = filename if filename else os.path.basename(urlparse(url).path)
-        base_filename, extension = os.path.splitext(filename)
+        latency = time.monotonic() - start
+        self.limiter.record(latency, status=response.status_code)
+        if response.status_code == 416 and offset:
+            if unsatisfied_range_length(response.headers.get('content-range')) == offset:
+                # the part file already holds the whole page, e.g. a run stopped right before renaming it
+                self.mirrors.record(host, latency, ok=True)
+                complete = httpx.Response(200, headers={'Content-Length': str(offset)}, request=response.request)
+                return complete, part_path
 
-        if not self.no_filename_padding:
-            filename = base_filename.zfill(length) + extension
+            # the part file does not match what the host has, start over once without a Range header
+            self.mirrors.cancelled(host)
+            remove_quietly(part_path)
+            return await self.fetch(url, part_path)
+
+        if response.status_code == 404:
+            # missing page, says nothing about the health of the host
+            self.mirrors.cancelled(host)
         else:
-            filename = base_filename + extension
+            self.mirrors.record(host, latency, ok=response.status_code in SUCCESS_STATUS)
+        return response, part_path
 
-        try:
-            response = await async_request('GET', url, timeout=self.timeout, proxy=proxy)
-
-            if response.status_code != 200:
-                path = urlparse(url).path
-                for mirror in constant.IMAGE_URL_MIRRORS:
-                    # Silently try mirrors - progress bar shows overall status
-                    mirror_url = f'{mirror}{path}'
-                    response = await async_request('GET', mirror_url, timeout=self.timeout, proxy=proxy)
-                    if response.status_code == 200:
-                        break
-                else:
-                    # If loop completes without break, all mirrors failed
-                    logger.error(f'All mirrors failed for {filename}')
-                    return -1, url
+    async def write_part(self, response, part_path, offset, reservation=None):
+        if response.status_code == 206:
+            start, total = parse_content_range(response.headers.get('content-range'))
+            if start != offset:
+                remove_quietly(part_path)
+                raise IncompleteDownloadError(f'asked for byte {offset}, got a range starting at {start}')
+            mode = 'ab'
+        else:
+            # the host ignored the Range header and sent the whole page
+            length = response.headers.get('content-length')
+            total = int(length) if length and length.isdigit() else None
+            mode = 'wb'
 
-            # Validate response before saving
-            if response.status_code != 200:
-                logger.error(f'Failed to download {filename}: HTTP {response.status_code}')
-                return -1, url
+        async with aiofiles.open(part_path, mode) as f:
+            async for chunk in response.aiter_bytes(CHUNK_SIZE):
+                raise_if_stop_requested()
+                await f.write(chunk)
+                rate_limiter.consumed(IMAGE, len(chunk), reservation)
+                self.received_bytes += len(chunk)
 
-            if not await self.save(filename, response):
-                logger.error(f'Failed to save {filename}')
-                return -2, url
+        size = os.path.getsize(part_path)
+        if total is not None and size != total:
+            if size > total:
+                remove_quietly(part_path)
+            raise IncompleteDownloadError(f'received {size} of {total} bytes')
 
-        except KeyboardInterrupt:
-            logger.info('Download interrupted by user')
-            if constant.STOP_REQUESTED:
-                raise
-            return -4, url
-
-        except (httpx.HTTPStatusError, httpx.TimeoutException, httpx.ConnectError):
-            if retried < constant.RETRY_TIMES:
-                # Silently retry - progress bar shows overall status
-                return await self.download(
-                    url=url,
-                    folder=folder,
-                    filename=filename,
-                    retried=retried + 1,
-                    proxy=proxy,
-                )
+    async def fetch_from_mirrors(self, path, part_path, hedge_path):
+        hosts = self.mirrors.route()
+        result = None
+        while hosts:
+            host = hosts.pop(0)
+            if self.hedge is not None and hosts:
+                result = await self.hedged_fetch(path, part_path, hedge_path, host, hosts)
             else:
-                # Only log when all retries exhausted
-                logger.warning(f'Failed to download {filename} after {constant.RETRY_TIMES} retries')
-                return -2, url
+                result = await self.fetch(f'{host}{path}', part_path)
 
-        except Exception as e:
-            logger.error(f"Unexpected error: {type(e).__name__}: {e}")
-            if os.getenv('DEBUG'):
-                import traceback
-                logger.debug(traceback.format_exc())
-            return -9, url
+            if result[0].status_code in SUCCESS_STATUS:
+                break
 
-        return 1, url
+        return result
 
-    async def save(self, filename, response) -> bool:
-        if response is None:
-            logger.error('Error: Response is None')
-            return False
-        filename, content = prepare_image_payload(filename, response, self.webp)
-        save_file_path = os.path.join(self.folder, filename)
-        async with aiofiles.open(save_file_path, 'wb') as f:
-            await f.write(content)
-        return True
+    async def hedged_fetch(self, path, part_path, hedge_path, host, alternatives):
+        """
+        Fetch ``path`` from ``host``, and if it is still pending after the hedge delay, race a
+        duplicate request against the next best mirror. The first 200 wins, the other is cancelled.
+        """
+        delay = self.hedge.delay(self.mirrors.latencies)
+        primary = asyncio.ensure_future(self.fetch(f'{host}{path}', part_path))
+        pending = {primary}
+        try:
+            if delay is None or delay >= self.timeout:
+                return await primary
 
-    def create_storage_object(self, folder: str):
-        if not os.path.exists(folder):
+            done, _ = await asyncio.wait(pending, timeout=delay)
+            if done or not self.hedge.spend():
+                return await primary
+
+            # the duplicate streams into its own part file
+            backup = asyncio.ensure_future(self.fetch(f'{alternatives.pop(0)}{path}', hedge_path))
+            pending.add(backup)
+
+            result = error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                        continue
+
+                    result = task.result()
+                    if result[0].status_code in SUCCESS_STATUS:
+                        if task is backup:
+                            self.hedge.wins += 1
+                        return result
+
+            if result is None:
+                raise error
+            return result
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.wait(pending)
+
+    async def download(self, url, gallery, filename=''):
+        # Suppress verbose logging during downloads - progress bar shows status
+        filename = self.pad_filename(filename if filename else os.path.basename(urlparse(url).path),
+                                     gallery.digit_length)
+        result = await self.download_page(url, gallery, filename)
+        if result[0] <= 0:
+            # an archive does not wait for this page before writing the ones after it
+            gallery.storage.discard(os.path.splitext(filename)[0])
+        else:
+            self.pages_saved += 1
+        return result
+
+    async def download_page(self, url, gallery, filename):
+        # pages land in a hidden part file first and are renamed once complete
+        base_filename = os.path.splitext(filename)[0]
+        part_path = os.path.join(gallery.storage.part_folder, f'.{base_filename}{PART_SUFFIX}')
+        hedge_path = os.path.join(gallery.storage.part_folder, f'.{base_filename}.hedge{PART_SUFFIX}')
+        retry = retry_policy.start(IMAGE)
+        while True:
+            retry_after = None
             try:
-                os.makedirs(folder)
-            except EnvironmentError as e:
-                logger.critical(str(e))
-        self.folder: str = folder
-        self.close = lambda: None  # Only available in class CompressedDownloader
+                # the concurrency slot is only held while requesting, not while backing off
+                async with self.limiter:
+                    # Silently try mirrors, healthiest first - progress bar shows overall status
+                    response, done_path = await self.fetch_from_mirrors(urlparse(url).path, part_path, hedge_path)
+                    if response.status_code in SUCCESS_STATUS:
+                        if not await gallery.storage.save(filename, response, done_path):
+                            logger.error(f'Failed to save {filename}')
+                            return -2, url
+
+                        # whichever request lost a hedge race leaves a stale part file behind
+                        remove_quietly(part_path)
+                        remove_quietly(hedge_path)
+                        return 1, url
+
+                error_class = classify(status=response.status_code)
+                if error_class is None:
+                    logger.error(f'All mirrors failed for {filename}: HTTP {response.status_code}')
+                    remove_quietly(part_path)
+                    return -1, url
+                retry_after = response.headers.get('retry-after')
+                error = f'HTTP {response.status_code}'
+
+            except KeyboardInterrupt:
+                logger.info('Download interrupted by user')
+                if constant.STOP_REQUESTED:
+                    raise
+                return -4, url
+
+            except (httpx.HTTPStatusError, httpx.TransportError, IncompleteDownloadError) as e:
+                error_class, error = classify(e), f'{type(e).__name__}: {e}'
 
-    def start_download(self, queue, folder='') -> bool:
+            except Exception as e:
+                logger.error(f"Unexpected error: {type(e).__name__}: {e}")
+                if os.getenv('DEBUG'):
+                    import traceback
+                    logger.debug(traceback.format_exc())
+                return -9, url
+
+            delay = retry.backoff(error_class, retry_after)
+            if delay is None:
+                # Only log when all retries exhausted
+                logger.warning(f'Failed to download {filename} after {retry.attempts} retries ({error})')
+                return -2, url
+            # Silently retry - progress bar shows overall status
+            await async_sleep(delay)
+
+    def pad_filename(self, filename, length):
+        base_filename, extension = os.path.splitext(filename)
+        if not self.no_filename_padding:
+            return base_filename.zfill(length) + extension
+        return base_filename + extension
+
+    def create_storage_object(self, folder, doujinshi=None):
+        return DirectoryStorage(folder, converter=self.converter, pdf=f'{folder}.pdf' if self.pdf else None)
+
+    def open_gallery(self, queue, folder='', name=None, doujinshi=None):
+        """
+        Prepare the storage of one doujinshi and work out which of its pages still have to be
+        downloaded, so that its pages can be queued next to those of other doujinshi.
+        """
         if not isinstance(folder, (str,)):
             folder = str(folder)
 
@@ -280,55 +594,436 @@ class Downloader(Singleton):
             folder = os.path.join(self.path, folder)
 
         logger.log(16, f'Saving to: {folder}')
-        self.create_storage_object(folder)
-
-        # Fix for incomplete downloads
-        self.semaphore = None
-        if hasattr(self, 'zip_lock'):
-            self.zip_lock = None
+        storage = self.create_storage_object(folder, doujinshi)
+        digit_length = len(str(len(queue)))
 
         if os.getenv('DEBUG', None) == 'NODOWNLOAD':
             # Assuming we want to continue with rest of process.
-            return True
+            return Gallery(name or folder, storage, [], digit_length)
 
-        digit_length = len(str(len(queue)))
         logger.log(16, f'Total pages: {len(queue)}')
-        coroutines = [
-            self._semaphore_download(url, filename=os.path.basename(urlparse(url).path), length=digit_length)
-            for url in queue
-        ]
 
-        # Prevent coroutines infection
-        asyncio.run(self.fiber(coroutines))
+        # pages finished by an earlier run are skipped as long as the stored file still matches
+        pending = []
+        for url in queue:
+            filename = os.path.basename(urlparse(url).path)
+            page = os.path.splitext(self.pad_filename(filename, digit_length))[0]
+            if not storage.manifest.is_complete(page, storage.stored_digest):
+                pending.append((url, filename))
+
+        if len(pending) < len(queue):
+            logger.info(f'{len(queue) - len(pending)} pages already downloaded, {len(pending)} left')
+
+        storage.expect([os.path.splitext(self.pad_filename(filename, digit_length))[0] for _, filename in pending])
 
-        self.close()
+        return Gallery(name or folder, storage, pending, digit_length, total=len(queue))
+
+    def start_download(self, queue, folder='', doujinshi=None) -> bool:
+        gallery = self.open_gallery(queue, folder, doujinshi=doujinshi)
+        coroutines = [self.download(url, gallery, filename=filename) for url, filename in gallery.pending]
+
+        try:
+            if coroutines:
+                self.run(self.fiber(coroutines))
+        finally:
+            gallery.storage.close()
 
         return True
 
 
 class CompressedDownloader(Downloader):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.zip_lock = None  # Will be initialized in async context
+    def create_storage_object(self, folder, doujinshi=None):
+        return ArchiveStorage(folder, converter=self.converter, compression=self.zip_compression)
 
-    def create_storage_object(self, folder):
-        filename = f'{folder}.zip'
-        logger.debug(f'Creating ZIP file: {filename}')
-        self.zipfile = zipfile.ZipFile(filename, 'w')
-        self.close = lambda: self.zipfile.close()
 
-    async def save(self, filename, response) -> bool:
+class CbzDownloader(Downloader):
+    def create_storage_object(self, folder, doujinshi=None):
+        return CbzStorage(folder, doujinshi, converter=self.converter, compression=self.zip_compression)
+
+
+class Gallery(object):
+    """ One doujinshi in a download: where its pages are stored and how many are left. """
+
+    def __init__(self, name, storage, pending, digit_length, total=None):
+        self.name = name
+        self.storage = storage
+        self.pending = pending
+        self.digit_length = digit_length
+        self.total = len(pending) if total is None else total
+        self.done = self.total - len(pending)
+        self.failed = 0
+
+    @property
+    def finished(self):
+        return self.done + self.failed >= self.total
+
+    def page_done(self, ok):
+        if ok:
+            self.done += 1
+        else:
+            self.failed += 1
+
+
+class DirectoryStorage(object):
+    """
+    Pages saved as image files in the doujinshi folder. With ``pdf``, the stored pages are also
+    added to that PDF file in page order while the rest of the doujinshi is downloading.
+    """
+
+    def __init__(self, folder, converter=None, pdf=None):
+        if not os.path.exists(folder):
+            try:
+                os.makedirs(folder)
+            except EnvironmentError as e:
+                logger.critical(str(e))
+        self.folder = folder
+        self.part_folder = folder
+        self.converter = converter
+        self.manifest = PageManifest(directory_manifest_path(folder))
+        self.missing = None  # pages not stored yet, known once they are expected
+        self.generated = []  # documents finished along with the download, e.g. 'pdf'
+        self.pdf = None
+        if pdf is not None:
+            self.pdf = PdfStreamer(pdf)
+            self.pdf.start()
+
+    async def save(self, filename, response, part_path) -> bool:
         if response is None:
             logger.error('Error: Response is None')
             return False
+        page = os.path.splitext(filename)[0]
+        filename = await prepare_image_file(filename, part_path, response.headers.get('content-type'), self.converter)
+        # hashing the page and writing the manifest stay off the event loop
+        path = await asyncio.get_running_loop().run_in_executor(None, self.store, page, filename, part_path)
+        if self.missing is not None:
+            self.missing.discard(page)
+        if self.pdf is not None:
+            self.pdf.queue.put(('page', (page, path)))
+        return True
+
+    def store(self, page, filename, part_path):
+        size, sha1 = os.path.getsize(part_path), file_digest(part_path)
+        path = os.path.join(self.folder, filename)
+        os.replace(part_path, path)
+        self.manifest.record(page, filename, size, sha1)
+        return path
+
+    def stored_digest(self, filename, size):
+        path = os.path.join(self.folder, filename)
+        if not os.path.isfile(path):
+            return None
+        actual_size = os.path.getsize(path)
+        if actual_size != size:
+            return actual_size, None
+        return actual_size, file_digest(path)
+
+    def expect(self, pages):
+        self.missing = set(pages)
+        if self.pdf is None:
+            return
+        # pages stored by an earlier run go into the PDF as well
+        stored = {page: entry['filename'] for page, entry in self.manifest.pages.items()}
+        self.pdf.queue.put(('expect', sorted(set(pages) | set(stored), key=page_order)))
+        for page, filename in stored.items():
+            self.pdf.queue.put(('page', (page, os.path.join(self.folder, filename))))
+
+    def discard(self, page):
+        if self.pdf is not None:
+            self.pdf.queue.put(('discard', page))
+
+    def close(self):
+        if self.missing is not None and not self.missing and not constant.STOP_REQUESTED:
+            # every page is stored, nothing is left to resume
+            self.manifest.clear()
+        else:
+            self.manifest.close()
+
+        if self.pdf is None or not self.pdf.is_alive():
+            return
+        self.pdf.queue.put(None)
+        self.pdf.join()
+        if self.pdf.document is not None:
+            self.generated.append('pdf')
+            logger.log(16, f'PDF file has been written to "{self.pdf.document}"')
+
+
+class OrderedWriter(threading.Thread, metaclass=abc.ABCMeta):
+    """
+    Takes finished pages off ``queue`` on a single thread and hands them to ``write`` in the order
+    passed to ``expect``, whatever order they finish downloading in: a page that arrives early
+    waits until every page before it was written or discarded. Subclasses implement ``write``.
+    """
+
+    def __init__(self, name):
+        super().__init__(name=name, daemon=True)
+        self.queue = queue.Queue()
+        self.written = None  # called once a queued page was taken care of
+        self.order = []
+        self.expected = set()
+        self.position = 0
+        self.waiting = {}
+        self.discarded = set()
+        self.errors = 0
+
+    def run(self):
+        while True:
+            message = self.queue.get()
+            if message is None:
+                break
+
+            kind, value = message
+            if kind == 'expect':
+                self.order, self.expected = value, set(value)
+            elif kind == 'discard':
+                self.discarded.add(value)
+            else:
+                self.waiting[value[0]] = value
+            self.flush()
+
+            if kind == 'page' and self.written is not None:
+                try:
+                    self.written()
+                except RuntimeError:
+                    # the event loop is already closed, nobody is waiting for a slot
+                    pass
+
+        self.finish()
+
+    @property
+    def complete(self):
+        """ Every expected page was written, only meaningful once the thread has stopped. """
+        return self.position >= len(self.order) and not self.discarded and not self.errors
+
+    def flush(self):
+        for page in [page for page in self.waiting if page not in self.expected]:
+            self.write(*self.waiting.pop(page))
+
+        while self.position < len(self.order):
+            page = self.order[self.position]
+            if page in self.waiting:
+                self.write(*self.waiting.pop(page))
+            elif page not in self.discarded:
+                break
+            self.position += 1
+
+    @abc.abstractmethod
+    def write(self, page, *args):
+        """ Store ``page``, the arguments are the rest of its 'page' message. """
+
+    def finish(self):
+        pass
+
 
-        # Initialize lock in async context if needed
-        if self.zip_lock is None:
-            self.zip_lock = asyncio.Lock()
+class ZipWriter(OrderedWriter):
+    """
+    Adds pages to an open zip file from a single thread, so compressing and writing never runs
+    on the event loop. A page that arrives ahead of its turn waits on disk.
+    """
 
-        filename, content = prepare_image_payload(filename, response, self.webp)
-        # Acquire lock before writing to zipfile to prevent race conditions
-        async with self.zip_lock:
-            self.zipfile.writestr(filename, content)
+    def __init__(self, archive, manifest, compression=zipfile.ZIP_STORED):
+        super().__init__('zip-writer')
+        self.archive = archive
+        self.manifest = manifest
+        self.compression = compression
 
+    def finish(self):
+        # pages still waiting, e.g. after an interrupt, are kept in order as well
+        for page in sorted(self.waiting, key=page_order):
+            self.write(*self.waiting.pop(page))
+
+    def write(self, page, filename, path, size, sha1):
+        try:
+            self.archive.write(path, filename, compress_type=self.compression)
+        except (OSError, ValueError, zipfile.BadZipFile) as e:
+            self.errors += 1
+            logger.error(f'Failed to add {filename} to {self.archive.filename}: {e}')
+            return
+        finally:
+            remove_quietly(path)
+        self.manifest.record(page, filename, size, sha1)
+
+
+class PdfStreamer(OrderedWriter):
+    """
+    Adds stored pages to a PDF while the doujinshi is downloading, so it is done with the last
+    page. The PDF is only renamed into place when every expected page made it into it.
+    """
+
+    def __init__(self, filename):
+        super().__init__('pdf-writer')
+        self.writer = PdfWriter(filename)
+        self.document = None
+
+    def write(self, page, path):
+        if self.errors or constant.STOP_REQUESTED:
+            return
+        try:
+            self.writer.add_image(path)
+        except (OSError, ValueError) as e:
+            self.errors += 1
+            logger.error(f'Failed to add {os.path.basename(path)} to {self.writer.filename}: {e}')
+
+    def finish(self):
+        if self.complete and self.writer.pages and not constant.STOP_REQUESTED:
+            self.writer.close()
+            self.document = self.writer.filename
+        else:
+            self.writer.abort()
+
+
+class ArchiveStorage(object):
+    """ Pages added to ``{folder}.zip``, which is appended to when an earlier run left it incomplete. """
+
+    def __init__(self, folder, converter=None, compression=zipfile.ZIP_STORED, filename=None):
+        self.filename = filename or f'{folder}.zip'
+        self.converter = converter
+        self.manifest = PageManifest(archive_manifest_path(self.filename))
+        self.generated = []
+        self.archived = {}
+        self.appending = bool(self.manifest.pages and os.path.exists(self.filename)
+                              and self.verify_archive(self.filename))
+        if self.appending:
+            logger.debug(f'Appending to ZIP file: {self.filename}')
+            self.zipfile = zipfile.ZipFile(self.filename, 'a', compression=compression)
+        else:
+            logger.debug(f'Creating ZIP file: {self.filename}')
+            self.manifest.clear()
+            self.zipfile = zipfile.ZipFile(self.filename, 'w', compression=compression)
+        # pages are streamed to disk next to the archive before they are added to it
+        self.part_folder = f'{folder}.parts'
+        os.makedirs(self.part_folder, exist_ok=True)
+
+        self.slots = None  # Will be initialized in async context
+        self.writer = ZipWriter(self.zipfile, self.manifest, compression)
+        self.writer.start()
+
+    def verify_archive(self, filename):
+        """
+        Hash the pages of an archive left by an earlier run. Returns False when it cannot be appended
+        to; pages that are damaged or missing from the manifest are dropped by rewriting the archive.
+        """
+        try:
+            with zipfile.ZipFile(filename, 'r') as archive:
+                for info in archive.infolist():
+                    sha1 = hashlib.sha1()
+                    with archive.open(info) as f:
+                        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                            sha1.update(chunk)
+                    self.archived[info.filename] = (info.file_size, sha1.hexdigest())
+                names = archive.namelist()
+        except (zipfile.BadZipFile, OSError) as e:
+            logger.warning(f'Cannot resume {filename}, starting over: {e}')
+            return False
+
+        valid = {entry['filename'] for page, entry in self.manifest.pages.items()
+                 if self.archived.get(entry['filename']) == (entry['size'], entry['sha1'])}
+        if len(names) == len(set(names)) and set(names) <= valid:
+            return True
+
+        # rebuild with the good pages only, a zip entry cannot be replaced in place
+        temp_filename = f'{filename}.tmp'
+        with zipfile.ZipFile(filename, 'r') as source, zipfile.ZipFile(temp_filename, 'w') as target:
+            for name in sorted(valid & set(names), key=page_order):
+                target.writestr(source.getinfo(name), source.read(name))
+        os.replace(temp_filename, filename)
+        self.archived = {name: digest for name, digest in self.archived.items() if name in valid}
+        return True
+
+    def stored_digest(self, filename, size):
+        return self.archived.get(filename)
+
+    def expect(self, pages):
+        self.writer.queue.put(('expect', pages))
+
+    def discard(self, page):
+        self.writer.queue.put(('discard', page))
+
+    def stop_writer(self):
+        if self.writer.is_alive():
+            self.writer.queue.put(None)
+            self.writer.join()
+
+    def close(self):
+        self.stop_writer()
+        self.zipfile.close()
+        if self.writer.complete:
+            self.manifest.clear()
+        else:
+            self.manifest.close()
+
+        if self.appending:
+            self.sort_entries()
+        try:
+            os.rmdir(self.part_folder)
+        except OSError:
+            pass
+
+    def sort_entries(self):
+        # pages appended on a later run come after the ones already stored, restore the page order
+        with zipfile.ZipFile(self.filename, 'r') as archive:
+            names = archive.namelist()
+        if names == sorted(names, key=page_order):
+            return
+
+        temp_filename = f'{self.filename}.tmp'
+        with zipfile.ZipFile(self.filename, 'r') as source, zipfile.ZipFile(temp_filename, 'w') as target:
+            for name in sorted(names, key=page_order):
+                target.writestr(source.getinfo(name), source.read(name))
+        os.replace(temp_filename, self.filename)
+
+    async def save(self, filename, response, part_path) -> bool:
+        if response is None:
+            logger.error('Error: Response is None')
+            return False
+
+        # Initialize the queue bound in async context, the writer thread hands slots back through the loop
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(ZIP_QUEUE_SIZE)
+            loop = asyncio.get_running_loop()
+            self.writer.written = lambda: loop.call_soon_threadsafe(self.slots.release)
+
+        page = os.path.splitext(filename)[0]
+        filename = await prepare_image_file(filename, part_path, response.headers.get('content-type'), self.converter)
+        # hashing the page stays off the event loop
+        queued_path, size, sha1 = await asyncio.get_running_loop().run_in_executor(None, self.hand_over,
+                                                                                   page, part_path)
+        await self.slots.acquire()
+        self.writer.queue.put(('page', (page, filename, queued_path, size, sha1)))
         return True
+
+    def hand_over(self, page, part_path):
+        size, sha1 = os.path.getsize(part_path), file_digest(part_path)
+        # the writer owns the file from here on, the part file names are reused by retries
+        queued_path = os.path.join(self.part_folder, f'.{page}.queued')
+        os.replace(part_path, queued_path)
+        return queued_path, size, sha1
+
+
+class CbzStorage(ArchiveStorage):
+    """
+    Pages and ComicInfo.xml written straight into ``{folder}.cbz``. The archive is built as
+    ``{folder}.cbz.part`` and only renamed once every page is in it, so a ``.cbz`` is never partial
+    and an interrupted one is resumed like a ``--zip`` archive.
+    """
+
+    def __init__(self, folder, doujinshi=None, converter=None, compression=zipfile.ZIP_STORED):
+        self.target = f'{folder}.cbz'
+        self.comic_info = comic_xml(doujinshi) if doujinshi is not None else None
+        super().__init__(folder, converter, compression, filename=f'{self.target}.part')
+
+    def close(self):
+        if self.zipfile.fp is None:
+            return
+
+        self.stop_writer()
+        complete = self.writer.complete
+        if complete and self.comic_info is not None:
+            self.zipfile.writestr('ComicInfo.xml', self.comic_info, compress_type=self.writer.compression)
+        super().close()
+
+        if not complete:
+            logger.warning(f'{self.target} is missing pages, run again to resume {self.filename}')
+            return
+        os.replace(self.filename, self.target)
+        self.generated.append('cbz')
+        logger.log(16, f'Comic Book CBZ file has been written to "{self.target}"')
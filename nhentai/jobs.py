@@ -0,0 +1,192 @@
+# coding: utf-8
+import sqlite3
+import threading
+import time
+
+from nhentai import constant
+
+
+QUEUED = 'queued'
+METADATA = 'metadata'
+DOWNLOADING = 'downloading'
+POST_PROCESSING = 'post-processing'
+DONE = 'done'
+FAILED = 'failed'
+STATES = (QUEUED, METADATA, DOWNLOADING, POST_PROCESSING, DONE, FAILED)
+FINISHED = (DONE, FAILED)
+LEASE_SECONDS = 60
+
+
+class JobQueue(object):
+    """
+    One row per doujinshi of a batch with the state it reached, how often it was attempted and
+    the last error, kept in the download history database. Every change is committed right away,
+    so a run that dies half way leaves an exact record and the next run only picks up the
+    doujinshi that are not done yet, in the order they were queued.
+
+    Doujinshi in the download history of older versions count as done.
+
+    Worker processes sharing the queue ``claim`` doujinshi under a lease they keep renewing; the
+    lease of a worker that died runs out and its doujinshi are claimed by another one.
+
+    A queue opened for a ``run`` only claims, counts and reports the doujinshi ``requeue`` added to
+    that run, so what other runs left unfinished in the same database is not picked up.
+    """
+
+    def __init__(self, path=None, run=None):
+        self.path = path or constant.NHENTAI_HISTORY
+        self.run = run
+        self.lock = threading.Lock()
+        # metadata and post-processing threads report states through the same connection
+        self.conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+        if self.path != ':memory:':
+            self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS download_history (id text)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY, state TEXT NOT NULL, '
+                          'attempts INTEGER NOT NULL DEFAULT 0, error TEXT, position INTEGER NOT NULL, '
+                          'updated REAL NOT NULL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, position)')
+        columns = {row[1] for row in self.conn.execute('PRAGMA table_info(jobs)')}
+        if 'owner' not in columns:
+            self.conn.execute('ALTER TABLE jobs ADD COLUMN owner TEXT')
+            self.conn.execute('ALTER TABLE jobs ADD COLUMN lease REAL')
+        if 'run' not in columns:
+            self.conn.execute('ALTER TABLE jobs ADD COLUMN run TEXT')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS workers (owner TEXT PRIMARY KEY, pages INTEGER NOT NULL, '
+                          'bytes INTEGER NOT NULL, started REAL NOT NULL, heartbeat REAL NOT NULL)')
+        self.conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    def enqueue(self, doujinshi_ids):
+        """ Add the doujinshi that are not queued yet, returns those of them that are not done. """
+        doujinshi_ids = list(dict.fromkeys(int(i) for i in doujinshi_ids))
+        now = time.time()
+        with self.lock, self.conn:
+            position = self.conn.execute('SELECT COALESCE(MAX(position), 0) FROM jobs').fetchone()[0]
+            self.conn.executemany(
+                'INSERT OR IGNORE INTO jobs (id, state, position, updated) VALUES (?, CASE WHEN EXISTS '
+                '(SELECT 1 FROM download_history WHERE id = CAST(? AS TEXT)) THEN ? ELSE ? END, ?, ?)',
+                [(i, i, DONE, QUEUED, position + n, now) for n, i in enumerate(doujinshi_ids, 1)])
+            done = {row[0] for row in self.conn.execute('SELECT id FROM jobs WHERE state = ?', (DONE,))}
+        return [i for i in doujinshi_ids if i not in done]
+
+    def unfinished(self):
+        """ Every doujinshi that is not done, including failed ones, in the order they were queued. """
+        with self.lock:
+            rows = self.conn.execute('SELECT id FROM jobs WHERE state != ? ORDER BY position', (DONE,))
+            return [row[0] for row in rows]
+
+    @property
+    def scope(self):
+        # parameters of the "(? IS NULL OR run = ?)" condition, true for every row without a run
+        return self.run, self.run
+
+    def pending(self):
+        """ Doujinshi that are neither done nor failed. """
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM jobs WHERE state NOT IN (?, ?) AND (? IS NULL OR run = ?)',
+                                     FINISHED + self.scope).fetchone()[0]
+
+    def requeue(self, doujinshi_ids):
+        """
+        Queue the doujinshi that are not done again, whatever state and lease they were left in,
+        as part of this queue's run.
+        """
+        with self.lock, self.conn:
+            self.conn.executemany('UPDATE jobs SET state = ?, owner = NULL, lease = NULL, run = ? '
+                                  'WHERE id = ? AND state != ?',
+                                  [(QUEUED, self.run, int(i), DONE) for i in doujinshi_ids])
+
+    def claim(self, owner, count=1, lease=LEASE_SECONDS):
+        """
+        Lease up to ``count`` doujinshi to ``owner``, in queue order. Doujinshi left unfinished
+        without a lease or whose lease ran out are claimed again.
+        """
+        now = time.time()
+        with self.lock:
+            # take the write lock first, so two processes never select the same rows
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                ids = [row[0] for row in self.conn.execute(
+                    'SELECT id FROM jobs WHERE state NOT IN (?, ?) AND (lease IS NULL OR lease < ?) '
+                    'AND (? IS NULL OR run = ?) ORDER BY position LIMIT ?', FINISHED + (now,) + self.scope + (count,))]
+                self.conn.executemany('UPDATE jobs SET owner = ?, lease = ? WHERE id = ?',
+                                      [(owner, now + lease, i) for i in ids])
+                self.conn.commit()
+            except BaseException:
+                self.conn.rollback()
+                raise
+        return ids
+
+    def renew(self, owner, lease=LEASE_SECONDS):
+        with self.lock, self.conn:
+            self.conn.execute('UPDATE jobs SET lease = ? WHERE owner = ? AND state NOT IN (?, ?)',
+                              (time.time() + lease, owner) + FINISHED)
+
+    def release(self, owner):
+        """ Hand back what ``owner`` still holds, e.g. once its process died. """
+        with self.lock, self.conn:
+            self.conn.execute('UPDATE jobs SET owner = NULL, lease = NULL WHERE owner = ? AND state NOT IN (?, ?)',
+                              (owner,) + FINISHED)
+
+    def leased(self, exclude=None):
+        """ Unfinished doujinshi under a running lease, of any owner but ``exclude``. """
+        with self.lock:
+            return self.conn.execute(
+                'SELECT COUNT(*) FROM jobs WHERE state NOT IN (?, ?) AND lease >= ? AND owner IS NOT ? '
+                'AND (? IS NULL OR run = ?)', FINISHED + (time.time(), exclude) + self.scope).fetchone()[0]
+
+    def update(self, doujinshi_id, state, error=None):
+        with self.lock, self.conn:
+            self.conn.execute(
+                'UPDATE jobs SET state = ?, error = ?, updated = ?, attempts = attempts + ?, '
+                'lease = CASE WHEN ? IN (?, ?) THEN NULL ELSE lease END WHERE id = ?',
+                (state, error, time.time(), 1 if state == METADATA else 0, state) + FINISHED + (int(doujinshi_id),))
+
+    def get(self, doujinshi_id):
+        with self.lock:
+            row = self.conn.execute('SELECT state, attempts, error FROM jobs WHERE id = ?',
+                                    (int(doujinshi_id),)).fetchone()
+        return None if row is None else dict(zip(('state', 'attempts', 'error'), row))
+
+    def counts(self, since=None):
+        """ Doujinshi per state, only counting those updated after ``since`` if it is given. """
+        with self.lock:
+            rows = self.conn.execute('SELECT state, COUNT(*) FROM jobs WHERE updated >= ? AND (? IS NULL OR run = ?) '
+                                     'GROUP BY state', (since or 0,) + self.scope)
+            counts = dict.fromkeys(STATES, 0)
+            counts.update(rows)
+        return counts
+
+    def failures(self, since=None):
+        with self.lock:
+            return self.conn.execute('SELECT id, error FROM jobs WHERE state = ? AND updated >= ? '
+                                     'AND (? IS NULL OR run = ?) ORDER BY position',
+                                     (FAILED, since or 0) + self.scope).fetchall()
+
+    def report(self, owner, pages, received):
+        """ Pages and bytes a worker downloaded so far, sent along with every lease renewal. """
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute('INSERT INTO workers (owner, pages, bytes, started, heartbeat) VALUES (?, ?, ?, ?, ?) '
+                              'ON CONFLICT (owner) DO UPDATE SET pages = excluded.pages, bytes = excluded.bytes, '
+                              'heartbeat = excluded.heartbeat', (owner, pages, received, now, now))
+
+    def workers(self, since=None):
+        with self.lock:
+            rows = self.conn.execute('SELECT owner, pages, bytes, started, heartbeat FROM workers '
+                                     'WHERE heartbeat >= ? ORDER BY started', (since or 0,))
+            return [dict(zip(('owner', 'pages', 'bytes', 'started', 'heartbeat'), row)) for row in rows]
+
+    def clear(self):
+        with self.lock, self.conn:
+            self.conn.execute('DELETE FROM jobs')
+            self.conn.execute('DELETE FROM workers')
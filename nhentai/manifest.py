@@ -0,0 +1,134 @@
+# coding: utf-8
+import hashlib
+import json
+import os
+import threading
+
+from nhentai.logger import logger
+
+
+MANIFEST_NAME = '.manifest.json'
+
+
+def file_digest(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def directory_manifest_path(folder):
+    return os.path.join(folder, MANIFEST_NAME)
+
+
+def archive_manifest_path(archive):
+    # next to the archive rather than inside it, so it can be updated without rewriting the zip
+    directory, name = os.path.split(archive)
+    return os.path.join(directory, f'.{name}{MANIFEST_NAME}')
+
+
+class PageManifest(object):
+    """
+    Completed pages of one doujinshi, keyed by page name (e.g. ``001``), with the file they
+    were stored as, its size and SHA-1. A re-run only queues pages that are not in the manifest
+    or whose stored file no longer matches it.
+
+    Every recorded page is one JSON line appended to the file, later lines win over earlier ones
+    and a line torn by a crash is skipped. The file is only rewritten to drop such lines when it
+    is opened again. Storages delete it once every page of the doujinshi is stored.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.pages = {}
+        self.lock = threading.Lock()
+        self.file = None
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+
+        lines = 0
+        try:
+            with open(self.path, 'r') as f:
+                for line in f:
+                    lines += 1
+                    try:
+                        entry = json.loads(line)
+                        self.pages[entry.pop('page')] = entry
+                    except (ValueError, KeyError, TypeError, AttributeError):
+                        continue
+        except OSError as e:
+            logger.warning(f'Ignoring unreadable page manifest {self.path}: {e}')
+            self.pages = {}
+            return
+
+        if lines > len(self.pages):
+            # replaced entries and torn lines
+            self.save()
+
+    def save(self):
+        temp_path = f'{self.path}.tmp'
+        with self.lock:
+            self.close_file()
+            try:
+                with open(temp_path, 'w') as f:
+                    for page, entry in self.pages.items():
+                        f.write(self.line(page, entry))
+                os.replace(temp_path, self.path)
+            except OSError as e:
+                logger.warning(f'Failed to write page manifest: {e}')
+
+    @staticmethod
+    def line(page, entry):
+        return json.dumps(dict(page=page, **entry), separators=(',', ':')) + '\n'
+
+    def record(self, page, filename, size, sha1):
+        entry = {'filename': filename, 'size': size, 'sha1': sha1}
+        with self.lock:
+            self.pages[page] = entry
+            try:
+                if self.file is None:
+                    self.file = open(self.path, 'a')
+                self.file.write(self.line(page, entry))
+                # flushed to the OS, not synced: a crash loses a page or two that are downloaded again
+                self.file.flush()
+            except OSError as e:
+                logger.warning(f'Failed to write page manifest: {e}')
+
+    def is_complete(self, page, digest):
+        """
+        ``digest(filename, size)`` returns the (size, sha1) of a stored page, or None when it is
+        missing. It may skip hashing when the size already differs from the expected one.
+        """
+        entry = self.pages.get(page)
+        if not entry:
+            return False
+
+        stored = digest(entry['filename'], entry['size'])
+        if stored != (entry['size'], entry['sha1']):
+            del self.pages[page]
+            return False
+        return True
+
+    def close(self):
+        with self.lock:
+            self.close_file()
+
+    def close_file(self):
+        if self.file is None:
+            return
+        try:
+            self.file.close()
+        except OSError as e:
+            logger.warning(f'Failed to write page manifest: {e}')
+        self.file = None
+
+    def clear(self):
+        with self.lock:
+            self.close_file()
+            self.pages = {}
+            if os.path.exists(self.path):
+                os.remove(self.path)
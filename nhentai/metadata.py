@@ -0,0 +1,190 @@
+# coding: utf-8
+import abc
+import datetime
+import threading
+import time
+
+import nhentai.constant as constant
+from nhentai.doujinshi import EXT_MAP
+from nhentai.logger import logger
+from nhentai.parser import doujinshi_parser
+from nhentai.utils import request
+
+
+AUTO = 'auto'
+# how long a backend that stopped answering is passed over before it is asked again
+REPROBE_SECONDS = 600
+# tag types of the API and the doujinshi fields the gallery page lists them in
+TAG_FIELDS = {
+    'parody': 'parodies',
+    'character': 'characters',
+    'tag': 'tags',
+    'artist': 'artists',
+    'group': 'groups',
+    'language': 'languages',
+    'category': 'categories',
+}
+
+
+class BackendUnavailable(Exception):
+    """ The backend cannot serve any gallery, as opposed to not finding one. """
+
+
+class MetadataBackend(metaclass=abc.ABCMeta):
+    """ A source of gallery metadata, ``fetch`` returns the doujinshi dict of doujinshi_parser or None. """
+    name = None
+
+    @abc.abstractmethod
+    def fetch(self, doujinshi_id):
+        """ Raises BackendUnavailable when the backend cannot serve any gallery. """
+
+
+class HtmlBackend(MetadataBackend):
+    """ Scrapes the gallery page, see doujinshi_parser. """
+    name = 'html'
+
+    def fetch(self, doujinshi_id):
+        return doujinshi_parser(doujinshi_id)
+
+
+class ApiBackend(MetadataBackend):
+    """
+    Reads the JSON gallery API, a response a tenth of the size of the gallery page with the media
+    id and the type of every page in it. Anything but a JSON answer means the API is unavailable.
+    """
+    name = 'api'
+
+    def fetch(self, doujinshi_id):
+        doujinshi_id = int(doujinshi_id)
+        logger.info(f'Fetching doujinshi information of id {doujinshi_id}')
+        try:
+            # throttled and failed requests were already retried with backoff by request()
+            response = request('get', f'{constant.API_DETAIL_URL}/{doujinshi_id}')
+        except KeyboardInterrupt:
+            raise
+        except Exception as e:
+            raise BackendUnavailable(f'Error: {e}')
+
+        try:
+            gallery = response.json()
+        except ValueError:
+            gallery = None
+        if not isinstance(gallery, dict):
+            raise BackendUnavailable(f'HTTP {response.status_code} without a JSON gallery')
+        if response.status_code == 404:
+            logger.error(f'Doujinshi with id {doujinshi_id} cannot be found (404)')
+            return None
+        if response.status_code != 200:
+            raise BackendUnavailable(f'HTTP {response.status_code}')
+        return parse_gallery(doujinshi_id, gallery)
+
+
+def parse_gallery(doujinshi_id, gallery):
+    """ The doujinshi dict of a gallery API response, with the fields parse_doujinshi_page reads from the page. """
+    try:
+        title = gallery.get('title') or {}
+        pages = gallery['images']['pages']
+        doujinshi = {
+            'id': doujinshi_id,
+            'name': title.get('english') or title.get('pretty') or '',
+            'pretty_name': title.get('pretty') or '',
+            'subtitle': title.get('japanese') or '',
+            'favorite_counts': int(gallery.get('num_favorites') or 0),
+            'img_id': str(gallery['media_id']),
+            'ext': [EXT_MAP.get(page.get('t'), 'jpg') for page in pages],
+            'pages': int(gallery.get('num_pages') or len(pages)),
+        }
+
+        fields = {field: [] for field in TAG_FIELDS.values()}
+        for tag in gallery.get('tags') or []:
+            if tag.get('type') in TAG_FIELDS:
+                fields[TAG_FIELDS[tag['type']]].append(tag['name'].strip())
+        for field, names in fields.items():
+            doujinshi[field] = ', '.join(names)
+
+        if gallery.get('upload_date'):
+            doujinshi['date'] = datetime.datetime.fromtimestamp(int(gallery['upload_date']),
+                                                                datetime.timezone.utc).isoformat()
+    except (KeyError, TypeError, ValueError, AttributeError) as e:
+        raise BackendUnavailable(f'unexpected gallery format ({type(e).__name__}: {e})')
+    return doujinshi
+
+
+class MetadataSource(object):
+    """
+    The metadata backend of the run. With ``auto`` the JSON API is used while it answers, and the
+    first time it does not the run falls back to scraping the gallery pages. The API is asked
+    again every ``reprobe`` seconds, so a long running daemon goes back to it once it recovers.
+    With a MetadataCache only galleries missing from it are fetched.
+    """
+
+    def __init__(self, reprobe=REPROBE_SECONDS):
+        self.backends = {backend.name: backend for backend in (ApiBackend(), HtmlBackend())}
+        self.reprobe = reprobe
+        self.lock = threading.Lock()
+        self.cache = None
+        self.configure()
+
+    def configure(self, choice=AUTO, cache=None):
+        if choice != AUTO and choice not in self.backends:
+            raise ValueError(f'Unknown metadata backend "{choice}"')
+        self.choice = choice
+        # backend name -> when it last failed
+        self.unavailable = {}
+        self.close()
+        self.cache = cache
+
+    def close(self):
+        if self.cache is not None:
+            self.cache.close()
+            self.cache = None
+
+    def available(self):
+        """ Names of the backends to ask for a gallery, in order. """
+        if self.choice != AUTO:
+            return [self.choice]
+        now = time.monotonic()
+        return [name for name in self.backends if now - self.unavailable.get(name, -self.reprobe) >= self.reprobe]
+
+    @property
+    def current(self):
+        """ Name of the backend the next gallery is asked from. """
+        return next(iter(self.available()), None)
+
+    def fetch(self, doujinshi_id):
+        doujinshi = self.cache.get(doujinshi_id) if self.cache is not None else None
+        if doujinshi is not None:
+            logger.info(f'Using cached information of doujinshi {doujinshi_id}')
+            return doujinshi
+
+        doujinshi = self.fetch_backend(doujinshi_id)
+        if doujinshi is not None and self.cache is not None:
+            self.cache.put(doujinshi_id, doujinshi)
+        return doujinshi
+
+    def fetch_backend(self, doujinshi_id):
+        for name in self.available():
+            backend = self.backends[name]
+            try:
+                doujinshi = backend.fetch(doujinshi_id)
+            except BackendUnavailable as e:
+                if self.choice != AUTO:
+                    logger.error(f'The {backend.name} metadata backend is unavailable: {e}')
+                    return None
+
+                with self.lock:
+                    if backend.name not in self.unavailable:
+                        logger.warning(f'The {backend.name} metadata backend is unavailable: {e}, '
+                                       f'using the next one for {self.reprobe:.0f}s')
+                    self.unavailable[backend.name] = time.monotonic()
+                continue
+
+            if backend.name in self.unavailable:
+                with self.lock:
+                    if self.unavailable.pop(backend.name, None) is not None:
+                        logger.info(f'The {backend.name} metadata backend answers again')
+            return doujinshi
+        return None
+
+
+metadata_source = MetadataSource()
@@ -0,0 +1,163 @@
+# coding: utf-8
+import json
+import os
+import time
+
+from collections import deque
+
+from urllib.parse import urlparse
+
+from nhentai import constant
+from nhentai.logger import logger
+
+
+DEFAULT_LATENCY = 1.0
+# weight of the newest sample in the latency moving average
+LATENCY_ALPHA = 0.3
+# persisted counters are capped so old runs cannot outvote the current one
+MAX_PERSISTED_SAMPLES = 20
+# successful request latencies kept for percentile estimates
+LATENCY_WINDOW = 200
+
+
+def origin_of(url):
+    parsed = urlparse(url)
+    return f'{parsed.scheme}://{parsed.netloc}'
+
+
+def image_hosts():
+    return [origin_of(constant.IMAGE_URL)] + [origin_of(mirror) for mirror in constant.IMAGE_URL_MIRRORS]
+
+
+class MirrorStats(object):
+    def __init__(self, host, successes=0, failures=0, latency=None):
+        self.host = host
+        self.successes = successes
+        self.failures = failures
+        self.latency = latency
+        self.consecutive_failures = 0
+        self.in_flight = 0
+        self.blocked_until = 0.0
+        self.cooldown = 0.0
+
+    @property
+    def success_rate(self):
+        # Laplace smoothing, an unknown host starts at 50% rather than 0% or 100%
+        return (self.successes + 1) / (self.successes + self.failures + 2)
+
+    def is_blocked(self, now):
+        return now < self.blocked_until
+
+    def to_dict(self):
+        return {
+            'successes': min(self.successes, MAX_PERSISTED_SAMPLES),
+            'failures': min(self.failures, MAX_PERSISTED_SAMPLES),
+            'latency': self.latency,
+        }
+
+
+class MirrorScoreboard(object):
+    """
+    Per-run health of every image host (i1 ... i7).
+
+    Pages are routed to the host with the lowest expected cost, i.e. latency divided by success
+    rate, inflated by the requests already in flight to that host so load spreads across the
+    healthy ones. A host failing ``failure_threshold`` times in a row is taken out of rotation
+    for a cooldown that doubles on every relapse, then gets a single probe request.
+    """
+
+    def __init__(self, hosts=None, path=None, failure_threshold=3, cooldown=30.0, max_cooldown=600.0):
+        self.hosts = hosts or image_hosts()
+        self.path = path
+        self.failure_threshold = failure_threshold
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.stats = {host: MirrorStats(host) for host in self.hosts}
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+
+        if self.path:
+            self.load()
+
+    def cost(self, stats):
+        known = [s.latency for s in self.stats.values() if s.latency is not None]
+        latency = stats.latency
+        if latency is None:
+            # optimistic prior so that unknown hosts get explored
+            latency = min(known) if known else DEFAULT_LATENCY
+        return latency * (1 + stats.in_flight) / stats.success_rate
+
+    def route(self):
+        """ Return the hosts to try for a page, best candidate first. Hosts in cooldown are left out. """
+        now = time.monotonic()
+        hosts = [host for host in self.hosts if not self.stats[host].is_blocked(now)] or self.hosts
+        order = {host: index for index, host in enumerate(self.hosts)}
+        return sorted(hosts, key=lambda host: (self.cost(self.stats[host]), order[host]))
+
+    def started(self, host):
+        self.stats[host].in_flight += 1
+
+    def record(self, host, latency, ok):
+        stats = self.stats[host]
+        stats.in_flight = max(0, stats.in_flight - 1)
+
+        if ok:
+            stats.successes += 1
+            stats.consecutive_failures = 0
+            stats.cooldown = 0.0
+            stats.blocked_until = 0.0
+            self.latencies.append(latency)
+            if stats.latency is None:
+                stats.latency = latency
+            else:
+                stats.latency = LATENCY_ALPHA * latency + (1 - LATENCY_ALPHA) * stats.latency
+            return
+
+        stats.failures += 1
+        stats.consecutive_failures += 1
+        if stats.consecutive_failures >= self.failure_threshold:
+            stats.cooldown = min(self.max_cooldown, stats.cooldown * 2 or self.base_cooldown)
+            stats.blocked_until = time.monotonic() + stats.cooldown
+            # leave room for exactly one probe once the cooldown expires
+            stats.consecutive_failures = self.failure_threshold - 1
+            logger.debug(f'Image host {host} is failing, skipped for {stats.cooldown:.0f}s')
+
+    def cancelled(self, host):
+        stats = self.stats[host]
+        stats.in_flight = max(0, stats.in_flight - 1)
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f'Failed to load mirror stats: {e}')
+            return
+
+        for host, values in data.items():
+            if host in self.stats and isinstance(values, dict):
+                self.stats[host] = MirrorStats(host, values.get('successes', 0), values.get('failures', 0),
+                                               values.get('latency'))
+
+    def save(self):
+        if not self.path:
+            return
+
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, 'w') as f:
+                json.dump({host: stats.to_dict() for host, stats in self.stats.items()}, f)
+        except OSError as e:
+            logger.warning(f'Failed to save mirror stats: {e}')
+
+    def __str__(self):
+        rows = []
+        for host in self.hosts:
+            stats = self.stats[host]
+            if not stats.successes and not stats.failures:
+                continue
+            latency = f'{stats.latency * 1000:.0f}ms' if stats.latency is not None else '-'
+            rows.append(f'{urlparse(host).netloc} {stats.successes}/{stats.successes + stats.failures} ok, {latency}')
+        return '; '.join(rows) if rows else 'no requests'
@@ -2,13 +2,15 @@
 import sys
 import os
 import re
-import time
 from bs4 import BeautifulSoup
 from tabulate import tabulate
 
 import nhentai.constant as constant
 from nhentai.utils import request
+from nhentai.extract import scan_gallery_page
 from nhentai.logger import logger
+from nhentai.ratelimit import METADATA
+from nhentai.retry import retry_policy, classify, sleep, MALFORMED
 
 
 def _get_csrf_token(content):
@@ -108,42 +110,42 @@ def favorites_parser(page=None):
     for page in page_range_list:
         logger.info(f'Getting doujinshi ids of page {page}')
 
-        i = 0
-        while i <= constant.RETRY_TIMES + 1:
-            i += 1
-            if i > 3:
-                logger.error(f'Failed to get favorites at page {page} after 3 times retried, skipped')
-                break
-
+        retry = retry_policy.start(METADATA)
+        while True:
             try:
                 resp = request('get', f'{constant.FAV_URL}?page={page}').content
                 temp_result = _get_title_and_id(resp)
-                if not temp_result:
-                    logger.warning(f'Failed to get favorites at page {page}, retrying ({i} times) ...')
-                    continue
-                else:
+                if temp_result:
                     result.extend(temp_result)
                     break
+                error_class, reason = MALFORMED, 'no doujinshi in page'
 
             except Exception as e:
                 if isinstance(e, (KeyboardInterrupt, SystemExit)):
                     raise
-                logger.warning(f'Error: {e}, retrying ({i} times) ...')
+                # network errors were already retried by request(), only a bad page is worth another try
+                error_class, reason = (None if classify(e) else MALFORMED), f'Error: {e}'
+
+            delay = retry.backoff(error_class)
+            if delay is None:
+                logger.error(f'Failed to get favorites at page {page} after {retry.attempts} retries, skipped')
+                break
+            logger.warning(f'{reason}, retrying favorites page {page} in {delay:.1f}s ...')
+            sleep(delay)
 
     return result
 
 
-def doujinshi_parser(id_, counter=0):
+def doujinshi_parser(id_):
     if not isinstance(id_, (int,)) and (isinstance(id_, (str,)) and not id_.isdigit()):
         raise Exception(f'Doujinshi id({id_}) is not valid')
 
     id_ = int(id_)
     logger.info(f'Fetching doujinshi information of id {id_}')
-    doujinshi = dict()
-    doujinshi['id'] = id_
     url = f'{constant.DETAIL_URL}/{id_}/'
 
     try:
+        # throttled and failed requests were already retried with backoff by request()
         response = request('get', url)
         if response.status_code in (200, ):
             response = response.content
@@ -151,74 +153,62 @@ def doujinshi_parser(id_, counter=0):
             logger.error(f'Doujinshi with id {id_} cannot be found (404)')
             return None
         else:
-            counter += 1
-
-            if counter == 10:
-                logger.critical(f'Failed to fetch doujinshi information of id {id_}')
-                return None
-
-            logger.debug(f'Slow down and retry ({id_}) ...')
-            time.sleep(1)
-            return doujinshi_parser(str(id_), counter)
+            logger.critical(f'Failed to fetch doujinshi information of id {id_} (HTTP {response.status_code})')
+            return None
 
+    except KeyboardInterrupt:
+        raise
     except Exception as e:
         logger.warning(f'Error: {e}, ignored')
         return None
 
-    html = BeautifulSoup(response, 'html.parser')
-    doujinshi_info = html.find('div', attrs={'id': 'info'})
+    return parse_doujinshi_page(id_, response)
+
 
-    if not doujinshi_info:
+def parse_doujinshi_page(id_, content, extract=scan_gallery_page):
+    """ The doujinshi dict of a gallery page, ``extract`` is scan_gallery_page or soup_gallery_page. """
+    page = extract(content)
+    doujinshi = dict()
+    doujinshi['id'] = id_
+
+    if not page.info:
         logger.error(f'Info div not found for doujinshi {id_}')
         return None
 
-    h1_tag = doujinshi_info.find('h1')
-    if not h1_tag:
+    if page.title is None:
         logger.error(f'Title not found for doujinshi {id_}')
         return None
-    title = h1_tag.text
 
-    pretty_span = h1_tag.find('span', attrs={'class': 'pretty'})
-    pretty_name = pretty_span.text if pretty_span else ''
+    favorite_counts = page.favorites.strip('(').strip(')') if page.favorites is not None else '0'
 
-    subtitle = doujinshi_info.find('h2')
-
-    favorite_span = doujinshi_info.find('span', class_='nobold')
-    favorite_counts = favorite_span.text.strip('(').strip(')') if favorite_span else '0'
-
-    doujinshi['name'] = title
-    doujinshi['pretty_name'] = pretty_name
-    doujinshi['subtitle'] = subtitle.text if subtitle else ''
+    doujinshi['name'] = page.title
+    doujinshi['pretty_name'] = page.pretty_name or ''
+    doujinshi['subtitle'] = page.subtitle or ''
     doujinshi['favorite_counts'] = int(favorite_counts) if favorite_counts and favorite_counts.isdigit() else 0
 
-    doujinshi_cover = html.find('div', attrs={'id': 'cover'})
-
-    if not doujinshi_cover:
+    if not page.cover:
         logger.critical(f'Cover div not found for id: {id_}')
         return None
 
-    cover_a = doujinshi_cover.find('a')
-    if not cover_a:
+    if not page.cover_link:
         logger.critical(f'Cover link not found for id: {id_}')
         return None
 
-    cover_img = cover_a.find('img')
-    if not cover_img or 'data-src' not in cover_img.attrs:
+    if page.cover_src is None:
         logger.critical(f'Cover image not found for id: {id_}')
         return None
 
     # fix cover.webp.webp
-    img_id = re.search(r'/galleries/(\d+)/cover(\.webp|\.jpg|\.png)?\.\w+$', cover_img.attrs['data-src'])
+    img_id = re.search(r'/galleries/(\d+)/cover(\.webp|\.jpg|\.png)?\.\w+$', page.cover_src)
 
     ext = []
-    for i in html.find_all('div', attrs={'class': 'thumb-container'}):
-        thumb_img = i.find('img')
-        if not thumb_img or 'data-src' not in thumb_img.attrs:
+    for thumb_src in page.thumbs:
+        if thumb_src is None:
             logger.warning('Thumb image missing data-src, using jpg as default')
             ext.append('jpg')
             continue
 
-        base_name = os.path.basename(thumb_img.attrs['data-src'])
+        base_name = os.path.basename(thumb_src)
         ext_name = base_name.split('.')
         if len(ext_name) == 3:
             ext.append(ext_name[1])
@@ -231,26 +221,16 @@ def doujinshi_parser(id_, counter=0):
 
     doujinshi['img_id'] = img_id.group(1)
     doujinshi['ext'] = ext
-
-    pages = 0
-    for _ in doujinshi_info.find_all('div', class_='tag-container field-name'):
-        if re.search('Pages:', _.text):
-            pages = _.find('span', class_='name').string
-    doujinshi['pages'] = int(pages)
+    doujinshi['pages'] = int(page.pages)
 
     # gain information of the doujinshi
-    information_fields = doujinshi_info.find_all('div', attrs={'class': 'field-name'})
     needed_fields = ['Characters', 'Artists', 'Languages', 'Tags', 'Parodies', 'Groups', 'Categories']
-    for field in information_fields:
-        field_name = field.contents[0].strip().strip(':')
+    for field_name, data in page.fields:
         if field_name in needed_fields:
-            data = [sub_field.find('span', attrs={'class': 'name'}).contents[0].strip() for sub_field in
-                    field.find_all('a', attrs={'class': 'tag'})]
             doujinshi[field_name.lower()] = ', '.join(data)
 
-    time_field = doujinshi_info.find('time')
-    if time_field.has_attr('datetime'):
-        doujinshi['date'] = time_field['datetime']
+    if page.date is not None:
+        doujinshi['date'] = page.date
     return doujinshi
 
 
@@ -325,10 +305,9 @@ def search_parser(keyword, sorting, page, is_page_all=False):
     total = f'/{page[-1]}' if is_page_all else ''
     not_exists_persist = False
     for p in page:
-        i = 0
-
         logger.info(f'Searching doujinshis using keywords "{keyword}" on page {p}{total}')
-        for i in range(constant.RETRY_TIMES):
+        retry = retry_policy.start(METADATA)
+        while True:
             try:
                 url = request('get', url=constant.SEARCH_URL, params={'query': keyword,
                                                                       'page': p, 'sort': sorting}).url
@@ -339,10 +318,16 @@ def search_parser(keyword, sorting, page, is_page_all=False):
                 response = request('get', url.replace('%2B', '+')).json()
                 break  # Break only on success
             except Exception as e:
-                logger.warning(f'Search failed (attempt {i+1}/{constant.RETRY_TIMES}): {e}')
+                if isinstance(e, (KeyboardInterrupt, SystemExit)):
+                    raise
                 response = None
-                if i == constant.RETRY_TIMES - 1:
-                    logger.critical('Search failed after all retries')
+                # network errors were already retried by request(), only a bad payload is worth another try
+                delay = retry.backoff(None if classify(e) else MALFORMED)
+                if delay is None:
+                    logger.critical(f'Search failed after {retry.attempts} retries: {e}')
+                    break
+                logger.warning(f'Search failed (retry {retry.attempts}): {e}, retrying in {delay:.1f}s')
+                sleep(delay)
 
         if constant.DEBUG:
             logger.debug(f'Response: {response}')
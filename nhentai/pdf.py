@@ -0,0 +1,197 @@
+# coding: utf-8
+import os
+import shutil
+import struct
+import zlib
+
+from PIL import Image
+
+
+DEFAULT_DPI = 96
+ORIENTATION_TAG = 0x0112
+# EXIF orientation -> clockwise /Rotate of the page, mirrored orientations are left alone
+EXIF_ROTATION = {3: 180, 6: 90, 8: 270}
+COLOR_SPACES = {
+    'L': b'/DeviceGray',
+    'RGB': b'/DeviceRGB',
+    'CMYK': b'/DeviceCMYK',
+}
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# PNG color type -> number of color components, for the ones PDF can decode as they are
+PNG_COLORS = {0: 1, 2: 3}
+
+
+def image_size_in_points(image):
+    dpi = image.info.get('dpi')
+    try:
+        x_dpi, y_dpi = (float(i) for i in dpi)
+    except (TypeError, ValueError):
+        x_dpi = y_dpi = DEFAULT_DPI
+    if x_dpi <= 1 or y_dpi <= 1:
+        x_dpi = y_dpi = DEFAULT_DPI
+    return image.width * 72 / x_dpi, image.height * 72 / y_dpi
+
+
+def png_data_chunks(path):
+    """
+    (offset, length) of every IDAT chunk of a PNG whose compressed data a PDF can embed as it is:
+    8 bits grayscale or RGB without interlacing. None for any other PNG.
+    """
+    chunks = []
+    with open(path, 'rb') as f:
+        if f.read(8) != PNG_SIGNATURE:
+            return None
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                return None
+            length, kind = struct.unpack('>I4s', header)
+            if kind == b'IHDR':
+                depth, color_type, _, _, interlace = struct.unpack('>8xBBBBB', f.read(13))
+                if depth != 8 or color_type not in PNG_COLORS or interlace:
+                    return None
+                length = 0
+            elif kind == b'IDAT':
+                chunks.append((f.tell(), length))
+            elif kind == b'IEND':
+                return chunks
+            f.seek(length + 4, os.SEEK_CUR)
+
+
+def flatten(image):
+    """ Pixels of an image PDF can show as they are: grayscale or RGB, transparency on white. """
+    if image.mode == 'P':
+        image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+    if image.mode in ('RGBA', 'LA', 'PA'):
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, 'white')
+        background.paste(image, mask=image.getchannel('A'))
+        return background
+    if image.mode not in ('RGB', 'L'):
+        return image.convert('RGB')
+    return image
+
+
+class PdfWriter(object):
+    """
+    Writes a PDF one page at a time. Every page is written to the file as soon as it is added and
+    only its object offsets are kept, so memory stays at about one decoded page however long the
+    doujinshi is. JPEG pages are copied into the PDF as they are. The document is written as
+    ``{filename}.part`` and renamed by ``close``, so an interrupted PDF never looks finished.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.temp_filename = f'{filename}.part'
+        self.file = open(self.temp_filename, 'wb')
+        self.offsets = {}
+        self.pages = []
+        # 1 and 2 are the catalog and the page tree, written once every page is known
+        self.next_id = 3
+        self.file.write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+
+    def begin_object(self):
+        object_id = self.next_id
+        self.next_id += 1
+        self.offsets[object_id] = self.file.tell()
+        return object_id
+
+    def write_object(self, body, object_id=None):
+        if object_id is None:
+            object_id = self.begin_object()
+        else:
+            self.offsets[object_id] = self.file.tell()
+        self.file.write(b'%d 0 obj\n%s\nendobj\n' % (object_id, body))
+        return object_id
+
+    def write_stream(self, dictionary, data=None, path=None, chunks=None):
+        """ The stream data is ``data``, the file at ``path``, or the (offset, length) ``chunks`` of it. """
+        object_id = self.begin_object()
+        if path is None:
+            length = len(data)
+        elif chunks is None:
+            length = os.path.getsize(path)
+        else:
+            length = sum(size for _, size in chunks)
+        self.file.write(b'%d 0 obj\n<< %s /Length %d >>\nstream\n' % (object_id, dictionary, length))
+
+        if path is None:
+            self.file.write(data)
+        else:
+            with open(path, 'rb') as f:
+                if chunks is None:
+                    shutil.copyfileobj(f, self.file)
+                for offset, size in chunks or ():
+                    f.seek(offset)
+                    self.copy(f, size)
+        self.file.write(b'\nendstream\nendobj\n')
+        return object_id
+
+    def copy(self, f, size):
+        while size > 0:
+            chunk = f.read(min(size, 64 * 1024))
+            if not chunk:
+                raise ValueError(f'{f.name} ended before its image data')
+            self.file.write(chunk)
+            size -= len(chunk)
+
+    def add_image(self, path):
+        with Image.open(path) as image:
+            width, height = image_size_in_points(image)
+            rotation = EXIF_ROTATION.get(image.getexif().get(ORIENTATION_TAG), 0)
+            dictionary = b'/Type /XObject /Subtype /Image /Width %d /Height %d /BitsPerComponent 8' % image.size
+            chunks = png_data_chunks(path) if image.format == 'PNG' and image.mode in ('L', 'RGB') else None
+
+            if image.format == 'JPEG' and image.mode in COLOR_SPACES:
+                dictionary += b' /ColorSpace %s /Filter /DCTDecode' % COLOR_SPACES[image.mode]
+                if image.mode == 'CMYK' and 'adobe' in image.info:
+                    # Adobe writes CMYK JPEGs inverted
+                    dictionary += b' /Decode [1 0 1 0 1 0 1 0]'
+                image_id = self.write_stream(dictionary, path=path)
+            elif chunks is not None:
+                # the zlib data of a PNG is a FlateDecode stream with the PNG predictors
+                dictionary += (b' /ColorSpace %s /Filter /FlateDecode /DecodeParms << /Predictor 15 '
+                               b'/Colors %d /BitsPerComponent 8 /Columns %d >>'
+                               % (COLOR_SPACES[image.mode], len(image.mode), image.width))
+                image_id = self.write_stream(dictionary, path=path, chunks=chunks)
+            else:
+                image = flatten(image)
+                dictionary += b' /ColorSpace %s /Filter /FlateDecode' % COLOR_SPACES[image.mode]
+                image_id = self.write_stream(dictionary, data=zlib.compress(image.tobytes(), 6))
+
+        content_id = self.write_stream(b'', data=b'q %.2f 0 0 %.2f 0 0 cm /Im0 Do Q' % (width, height))
+        self.pages.append(self.write_object(
+            b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %.2f %.2f] /Rotate %d '
+            b'/Resources << /XObject << /Im0 %d 0 R >> >> /Contents %d 0 R >>'
+            % (width, height, rotation, image_id, content_id)))
+
+    def close(self):
+        kids = b' '.join(b'%d 0 R' % page for page in self.pages)
+        self.write_object(b'<< /Type /Pages /Kids [%s] /Count %d >>' % (kids, len(self.pages)), 2)
+        self.write_object(b'<< /Type /Catalog /Pages 2 0 R >>', 1)
+
+        xref = self.file.tell()
+        self.file.write(b'xref\n0 %d\n0000000000 65535 f \n' % self.next_id)
+        for object_id in range(1, self.next_id):
+            self.file.write(b'%010d 00000 n \n' % self.offsets[object_id])
+        self.file.write(b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (self.next_id, xref))
+        self.file.close()
+        os.replace(self.temp_filename, self.filename)
+
+    def abort(self):
+        self.file.close()
+        try:
+            os.remove(self.temp_filename)
+        except OSError:
+            pass
+
+
+def write_pdf(filename, paths):
+    writer = PdfWriter(filename)
+    try:
+        for path in paths:
+            writer.add_image(path)
+    except BaseException:
+        writer.abort()
+        raise
+    writer.close()
@@ -0,0 +1,179 @@
+# coding: utf-8
+import asyncio
+import threading
+import time
+
+
+METADATA = 'metadata'
+IMAGE = 'image'
+# bytes set aside for a response of a class before any of its responses were seen
+DEFAULT_RESPONSE_SIZE = 256 * 1024
+# weight of the latest response in the estimated response size
+ESTIMATE_ALPHA = 0.2
+
+
+class TokenBucket(object):
+    """
+    A thread-safe token bucket that hands out reservations instead of blocking,
+    so the same bucket serves the threaded metadata path and the asyncio image path.
+    Tokens may go negative: the debt is paid by whoever reserves next.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(self.rate, 1.0))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount=1.0):
+        """ Take ``amount`` tokens and return how many seconds the caller has to wait before using them. """
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens -= amount
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+    def charge(self, amount):
+        """ Account for tokens spent after the fact, e.g. bytes of a response that was already read. """
+        with self.lock:
+            self._refill(time.monotonic())
+            self.tokens -= amount
+
+
+class ByteReservation(object):
+    """
+    Bytes of a bandwidth budget set aside for one response before it is requested. What the
+    response brings in draws on the reservation first, only bytes beyond it are charged as they
+    arrive; ``settle`` hands back what was reserved but not used.
+    """
+
+    def __init__(self, limit, amount):
+        self.limit = limit
+        self.amount = amount
+        self.received = 0
+        self.settled = False
+
+    def consumed(self, nbytes):
+        over = max(0, self.received + nbytes - self.amount) - max(0, self.received - self.amount)
+        self.received += nbytes
+        if over:
+            self.limit.bytes.charge(over)
+
+    def settle(self):
+        if self.settled:
+            return
+        self.settled = True
+        if self.received < self.amount:
+            self.limit.bytes.charge(self.received - self.amount)
+        self.limit.observed(self.received)
+
+
+class HostClassLimit(object):
+    def __init__(self, requests_per_second=None, bytes_per_second=None):
+        self.requests = TokenBucket(requests_per_second) if requests_per_second else None
+        self.bytes = TokenBucket(bytes_per_second) if bytes_per_second else None
+        self.estimate = None
+        self.waited = 0.0
+
+    def reserve(self):
+        """ Wait time of the next request, and the bytes set aside for its response if bandwidth is limited. """
+        delay = self.requests.reserve() if self.requests else 0.0
+        reservation = None
+        if self.bytes:
+            # every waiter sets aside the size it expects to receive, so concurrent waiters queue
+            # up one behind the other instead of all waking up when the current debt is paid off
+            amount = self.estimate
+            if amount is None:
+                amount = min(DEFAULT_RESPONSE_SIZE, self.bytes.capacity)
+            delay = max(delay, self.bytes.reserve(amount))
+            reservation = ByteReservation(self, amount)
+        self.waited += delay
+        return delay, reservation
+
+    def observed(self, nbytes):
+        if not nbytes:
+            # failed requests say nothing about the size of a response
+            return
+        if self.estimate is None:
+            self.estimate = nbytes
+        else:
+            self.estimate = ESTIMATE_ALPHA * nbytes + (1 - ESTIMATE_ALPHA) * self.estimate
+
+
+class RateLimiter(object):
+    """
+    Process-wide request and bandwidth budgets, one per host class (metadata pages on the
+    main site, images on the i* hosts), shared by every thread and coroutine.
+    """
+
+    def __init__(self):
+        self.classes = {}
+
+    def configure(self, host_class, requests_per_second=None, bytes_per_second=None):
+        self.classes[host_class] = HostClassLimit(requests_per_second, bytes_per_second)
+
+    def reset(self):
+        self.classes = {}
+
+    def wait(self, host_class):
+        """ Wait for the turn of the next request, returns its ByteReservation or None. """
+        limit = self.classes.get(host_class)
+        if limit is None:
+            return None
+        delay, reservation = limit.reserve()
+        if delay:
+            try:
+                time.sleep(delay)
+            except BaseException:
+                # the request is not sent after all
+                self.settle(reservation)
+                raise
+        return reservation
+
+    async def async_wait(self, host_class):
+        limit = self.classes.get(host_class)
+        if limit is None:
+            return None
+        delay, reservation = limit.reserve()
+        if delay:
+            try:
+                await asyncio.sleep(delay)
+            except BaseException:
+                # the request is not sent after all
+                self.settle(reservation)
+                raise
+        return reservation
+
+    def consumed(self, host_class, nbytes, reservation=None):
+        if reservation is not None:
+            reservation.consumed(nbytes)
+            return
+        limit = self.classes.get(host_class)
+        if limit is not None and limit.bytes is not None:
+            limit.bytes.charge(nbytes)
+
+    def settle(self, reservation):
+        """ Done with the response a ByteReservation was made for. """
+        if reservation is not None:
+            reservation.settle()
+
+    def __str__(self):
+        rows = []
+        for host_class, limit in self.classes.items():
+            budgets = []
+            if limit.requests:
+                budgets.append(f'{limit.requests.rate:g} req/s')
+            if limit.bytes:
+                budgets.append(f'{limit.bytes.rate / 1024:.0f} KiB/s')
+            rows.append(f'{host_class} {", ".join(budgets) or "unlimited"} ({limit.waited:.1f}s waited)')
+        return '; '.join(rows) if rows else 'unlimited'
+
+
+rate_limiter = RateLimiter()
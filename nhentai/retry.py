@@ -0,0 +1,192 @@
+# coding: utf-8
+import asyncio
+import random
+import threading
+import time
+
+from collections import Counter
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+
+import httpx
+from curl_cffi.requests import exceptions as curl_exceptions
+
+from nhentai import constant
+
+
+TIMEOUT = 'timeout'
+CONNECTION = 'connection'
+THROTTLED = 'throttled'
+SERVER = 'server'
+INCOMPLETE = 'incomplete'
+# a 200 whose body could not be used, e.g. an anti-bot page instead of search results
+MALFORMED = 'malformed'
+
+# retries per error class, as a multiple of --retry; throttling clears by waiting and an
+# interrupted page resumes where it stopped, so both get a larger share than hard errors
+BUDGET_FACTORS = {
+    TIMEOUT: 1,
+    CONNECTION: 1,
+    THROTTLED: 2,
+    SERVER: 1,
+    INCOMPLETE: 2,
+    MALFORMED: 1,
+}
+
+# sleep in short slices so Ctrl-C is not held up by a long Retry-After
+SLEEP_SLICE = 0.5
+
+
+def parse_retry_after(value):
+    """ Seconds to wait from a Retry-After header, which holds either seconds or an HTTP date. """
+    if not value:
+        return None
+
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+def classify(error=None, status=None):
+    """ Map an exception or HTTP status to an error class, or None when retrying cannot help. """
+    if error is not None:
+        retry_class = getattr(error, 'retry_class', None)
+        if retry_class:
+            return retry_class
+        if isinstance(error, httpx.HTTPStatusError):
+            return classify(status=error.response.status_code)
+        if isinstance(error, (httpx.TimeoutException, curl_exceptions.Timeout)):
+            return TIMEOUT
+        if isinstance(error, (httpx.TransportError, curl_exceptions.ConnectionError,
+                              curl_exceptions.ProxyError, curl_exceptions.ChunkedEncodingError,
+                              curl_exceptions.IncompleteRead)):
+            return CONNECTION
+        return None
+
+    if status in (429, 503):
+        return THROTTLED
+    if status is not None and status >= 500:
+        return SERVER
+    return None
+
+
+def sleep(delay):
+    deadline = time.monotonic() + delay
+    while True:
+        if constant.STOP_REQUESTED:
+            raise KeyboardInterrupt
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        time.sleep(min(remaining, SLEEP_SLICE))
+
+
+async def async_sleep(delay):
+    deadline = time.monotonic() + delay
+    while True:
+        if constant.STOP_REQUESTED:
+            raise KeyboardInterrupt
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        await asyncio.sleep(min(remaining, SLEEP_SLICE))
+
+
+class RetryState(object):
+    """ The retries left for a single operation, e.g. one page or one metadata request. """
+
+    def __init__(self, policy, operation):
+        self.policy = policy
+        self.operation = operation
+        self.counts = Counter()
+
+    @property
+    def attempts(self):
+        return sum(self.counts.values())
+
+    def backoff(self, error_class, retry_after=None):
+        """
+        Return how long to wait before the next attempt, or None when the budget of
+        ``error_class`` is spent (or the error is not retryable) and the caller should give up.
+        """
+        if error_class is None or self.counts[error_class] >= self.policy.budget(error_class):
+            self.policy.gave_up(self.operation)
+            return None
+
+        delay = self.policy.delay(self.counts[error_class], retry_after)
+        self.counts[error_class] += 1
+        self.policy.retried(self.operation, error_class, delay)
+        return delay
+
+
+class RetryPolicy(object):
+    """
+    Shared by every network call. Delays grow exponentially from ``base_delay`` up to
+    ``max_delay`` with full jitter, so workers that failed together do not retry together.
+    A Retry-After sent with a 429 or 503 is honoured (up to ``max_retry_after``) in place of
+    the computed delay when it is longer. Each error class has its own retry budget per operation.
+    """
+
+    def __init__(self, base_delay=0.5, max_delay=30.0, max_retry_after=300.0, budget_factors=None):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retry_after = max_retry_after
+        self.budget_factors = dict(BUDGET_FACTORS, **(budget_factors or {}))
+        self.retries = Counter()
+        self.failures = Counter()
+        self.waited = 0.0
+        self._lock = threading.Lock()
+
+    def budget(self, error_class):
+        # read at call time, --retry is applied after the policy was created
+        return self.budget_factors.get(error_class, 1) * max(constant.RETRY_TIMES, 0)
+
+    def delay(self, retried, retry_after=None):
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** retried))
+        retry_after = parse_retry_after(retry_after) if isinstance(retry_after, str) else retry_after
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_retry_after))
+        return delay
+
+    def start(self, operation):
+        return RetryState(self, operation)
+
+    def retried(self, operation, error_class, delay):
+        with self._lock:
+            self.retries[(operation, error_class)] += 1
+            self.waited += delay
+
+    def gave_up(self, operation):
+        with self._lock:
+            self.failures[operation] += 1
+
+    def reset(self):
+        with self._lock:
+            self.retries = Counter()
+            self.failures = Counter()
+            self.waited = 0.0
+
+    def __str__(self):
+        operations = {}
+        for (operation, error_class), count in sorted(self.retries.items()):
+            operations.setdefault(operation, []).append(f'{count} {error_class}')
+
+        rows = [f'{operation} {", ".join(counts)}' for operation, counts in operations.items()]
+        if not rows:
+            return 'no retries'
+        summary = '; '.join(rows) + f' ({self.waited:.1f}s waited'
+        failures = sum(self.failures.values())
+        if failures:
+            summary += f', gave up {failures} times'
+        return summary + ')'
+
+
+retry_policy = RetryPolicy()
@@ -1,4 +1,5 @@
 # coding: utf-8
+import io
 import json
 import os
 
@@ -35,8 +36,13 @@ def serialize_json(doujinshi, output_dir: str):
 
 
 def serialize_comic_xml(doujinshi, output_dir):
-    from iso8601 import parse_date
     with open(os.path.join(output_dir, 'ComicInfo.xml'), 'w', encoding="utf-8") as f:
+        f.write(comic_xml(doujinshi))
+
+
+def comic_xml(doujinshi) -> str:
+    from iso8601 import parse_date
+    with io.StringIO() as f:
         f.write('<?xml version="1.0" encoding="utf-8"?>\n')
         f.write('<ComicInfo xmlns:xsd="http://www.w3.org/2001/XMLSchema" '
                 'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">\n')
@@ -78,6 +84,7 @@ def serialize_comic_xml(doujinshi, output_dir):
              if (i != 'translated' and i in LANGUAGE_ISO)]
 
         f.write('</ComicInfo>')
+        return f.getvalue()
 
 
 def serialize_info_txt(doujinshi, output_dir: str):
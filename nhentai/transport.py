@@ -0,0 +1,116 @@
+# coding: utf-8
+import contextlib
+
+import httpx
+
+from nhentai import constant
+from nhentai.logger import logger
+from nhentai.utils import get_headers, raise_if_stop_requested
+
+
+DEFAULT_KEEPALIVE_EXPIRY = 30.0
+
+
+def http2_available():
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        logger.error('Please install h2 package by using pip to enable HTTP/2, falling back to HTTP/1.1.')
+        return False
+    return True
+
+
+class ConnectionStats(object):
+    """ Counts requests against freshly opened connections, fed by the httpcore trace extension. """
+
+    def __init__(self):
+        self.requests = 0
+        self.connections = 0
+        self.tls_handshakes = 0
+
+    @property
+    def reused(self):
+        return max(0, self.requests - self.connections)
+
+    @property
+    def reuse_ratio(self):
+        if not self.requests:
+            return 0.0
+        return self.reused / self.requests
+
+    async def trace(self, event_name, _info):
+        if event_name == 'connection.connect_tcp.complete':
+            self.connections += 1
+        elif event_name == 'connection.start_tls.complete':
+            self.tls_handshakes += 1
+        elif event_name.endswith('.send_request_headers.started'):
+            self.requests += 1
+
+    def __str__(self):
+        return (f'{self.requests} requests over {self.connections} connections '
+                f'({self.reused} reused, {self.reuse_ratio:.0%}), {self.tls_handshakes} TLS handshakes')
+
+
+class AsyncTransport(object):
+    """
+    A long-lived, pooled ``httpx.AsyncClient`` for image downloads.
+    httpx keeps one keep-alive pool per origin, so every i1/i2/... host reuses its connections
+    for as long as the owning event loop is alive.
+
+    With ``http2`` enabled, concurrent page requests are multiplexed as streams over a small
+    number of connections per host instead of one connection per in-flight request.
+    """
+
+    def __init__(self, max_connections=None, max_keepalive_connections=None,
+                 keepalive_expiry=DEFAULT_KEEPALIVE_EXPIRY, proxy=None, http2=False):
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.proxy = proxy
+        self.http2 = http2 and http2_available()
+        self.stats = ConnectionStats()
+        self.client = None
+
+    def _create_client(self):
+        proxy = self.proxy
+        if proxy is None:
+            proxy = constant.CONFIG['proxy']
+
+        if isinstance(proxy, (str, )) and not proxy:
+            proxy = None
+
+        return httpx.AsyncClient(headers=get_headers(), verify=False, proxy=proxy, limits=self.limits,
+                                 http2=self.http2)
+
+    def _prepare(self, kwargs):
+        raise_if_stop_requested()
+        if self.client is None:
+            self.client = self._create_client()
+
+        extensions = kwargs.pop('extensions', None) or {}
+        extensions.setdefault('trace', self.stats.trace)
+        return extensions
+
+    async def request(self, method, url, **kwargs):
+        extensions = self._prepare(kwargs)
+        response = await self.client.request(method, url, extensions=extensions, **kwargs)
+        await response.aread()
+
+        raise_if_stop_requested()
+        return response
+
+    @contextlib.asynccontextmanager
+    async def stream(self, method, url, **kwargs):
+        """ Like ``request``, but the body is left unread for the caller to iterate. """
+        extensions = self._prepare(kwargs)
+        async with self.client.stream(method, url, extensions=extensions, **kwargs) as response:
+            yield response
+
+        raise_if_stop_requested()
+
+    async def aclose(self):
+        if self.client is not None:
+            client, self.client = self.client, None
+            await client.aclose()
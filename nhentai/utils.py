@@ -5,9 +5,9 @@ import re
 import os
 import zipfile
 import shutil
+import threading
 import warnings
 
-import httpx
 from curl_cffi import requests
 import sqlite3
 import urllib.parse
@@ -16,6 +16,8 @@ from typing import Tuple
 from nhentai import constant
 from nhentai.constant import PATH_SEPARATOR
 from nhentai.logger import logger
+from nhentai.ratelimit import rate_limiter, METADATA
+from nhentai.retry import retry_policy, classify, sleep
 from nhentai.serializer import serialize_comic_xml, serialize_json, serialize_info_txt, set_js_database
 
 # Suppress curl_cffi proxy protocol warning
@@ -46,10 +48,54 @@ def raise_if_stop_requested():
         raise KeyboardInterrupt
 
 
+class SessionManager(object):
+    """
+    Owns the process-wide curl_cffi session used for metadata, search and favorites requests.
+    curl_cffi keeps a curl handle per thread behind a single Session, so the session (and its
+    cookie jar) can be shared by every caller while connections are reused per thread.
+    """
+
+    def __init__(self, factory=None):
+        self.factory = factory or (lambda: requests.Session(impersonate='chrome110'))
+        self._session = None
+        self._headers = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        with self._lock:
+            if self._session is None:
+                self._session = self.factory()
+
+            # cookie and useragent may be changed by the command line after the session was created
+            headers = get_headers()
+            if headers != self._headers:
+                self._session.headers.update(headers)
+                self._headers = headers
+
+            return self._session
+
+    def replace(self, session):
+        """ Swap in another session (e.g. a local stand-in in tests), returning the previous one. """
+        with self._lock:
+            previous, self._session = self._session, session
+            self._headers = None
+            return previous
+
+    def close(self):
+        with self._lock:
+            session, self._session = self._session, None
+            self._headers = None
+
+        if session is not None:
+            session.close()
+
+
+session_manager = SessionManager()
+
+
 def request(method, url, **kwargs):
     raise_if_stop_requested()
-    session = requests.Session(impersonate="chrome110")
-    session.headers.update(get_headers())
+    session = session_manager.get()
 
     if not kwargs.get('proxies', None):
         kwargs['proxies'] = {
@@ -57,34 +103,36 @@ def request(method, url, **kwargs):
             'http': constant.CONFIG['proxy'],
         }
 
-    try:
-        response = getattr(session, method)(url, verify=False, **kwargs)
-    except Exception:
-        if constant.STOP_REQUESTED:
-            raise KeyboardInterrupt
-        raise
-
-    raise_if_stop_requested()
-    return response
-
-
-async def async_request(method, url, proxy=None, **kwargs):
-    raise_if_stop_requested()
-    headers = get_headers()
-
-    if proxy is None:
-        proxy = constant.CONFIG['proxy']
+    retry = retry_policy.start(METADATA)
+    while True:
+        reservation = rate_limiter.wait(METADATA)
+        try:
+            response = getattr(session, method)(url, verify=False, **kwargs)
+        except Exception as e:
+            rate_limiter.settle(reservation)
+            if constant.STOP_REQUESTED:
+                raise KeyboardInterrupt
+            delay = retry.backoff(classify(e))
+            if delay is None:
+                raise
+            logger.debug(f'{e}, retrying {url} in {delay:.1f}s')
+            sleep(delay)
+            continue
 
-    if isinstance(proxy, (str, )) and not proxy:
-        proxy = None
+        rate_limiter.consumed(METADATA, len(response.content or b''), reservation)
+        rate_limiter.settle(reservation)
+        raise_if_stop_requested()
 
-    async with httpx.AsyncClient(headers=headers, verify=False, proxy=proxy, **kwargs) as client:
-        response = await client.request(method, url, **kwargs)
-        # Consume response body before client closes to prevent connection errors
-        await response.aread()
+        error_class = classify(status=response.status_code)
+        if error_class is None:
+            return response
 
-    raise_if_stop_requested()
-    return response
+        # the last response is handed back once the budget is spent, callers check the status
+        delay = retry.backoff(error_class, response.headers.get('Retry-After'))
+        if delay is None:
+            return response
+        logger.debug(f'HTTP {response.status_code}, retrying {url} in {delay:.1f}s')
+        sleep(delay)
 
 
 def check_cookie():
@@ -316,7 +364,7 @@ def generate_main_html(output_dir=f'.{PATH_SEPARATOR}'):
 
     for folder in doujinshi_dirs:
         folder_path = os.path.join(abs_output, folder)
-        files = os.listdir(folder_path)
+        files = [f for f in os.listdir(folder_path) if not f.startswith('.')]
 
         if not files:
             logger.warning(f'Empty folder, skipping: {folder}')
@@ -360,6 +408,9 @@ def generate_cbz(doujinshi_dir, filename):
     logger.info(f'Writing CBZ file to path: {filename}')
     with zipfile.ZipFile(filename, 'w') as cbz_pf:
         for image in file_list:
+            if image.startswith('.'):
+                # bookkeeping: unfinished pages left for a later run and the page manifest
+                continue
             image_path = os.path.join(doujinshi_dir, image)
             cbz_pf.write(image_path, image)
 
@@ -378,24 +429,15 @@ def generate_doc(file_type='', output_dir='.', doujinshi_obj=None, regenerate=Fa
         generate_cbz(doujinshi_dir, filename)
 
     elif file_type == 'pdf':
-        try:
-            import img2pdf
-
-            """Write images to a PDF file using img2pdf."""
-            file_list = [f for f in os.listdir(doujinshi_dir) if f.lower().endswith(EXTENSIONS)]
-            file_list.sort()
+        from nhentai.pdf import write_pdf
 
-            logger.info(f'Writing PDF file to path: {filename}')
-            with open(filename, 'wb') as pdf_f:
-                full_path_list = (
-                    [os.path.join(doujinshi_dir, image) for image in file_list]
-                )
-                pdf_f.write(img2pdf.convert(full_path_list, rotation=img2pdf.Rotation.ifvalid))
+        file_list = [f for f in os.listdir(doujinshi_dir) if f.lower().endswith(EXTENSIONS)]
+        file_list.sort()
 
-            logger.log(16, f'PDF file has been written to "{filename}"')
-
-        except ImportError:
-            logger.error("Please install img2pdf package by using pip.")
+        logger.info(f'Writing PDF file to path: {filename}')
+        # pages are streamed into the file one at a time, memory does not grow with the page count
+        write_pdf(filename, [os.path.join(doujinshi_dir, image) for image in file_list])
+        logger.log(16, f'PDF file has been written to "{filename}"')
     else:
         raise ValueError('invalid file type')
 
@@ -445,6 +487,24 @@ def signal_handler(_signal, _frame):
     constant.STOP_REQUESTED = True
 
 
+def parse_size(value):
+    # 512K, 2M, 1.5G -> bytes
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    value = str(value).strip().upper().rstrip('B')
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(float(value))
+
+
+def parse_duration(value):
+    # 90, 30m, 12h, 7d -> seconds
+    units = {'S': 1, 'M': 60, 'H': 3600, 'D': 86400}
+    value = str(value).strip().upper()
+    if value and value[-1] in units:
+        return float(value[:-1]) * units[value[-1]]
+    return float(value)
+
+
 def paging(page_string):
     # 1,3-5,14 -> [1, 3, 4, 5, 14]
     if not page_string:
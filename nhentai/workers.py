@@ -0,0 +1,157 @@
+# coding: utf-8
+import multiprocessing
+import os
+import socket
+import threading
+import time
+
+from rich.progress import Progress, BarColumn, TextColumn, TimeRemainingColumn
+
+from nhentai import constant
+from nhentai.jobs import LEASE_SECONDS, DONE, FAILED
+from nhentai.logger import logger, console
+
+
+def worker_name(pid=None):
+    """ Lease owner of a worker process, unique across the machines sharing a job queue. """
+    return f'{socket.gethostname()}:{pid or os.getpid()}'
+
+
+class Shard(object):
+    """
+    One worker of ``--workers``. Doujinshi are claimed from the shared job queue ``batch`` at a
+    time, as the downloader asks for more, and stay leased to this worker while it works on them;
+    a heartbeat thread renews the leases and reports the pages downloaded so far.
+
+    Once nothing is left to claim the worker keeps waiting while other workers hold leases, so
+    the doujinshi of a worker that died are picked up when its leases run out.
+    """
+
+    def __init__(self, jobs, downloader, owner=None, batch=1, lease=LEASE_SECONDS):
+        self.jobs = jobs
+        self.downloader = downloader
+        self.owner = owner or worker_name()
+        self.batch = batch
+        self.lease = lease
+        self.stopped = threading.Event()
+
+    def claims(self, claimed):
+        # advanced from a metadata thread, see prefetch, so a claim waiting on the database lock
+        # does not hold up the downloads
+        yield from claimed
+        while not constant.STOP_REQUESTED:
+            claimed = self.jobs.claim(self.owner, self.batch, self.lease)
+            if not claimed:
+                return
+            yield from claimed
+
+    def report(self):
+        self.jobs.report(self.owner, self.downloader.pages_saved, self.downloader.received_bytes)
+
+    def heartbeat(self):
+        while not self.stopped.wait(self.lease / 4):
+            self.jobs.renew(self.owner, self.lease)
+            self.report()
+
+    def run(self, run_batch):
+        """ ``run_batch(ids)`` downloads the doujinshi of an iterator of ids. """
+        self.report()
+        heartbeat = threading.Thread(target=self.heartbeat, name='lease-heartbeat', daemon=True)
+        heartbeat.start()
+        try:
+            while not constant.STOP_REQUESTED:
+                claimed = self.jobs.claim(self.owner, self.batch, self.lease)
+                if claimed:
+                    run_batch(self.claims(claimed))
+                elif not self.jobs.leased(exclude=self.owner) or self.stopped.wait(min(self.lease / 4, 1)):
+                    break
+        finally:
+            self.stopped.set()
+            heartbeat.join()
+            self.report()
+            # whatever an interrupted worker did not finish is free for the others right away
+            self.jobs.release(self.owner)
+
+
+class WorkerPool(object):
+    """
+    Runs ``target(*args)`` in ``count`` worker processes sharing ``jobs`` and shows their combined
+    progress over the ``total`` doujinshi of the batch. The leases of a worker that exits with an
+    error are released at once instead of waiting for them to run out.
+    """
+
+    def __init__(self, jobs, count, target, args=(), total=0):
+        self.jobs = jobs
+        self.count = count
+        self.target = target
+        self.args = args
+        self.total = total
+        self.started = None
+        self.processes = []
+
+    def run(self):
+        self.started = time.time()
+        # spawned rather than forked: the parent holds a database connection and Rich's threads
+        context = multiprocessing.get_context('spawn')
+        self.processes = [context.Process(target=self.target, args=self.args, name=f'nhentai-worker-{i}')
+                          for i in range(self.count)]
+        for process in self.processes:
+            process.start()
+        logger.info(f'Started {self.count} worker processes')
+
+        reaped = set()
+        with BatchProgress(self.jobs, self.total, self.started) as progress:
+            while True:
+                running = [process for process in self.processes if process.is_alive()]
+                for process in self.processes:
+                    if process.exitcode not in (None, 0) and process not in reaped:
+                        reaped.add(process)
+                        logger.warning(f'{process.name} exited with code {process.exitcode}, '
+                                       'its doujinshi go back to the queue')
+                        self.jobs.release(worker_name(process.pid))
+                progress.update(len(running))
+                if not running:
+                    break
+                time.sleep(0.5)
+
+        for process in self.processes:
+            process.join()
+
+
+class BatchProgress(object):
+    """ One progress bar over the ``total`` doujinshi of a batch, summed from the workers' reports. """
+
+    def __init__(self, jobs, total, started):
+        self.jobs = jobs
+        self.total = total
+        self.started = started
+        self.progress = Progress(
+            TextColumn("[progress.description]{task.description}"),
+            BarColumn(),
+            TextColumn("[cyan]{task.completed}/{task.total}"),
+            TextColumn("•"),
+            TextColumn("{task.fields[stats]}"),
+            TimeRemainingColumn(),
+            console=console,
+            refresh_per_second=4,
+            transient=False,
+        )
+        self.task = None
+
+    def __enter__(self):
+        self.progress.__enter__()
+        self.task = self.progress.add_task('[green]Doujinshi', total=self.total, stats='')
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.progress.__exit__(exc_type, exc_val, exc_tb)
+
+    def update(self, running):
+        counts = self.jobs.counts(since=self.started)
+        workers = self.jobs.workers(since=self.started)
+        pages = sum(worker['pages'] for worker in workers)
+        received = sum(worker['bytes'] for worker in workers)
+        elapsed = max(time.time() - self.started, 1e-6)
+        self.progress.update(self.task, completed=counts[DONE] + counts[FAILED],
+                             stats=f'{pages} pages • {pages / elapsed:.1f} pages/s • '
+                                   f'{received / elapsed / 1024 / 1024:.2f} MiB/s • {running} workers')
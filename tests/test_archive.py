@@ -0,0 +1,95 @@
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+
+from nhentai.doujinshi import Doujinshi
+from nhentai.downloader import CbzStorage, ZipWriter, page_order
+from nhentai.manifest import PageManifest
+
+
+class TestZipWriter(unittest.TestCase):
+    def setUp(self) -> None:
+        self.folder = tempfile.mkdtemp()
+        self.filename = os.path.join(self.folder, 'gallery.zip')
+        self.manifest = PageManifest(os.path.join(self.folder, '.gallery.zip.manifest.json'))
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def queue_page(self, writer, page):
+        path = os.path.join(self.folder, f'.{page}.queued')
+        with open(path, 'wb') as f:
+            f.write(page.encode())
+        writer.queue.put(('page', (page, f'{page}.jpg', path, len(page), 'sha1')))
+
+    def test_pages_are_written_in_order(self):
+        archive = zipfile.ZipFile(self.filename, 'w')
+        writer = ZipWriter(archive, self.manifest, zipfile.ZIP_DEFLATED)
+        writer.start()
+        writer.queue.put(('expect', ['1', '2', '3', '4', '10']))
+
+        # finish out of order, page 3 never arrives
+        for page in ('10', '4', '2'):
+            self.queue_page(writer, page)
+        writer.queue.put(('discard', '3'))
+        self.queue_page(writer, '1')
+
+        writer.queue.put(None)
+        writer.join()
+        archive.close()
+
+        with zipfile.ZipFile(self.filename) as archive:
+            self.assertEqual(archive.namelist(), ['1.jpg', '2.jpg', '4.jpg', '10.jpg'])
+            self.assertEqual({info.compress_type for info in archive.infolist()}, {zipfile.ZIP_DEFLATED})
+        self.assertEqual(sorted(self.manifest.pages), ['1', '10', '2', '4'])
+        self.assertFalse([name for name in os.listdir(self.folder) if name.endswith('.queued')])
+
+    def test_page_order(self):
+        self.assertEqual(sorted(['10.jpg', '2.jpg', '01.jpg', 'cover.jpg'], key=page_order),
+                         ['01.jpg', '2.jpg', '10.jpg', 'cover.jpg'])
+
+
+class TestCbzStorage(unittest.TestCase):
+    def setUp(self) -> None:
+        self.folder = tempfile.mkdtemp()
+        self.gallery = os.path.join(self.folder, 'gallery')
+        self.doujinshi = Doujinshi(name='Gallery', pretty_name='Gallery', id=1, pages=2,
+                                   date='2024-01-02T03:04:05+00:00')
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def store(self, pages, missing=()):
+        storage = CbzStorage(self.gallery, self.doujinshi)
+        storage.expect(pages)
+        for page in pages:
+            if page in missing:
+                storage.discard(page)
+                continue
+            path = os.path.join(storage.part_folder, f'.{page}.queued')
+            with open(path, 'wb') as f:
+                f.write(page.encode())
+            storage.writer.queue.put(('page', (page, f'{page}.jpg', path, len(page), 'sha1')))
+        storage.close()
+
+    def test_renamed_once_complete(self):
+        self.store(['1', '2'])
+
+        self.assertEqual(os.listdir(self.folder), ['gallery.cbz'])
+        with zipfile.ZipFile(f'{self.gallery}.cbz') as archive:
+            self.assertEqual(archive.namelist(), ['1.jpg', '2.jpg', 'ComicInfo.xml'])
+            self.assertIn(b'<Title>Gallery</Title>', archive.read('ComicInfo.xml'))
+
+    def test_missing_page_keeps_part_file(self):
+        self.store(['1', '2'], missing=['2'])
+
+        self.assertFalse(os.path.exists(f'{self.gallery}.cbz'))
+        with zipfile.ZipFile(f'{self.gallery}.cbz.part') as archive:
+            self.assertEqual(archive.namelist(), ['1.jpg'])
+        self.assertTrue(os.path.exists(os.path.join(self.folder, '.gallery.cbz.part.manifest.json')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,194 @@
+import argparse
+import asyncio
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from nhentai import constant
+from nhentai.batch import BatchDownload, PostProcessPool, prefetch
+from nhentai.command import run_downloads
+from nhentai.downloader import Downloader, ExitOnFail
+
+
+class PageHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    body = b'\xff\xd8\xff' + b'\x00' * 512
+
+    def do_GET(self):
+        if self.path.endswith('/404.jpg'):
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, *args):
+        pass
+
+
+class BatchTestDownloader(Downloader):
+    # Downloader is a singleton, a subclass keeps this instance to the test
+    pass
+
+
+class ExitOnFailDownloader(Downloader):
+    pass
+
+
+class StandInDoujinshi(object):
+    def __init__(self, id_):
+        self.name = f'gallery {id_}'
+        self.filename = str(id_)
+
+
+class TestBatchDownload(unittest.TestCase):
+    def setUp(self) -> None:
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), PageHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.image_url, self.mirrors = constant.IMAGE_URL, constant.IMAGE_URL_MIRRORS
+        constant.IMAGE_URL = f'http://127.0.0.1:{self.server.server_address[1]}/galleries'
+        constant.IMAGE_URL_MIRRORS = []
+        self.output = tempfile.mkdtemp()
+
+    def tearDown(self) -> None:
+        constant.IMAGE_URL, constant.IMAGE_URL_MIRRORS = self.image_url, self.mirrors
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.output, ignore_errors=True)
+
+    def test_pages_of_all_galleries_share_one_queue(self):
+        downloader = BatchTestDownloader(path=self.output, threads=4)
+        downloader.transport.proxy = ''
+
+        def load(id_):
+            if id_ == 3:
+                return None
+            pages = [f'{constant.IMAGE_URL}/{id_}/{page}.jpg' for page in range(1, 13)]
+            if id_ == 2:
+                pages.append(f'{constant.IMAGE_URL}/{id_}/404.jpg')
+            return StandInDoujinshi(id_), pages
+
+        finished = {}
+
+        def finish(doujinshi, gallery):
+            # post-processing only starts once every page of the gallery is on disk
+            finished[doujinshi.filename] = (gallery.done, gallery.failed, len(os.listdir(gallery.storage.folder)))
+
+        try:
+            BatchDownload(downloader, load, finish).run([1, 2, 3])
+        finally:
+            downloader.shutdown()
+
+        # 12 pages, plus the page manifest where a page is still missing
+        self.assertEqual(finished, {'1': (12, 0, 12), '2': (12, 1, 13)})
+        self.assertEqual(downloader.transport.stats.requests, 25)
+        self.assertEqual(downloader.loop, None)
+
+    def test_exit_on_fail(self):
+        downloader = ExitOnFailDownloader(path=self.output, threads=2, exit_on_fail=True)
+        downloader.transport.proxy = ''
+        self.addCleanup(downloader.shutdown)
+
+        def load(id_):
+            return StandInDoujinshi(id_), [f'{constant.IMAGE_URL}/{id_}/404.jpg']
+
+        with self.assertRaises(ExitOnFail):
+            BatchDownload(downloader, load, lambda doujinshi, gallery: None).run([1])
+
+        # a run of the command line exits with status 1, as it always did, instead of a traceback
+        options = argparse.Namespace(is_save_download_history=False, metadata_threads=1, post_threads=1)
+        with mock.patch('nhentai.command.create_downloader', return_value=downloader), \
+                mock.patch('nhentai.command.load_doujinshi', side_effect=lambda id_, *args: load(id_)), \
+                self.assertRaises(SystemExit) as exited:
+            run_downloads(options, [1])
+        self.assertEqual(exited.exception.code, 1)
+
+
+class TestPrefetch(unittest.TestCase):
+    def test_bounded_and_in_completion_order(self):
+        lock = threading.Lock()
+        running = [0, 0]
+
+        def load(item):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(0.05 if item == 0 else 0.01)
+            with lock:
+                running[0] -= 1
+            return item
+
+        async def collect():
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                return [item async for item in prefetch(load, range(12), executor, 3)]
+
+        results = asyncio.run(collect())
+        self.assertEqual(sorted(results), list(range(12)))
+        # the slow first item does not hold back the ones after it
+        self.assertNotEqual(results[0], 0)
+        self.assertLessEqual(running[1], 3)
+
+    def test_blocking_items_do_not_hold_up_the_loop(self):
+        def claims():
+            # stands in for claiming from a job queue whose database is locked by another process
+            for item in range(3):
+                time.sleep(0.1)
+                yield item
+
+        async def collect():
+            ticks = 0
+
+            async def tick():
+                nonlocal ticks
+                while True:
+                    await asyncio.sleep(0.01)
+                    ticks += 1
+
+            ticker = asyncio.ensure_future(tick())
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                results = [item async for item in prefetch(lambda item: item, claims(), executor, 2)]
+            ticker.cancel()
+            return results, ticks
+
+        results, ticks = asyncio.run(collect())
+        self.assertEqual(results, [0, 1, 2])
+        self.assertGreater(ticks, 15)
+
+
+class TestPostProcessPool(unittest.TestCase):
+    def test_backlog_blocks_submit(self):
+        release = threading.Event()
+        done = []
+
+        def job(item):
+            release.wait(5)
+            done.append(item)
+
+        async def submit_all():
+            with PostProcessPool(threads=1, backlog=1) as pool:
+                await pool.submit(job, 1)
+                await pool.submit(job, 2)
+                # one running and one waiting, the third has to wait for a free slot
+                third = asyncio.ensure_future(pool.submit(job, 3))
+                await asyncio.sleep(0.05)
+                self.assertFalse(third.done())
+                release.set()
+                await third
+                await pool.join()
+
+        asyncio.run(submit_all())
+        self.assertEqual(done, [1, 2, 3])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import unittest
+
+from nhentai.cache import MetadataCache
+from nhentai.metadata import MetadataBackend, MetadataSource
+from nhentai.utils import parse_duration
+
+
+def gallery(doujinshi_id, tags=''):
+    return {'id': doujinshi_id, 'name': f'gallery {doujinshi_id}', 'img_id': str(doujinshi_id * 3),
+            'ext': ['jpg', 'webp'], 'pages': 2, 'tags': tags, 'favorite_counts': 0}
+
+
+class CountingBackend(MetadataBackend):
+    name = 'html'
+
+    def __init__(self):
+        self.fetched = []
+
+    def fetch(self, doujinshi_id):
+        self.fetched.append(doujinshi_id)
+        return gallery(doujinshi_id) if doujinshi_id != 404 else None
+
+
+class TestMetadataCache(unittest.TestCase):
+    def setUp(self) -> None:
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'metadata.sqlite3')
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def test_entries_expire(self):
+        with MetadataCache(self.path, ttl=0.1) as cache:
+            self.assertIsNone(cache.get(1))
+            cache.put(1, gallery(1, tags='full color, sole female'))
+            self.assertEqual(cache.get(1), gallery(1, tags='full color, sole female'))
+            time.sleep(0.15)
+            self.assertIsNone(cache.get(1))
+            self.assertEqual((cache.hits, cache.misses, cache.expired), (1, 2, 1))
+
+        # an entry stored with a long TTL is stale for a run with a shorter one
+        with MetadataCache(self.path, ttl=60) as cache:
+            cache.put(2, gallery(2))
+        with MetadataCache(self.path, ttl=0.05) as cache:
+            time.sleep(0.1)
+            self.assertIsNone(cache.get(2))
+
+    def test_least_recently_used_are_evicted(self):
+        size = len(json.dumps(gallery(1)))
+        with MetadataCache(self.path, size=size * 3.5) as cache:
+            for doujinshi_id in (1, 2, 3):
+                cache.put(doujinshi_id, gallery(doujinshi_id))
+            # 1 is used again, 2 becomes the least recently used
+            self.assertIsNotNone(cache.get(1))
+            cache.put(4, gallery(4))
+            self.assertEqual(cache.evicted, 1)
+            self.assertEqual([i for i in (1, 2, 3, 4) if cache.get(i)], [1, 3, 4])
+            self.assertIn('3 galleries', str(cache))
+
+    def test_refresh_skips_the_entries(self):
+        with MetadataCache(self.path) as cache:
+            cache.put(1, gallery(1))
+        with MetadataCache(self.path, refresh=True) as cache:
+            self.assertIsNone(cache.get(1))
+            cache.put(1, gallery(1, tags='updated'))
+        with MetadataCache(self.path) as cache:
+            self.assertEqual(cache.get(1)['tags'], 'updated')
+
+    def test_errors_are_misses(self):
+        with MetadataCache(self.path) as cache:
+            cache.put(1, gallery(1))
+            # another process holding the write lock longer than the cache waits for it
+            cache.conn.execute('PRAGMA busy_timeout = 0')
+            blocker = sqlite3.connect(self.path)
+            self.addCleanup(blocker.close)
+            blocker.execute('BEGIN EXCLUSIVE')
+            with self.assertLogs('nhentai', level='WARNING'):
+                cache.put(2, gallery(2))
+            blocker.rollback()
+
+            cache.conn.execute('DROP TABLE metadata')
+            with self.assertLogs('nhentai', level='WARNING'):
+                self.assertIsNone(cache.get(1))
+            self.assertEqual((cache.hits, cache.misses, cache.errors), (0, 1, 2))
+            self.assertIn('1 misses (0 expired, 2 errors)', str(cache))
+
+    def test_repeated_runs_fetch_once(self):
+        backend = CountingBackend()
+        source = MetadataSource()
+        source.backends = {backend.name: backend}
+        for _ in range(3):
+            source.configure('html', cache=MetadataCache(self.path))
+            self.assertEqual([source.fetch(i) for i in (1, 2, 404)], [gallery(1), gallery(2), None])
+            source.close()
+        # a gallery that could not be fetched is asked for again
+        self.assertEqual(backend.fetched, [1, 2, 404, 404, 404])
+
+    def test_parse_duration(self):
+        self.assertEqual([parse_duration(i) for i in ('90', '30m', '12h', '7d', '1.5D')],
+                         [90, 1800, 43200, 604800, 129600])
+
+
+if __name__ == '__main__':
+    unittest.main()
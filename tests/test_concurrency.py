@@ -0,0 +1,65 @@
+import asyncio
+import unittest
+
+from nhentai.concurrency import AdaptiveLimiter, HedgeBudget
+
+
+class TestAdaptiveLimiter(unittest.TestCase):
+    def test_limit_grows_while_latency_is_flat(self):
+        limiter = AdaptiveLimiter(5, maximum=15)
+        for _ in range(100):
+            limiter.record(0.1, status=200)
+        self.assertGreater(limiter.limit, 5)
+        self.assertLessEqual(limiter.limit, 15)
+
+    def test_backoff_on_throttling(self):
+        limiter = AdaptiveLimiter(12, maximum=15)
+        limiter.record(0.1, status=429)
+        self.assertEqual(limiter.limit, 6)
+        # only one backoff per window
+        limiter.record(0.1, timeout=True)
+        self.assertEqual(limiter.limit, 6)
+        self.assertEqual(limiter.throttled, 2)
+
+    def test_fixed_limit(self):
+        limiter = AdaptiveLimiter(5, maximum=15, adaptive=False)
+        for _ in range(50):
+            limiter.record(0.1, status=200)
+        limiter.record(0.1, status=503)
+        self.assertEqual(limiter.limit, 5)
+
+    def test_concurrency_is_bounded(self):
+        limiter = AdaptiveLimiter(3, adaptive=False)
+        peak = 0
+
+        async def work():
+            nonlocal peak
+            async with limiter:
+                peak = max(peak, limiter.in_flight)
+                await asyncio.sleep(0.01)
+
+        async def run():
+            await asyncio.gather(*(work() for _ in range(20)))
+
+        asyncio.run(run())
+        self.assertEqual(peak, 3)
+
+
+class TestHedgeBudget(unittest.TestCase):
+    def test_delay_needs_samples(self):
+        budget = HedgeBudget(percentile=90, min_samples=20)
+        self.assertIsNone(budget.delay([0.1] * 10))
+        self.assertEqual(budget.delay([i / 100 for i in range(100)]), 0.9)
+
+    def test_budget_is_bounded(self):
+        budget = HedgeBudget(ratio=0.1, burst=2)
+        spent = 0
+        for _ in range(100):
+            budget.delay([0.1] * 20)
+            spent += budget.spend()
+        self.assertLessEqual(spent, 12)
+        self.assertEqual(spent, budget.hedges)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+import argparse
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from nhentai.coordinator import Coordinator, RemoteJobQueue
+from nhentai.daemon import is_local
+from nhentai.jobs import JobQueue, DONE, FAILED
+from nhentai.workers import Shard
+
+
+class TestCoordinator(unittest.TestCase):
+    def setUp(self) -> None:
+        self.folder = tempfile.mkdtemp()
+        self.jobs = JobQueue(os.path.join(self.folder, 'history.sqlite3'))
+        self.addCleanup(self.jobs.close)
+        self.jobs.enqueue(range(1, 21))
+        self.downloaded = []
+
+        self.coordinator = Coordinator('127.0.0.1:0', self.jobs, total=20)
+        self.coordinator.listen()
+        self.url = 'http://%s:%d' % self.coordinator.server.server_address
+        self.serving = threading.Thread(target=self.coordinator.serve)
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def work(self, owner):
+        with RemoteJobQueue(self.url) as jobs:
+            downloader = argparse.Namespace(pages_saved=0, received_bytes=0)
+
+            def run_batch(ids):
+                for doujinshi_id in ids:
+                    time.sleep(0.005)
+                    self.downloaded.append(doujinshi_id)
+                    downloader.pages_saved += 2
+                    downloader.received_bytes += 2000
+                    jobs.update(doujinshi_id, FAILED if doujinshi_id == 13 else DONE, 'no gallery metadata')
+
+            Shard(jobs, downloader, owner=owner, batch=3, lease=2).run(run_batch)
+
+    def test_workers_drain_the_queue(self):
+        self.serving.start()
+        workers = [threading.Thread(target=self.work, args=(f'host-{i}:1',)) for i in range(3)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join(10)
+        # serving stops on its own once the queue is drained and the workers left
+        self.serving.join(10)
+        self.assertFalse(self.serving.is_alive())
+
+        self.assertEqual(sorted(self.downloaded), list(range(1, 21)))
+        self.assertEqual((self.jobs.counts()[DONE], self.jobs.failures()), (19, [(13, 'no gallery metadata')]))
+        self.assertEqual(sum(worker['bytes'] for worker in self.jobs.workers()), 40000)
+
+    def test_invalid_calls(self):
+        jobs = RemoteJobQueue(self.url)
+        self.addCleanup(jobs.close)
+        threading.Thread(target=self.coordinator.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.coordinator.server.server_close)
+        self.addCleanup(self.coordinator.server.shutdown)
+
+        with self.assertRaises(ValueError):
+            jobs.update(1, 'exploded')
+        with self.assertRaises(ValueError):
+            jobs.call('claim', owner='a', everything=True)
+        self.assertEqual(jobs.claim('a', count=1000), list(range(1, 21)))
+        self.assertEqual(self.coordinator.workers(), ['a'])
+
+    def test_token(self):
+        self.coordinator.server.server_close()
+        self.coordinator = Coordinator('127.0.0.1:0', self.jobs, total=20, token='s3cret')
+        self.coordinator.listen()
+        self.url = 'http://%s:%d' % self.coordinator.server.server_address
+        threading.Thread(target=self.coordinator.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.coordinator.server.server_close)
+        self.addCleanup(self.coordinator.server.shutdown)
+
+        for token in (None, 'guess'):
+            with RemoteJobQueue(self.url, token=token) as jobs:
+                with self.assertRaises(PermissionError):
+                    jobs.claim('a')
+                self.assertEqual(jobs.client.get(f'{self.url}/status').status_code, 401)
+        self.assertEqual((self.jobs.pending(), self.coordinator.workers()), (20, []))
+
+        with RemoteJobQueue(self.url, token='s3cret') as jobs:
+            self.assertEqual(jobs.claim('a', count=2), [1, 2])
+            self.assertEqual(jobs.client.get(f'{self.url}/status').json()['active'], ['a'])
+
+    def test_is_local(self):
+        self.assertEqual([is_local(address) for address in ('127.0.0.1:7381', 'localhost:7381', ':7381', '[::1]:7381',
+                                                            'unix:/tmp/nhentai.sock', '0.0.0.0:7381',
+                                                            '192.168.1.10:7381', 'example.com:7381')],
+                         [True, True, True, True, True, False, False, False])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,167 @@
+import argparse
+import http.client
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+from nhentai.daemon import Daemon, create_server, job_options, DONE, FAILED
+
+
+class StandInDownloader(object):
+    def __init__(self):
+        self.pages_saved = 0
+        self.received_bytes = 0
+        self.transport = argparse.Namespace(stats='0 requests')
+        self.limiter = '5 concurrent'
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path):
+        super().__init__('localhost')
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+
+
+def daemon_options():
+    return argparse.Namespace(id=None, keyword=None, favorites=False, artist=None, is_download=False,
+                              page=None, page_all=False, sorting='popular', output_dir='.')
+
+
+class TestJobOptions(unittest.TestCase):
+    def test_sources(self):
+        options = job_options(daemon_options(), {'ids': ['1', 2]})
+        self.assertEqual((options.id, options.is_download), ([1, 2], True))
+
+        options = job_options(daemon_options(), {'search': 'tag:full color', 'page': '1-3', 'sorting': 'recent'})
+        self.assertEqual((options.keyword, options.page, options.sorting, options.id),
+                         ('tag:full color', '1-3', 'recent', None))
+
+    def test_invalid(self):
+        for request in ({}, [], {'ids': []}, {'ids': ['x']}, {'search': 'a', 'sorting': 'random'}):
+            with self.assertRaises(ValueError):
+                job_options(daemon_options(), request)
+
+
+class TestDaemon(unittest.TestCase):
+    def setUp(self) -> None:
+        self.downloader = StandInDownloader()
+        self.release = threading.Event()
+
+    def run_job(self, options):
+        # the first job is held back so the second one can be seen waiting behind it
+        self.release.wait(5)
+        self.downloader.pages_saved += len(options.id) * 3
+        self.downloader.received_bytes += len(options.id) * 3000
+        if 13 in options.id:
+            raise RuntimeError('metadata server went away')
+        return options.id, [i for i in options.id if i == 2]
+
+    def start(self, address, token=None):
+        daemon = Daemon(address, daemon_options(), self.downloader, self.run_job, token=token)
+        daemon.listen()
+        thread = threading.Thread(target=daemon.serve, daemon=True)
+        thread.start()
+        self.addCleanup(thread.join, 5)
+        self.addCleanup(daemon.stop)
+        return daemon
+
+    def request(self, connection, method, path, body=None, headers=None):
+        connection.request(method, path, body=None if body is None else json.dumps(body), headers=headers or {})
+        response = connection.getresponse()
+        return response.status, json.loads(response.read())
+
+    def wait(self, connection, job_id):
+        for _ in range(100):
+            status, job = self.request(connection, 'GET', f'/jobs/{job_id}')
+            if job['state'] in (DONE, FAILED):
+                return job
+            time.sleep(0.05)
+        self.fail(f'job {job_id} did not finish')
+
+    def test_jobs_over_http(self):
+        daemon = self.start('127.0.0.1:0')
+        connection = http.client.HTTPConnection(*daemon.server.server_address)
+
+        self.assertEqual(self.request(connection, 'POST', '/jobs', {'ids': [1, 2]})[0], 201)
+        status, second = self.request(connection, 'POST', '/jobs', {'ids': [13]})
+        self.assertEqual((status, second['state']), (201, 'queued'))
+        self.release.set()
+
+        first = self.wait(connection, 1)
+        self.assertEqual((first['state'], first['doujinshi'], first['failed'], first['pages'], first['bytes']),
+                         (DONE, 2, [2], 6, 6000))
+        self.assertGreater(first['pages_per_second'], 0)
+
+        second = self.wait(connection, 2)
+        self.assertEqual((second['state'], second['error'], second['pages']),
+                         (FAILED, 'RuntimeError: metadata server went away', 3))
+
+        self.assertEqual(self.request(connection, 'POST', '/jobs', {'page': '1'})[0], 400)
+        self.assertEqual(self.request(connection, 'GET', '/jobs/9')[0], 404)
+        status, jobs = self.request(connection, 'GET', '/jobs')
+        self.assertEqual([job['id'] for job in jobs], [1, 2])
+        status, summary = self.request(connection, 'GET', '/status')
+        self.assertEqual((summary['jobs'], summary['pages']),
+                         ({'queued': 0, 'running': 0, 'done': 1, 'failed': 1}, 9))
+        connection.close()
+
+    def test_jobs_over_unix_socket(self):
+        path = os.path.join(tempfile.mkdtemp(), 'nhentai.sock')
+        self.addCleanup(os.rmdir, os.path.dirname(path))
+        self.start(f'unix:{path}')
+        self.release.set()
+
+        connection = UnixHTTPConnection(path)
+        self.assertEqual(self.request(connection, 'POST', '/jobs', {'ids': [5]})[0], 201)
+        self.assertEqual(self.wait(connection, 1)['pages'], 3)
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+        connection.close()
+
+    def test_token(self):
+        daemon = self.start('127.0.0.1:0', token='s3cret')
+        self.release.set()
+        connection = http.client.HTTPConnection(*daemon.server.server_address)
+        self.addCleanup(connection.close)
+
+        for headers in ({}, {'X-Daemon-Token': 'guess'}):
+            self.assertEqual(self.request(connection, 'POST', '/jobs', {'ids': [1]}, headers)[0], 401)
+            self.assertEqual(self.request(connection, 'GET', '/status', headers=headers)[0], 401)
+        self.assertEqual(daemon.list_jobs(), [])
+        self.assertEqual(self.request(connection, 'POST', '/jobs', {'ids': [1]}, {'X-Daemon-Token': 's3cret'})[0], 201)
+
+    def test_socket_path_in_use(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        path = os.path.join(folder, 'nhentai.sock')
+
+        # a file that is not a socket is left alone
+        with open(path, 'w') as f:
+            f.write('keep me')
+        with self.assertRaises(ValueError):
+            create_server(f'unix:{path}')
+        with open(path) as f:
+            self.assertEqual(f.read(), 'keep me')
+        os.remove(path)
+
+        # so is the socket of a server that is still running
+        server = create_server(f'unix:{path}')
+        with self.assertRaises(ValueError):
+            create_server(f'unix:{path}')
+        server.server_close()
+
+        # while the socket it left behind once it stopped is replaced
+        server = create_server(f'unix:{path}')
+        server.server_close()
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    unittest.main()
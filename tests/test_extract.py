@@ -0,0 +1,148 @@
+import glob
+import os
+import random
+import unittest
+
+from nhentai.extract import GalleryTreeBuilder, read_gallery_page, scan_gallery_page, soup_gallery_page
+from nhentai.parser import parse_doujinshi_page
+
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+
+def read_fixture(name):
+    with open(os.path.join(FIXTURES, name), 'rb') as f:
+        return f.read()
+
+
+def built_gallery_page(content):
+    """ What the tree builder alone reads, scan_gallery_page falls back to the soup on some pages. """
+    builder = GalleryTreeBuilder()
+    builder.feed(content)
+    builder.close()
+    return read_gallery_page(builder.document)
+
+
+def outcome(extract, content):
+    try:
+        return vars(extract(content))
+    except Exception as e:
+        return type(e)
+
+
+INSERTS = ('"', "'", '<', '>', '/', '=', '&', ';', ' ', '\n', '<pre>', '<script>', '<![CDATA[', '<!--', '&#x4', '&#150',
+           '&amp', '&ampE', '<br>', '</br>', '<img/>', '<template>', '</div>', '</span>', '<?x>', '<!x>',
+           '<div class="thumb-container">')
+
+
+def mutate(content, rng):
+    """ The page with a few pieces of broken markup where doujinshi_parser reads it. """
+    start, end = content.index('<div id="info"') - 500, content.rindex('thumb-container') + 500
+    for _ in range(rng.randint(1, 3)):
+        i = rng.randrange(start, end)
+        change = rng.randrange(4)
+        if change == 0:
+            content = content[:i] + rng.choice(INSERTS) + content[i:]
+        elif change == 1:
+            content = content[:i] + content[i + rng.randint(1, 20):]
+        elif change == 2:
+            j = i + rng.randint(1, 40)
+            content = content[:j] + content[i:j] + content[j:]
+        else:
+            tag = content.find('<', i)
+            content = content[:tag] + content[content.find('>', tag) + 1:]
+    return content
+
+
+class TestScanGalleryPage(unittest.TestCase):
+    def test_same_doujinshi_as_the_soup(self):
+        fixtures = sorted(glob.glob(os.path.join(FIXTURES, 'gallery-*.html')))
+        self.assertTrue(fixtures)
+        for fixture in fixtures:
+            with self.subTest(fixture=os.path.basename(fixture)):
+                with open(fixture, 'rb') as f:
+                    content = f.read()
+                self.assertEqual(parse_doujinshi_page(1, content, scan_gallery_page),
+                                 parse_doujinshi_page(1, content, soup_gallery_page))
+
+    def test_gallery(self):
+        doujinshi = parse_doujinshi_page(177013, read_fixture('gallery-webp.html'))
+        self.assertEqual(doujinshi['name'], '(C103) [Circle & Friends (Tanaka)] Sensei to "Issho" ni '
+                                            '(Blue Archive) [Chinese]')
+        self.assertEqual(doujinshi['subtitle'], '(C103) [サークル&フレンズ (田中)] 先生と「いっしょ」に (ブルーアーカイブ)')
+        self.assertEqual((doujinshi['img_id'], doujinshi['pages'], doujinshi['favorite_counts']), ('3191123', 40, 1203))
+        self.assertEqual(doujinshi['ext'][:7], ['webp'] * 6 + ['png'])
+        self.assertEqual(doujinshi['groups'], 'circle & friends')
+        self.assertEqual(doujinshi['date'], '2024-01-02T08:00:01.000001+00:00')
+
+    def test_malformed_markup(self):
+        # unclosed and stray tags, markup in scripts and attributes, comments, upper case and entities
+        content = '''<html><body>
+            <script>document.write('<div id="info"><h1>fake</h1>')</script>
+            <DIV ID="cover"><A HREF="/g/1/1/"><IMG TITLE="a > b"
+            DATA-SRC="https://t.nhentai.net/galleries/12/cover.png"></a></div></span>
+            <div id="info"><h1>Title <b>bold</h1> tail</h1><h2></h2>
+            <p>text<div class="tag-container field-name">Tags:<span class="tags"><a class="tag"><span
+            class="name">a &amp; b<span class="count">1K</span></span></a><a class="tag"><span class="name">c
+            </span></a></span></div></p>
+            <div class="field-name"><!-- Artists: --><a class="tag"><span class="name">x</span></a></div>
+            <div class="thumb-container"><img src="1t.jpg"></div>
+            <div class="thumb-container"><img data-src="https://t.nhentai.net/galleries/12/2t.webp.webp"></div>
+            </body></html>'''
+        self.assertEqual(parse_doujinshi_page(1, content, scan_gallery_page),
+                         parse_doujinshi_page(1, content, soup_gallery_page))
+        page = scan_gallery_page(content)
+        self.assertEqual((page.title, page.subtitle, page.cover_src),
+                         ('Title bold', '', 'https://t.nhentai.net/galleries/12/cover.png'))
+        self.assertEqual(page.fields, [('Tags', ['a & b', 'c']), ('Artists', ['x'])])
+        self.assertEqual(page.thumbs, [None, 'https://t.nhentai.net/galleries/12/2t.webp.webp'])
+
+        info = '<div id="info"><h1>%s</h1><div class="tag-container field-name">Pages: <span class="name">%s</span>' \
+               '</div><div class="field-name">%s<a class="tag"><span class="name">x</span></a></div></div>%s'
+        for content in (
+                # a page count with more than its text in it has no string
+                info % ('t', '1<b>2</b>', 'Tags:', ''),
+                info % ('t', '<b>12</b>', 'Tags:', ''),
+                # CDATA is text, and a node of its own
+                info % ('a<![CDATA[x > y]]>b', '<![CDATA[12]]>', '<![CDATA[Tags:]]>', ''),
+                # only whole entity names are replaced, whitespace between tags is squeezed
+                info % ('&ampE &amp;E &foo; &notin &copy2<b>\n  </b>', '12', 'Tags:', ''),
+                # the first image of nested thumbnails is the first one of both
+                info % ('t', '12', 'Tags:', '<div class="thumb-container"><div class="thumb-container">'
+                                            '<img data-src="b.jpg"></div></div>')):
+            with self.subTest(content=content):
+                self.assertEqual(vars(scan_gallery_page(content)), vars(soup_gallery_page(content)))
+        self.assertEqual(scan_gallery_page(info % ('&ampE &amp;E<b>\n  </b>', '12', '', '')).title, '&ampE &E\n')
+
+        # a tag without a name fails the walk over either tree
+        content = info % ('t', '12', 'Tags:<a class="tag"><span class="count">1</span></a>', '')
+        for extract in (soup_gallery_page, scan_gallery_page, built_gallery_page):
+            with self.assertRaises(AttributeError):
+                extract(content)
+
+    def test_broken_tags(self):
+        page = '<div id="info"><h1 class="title"">%s</h1></div><div id="cover"><a><img data-src="%s"></a></div>'
+        for content in (page % ('Title', 'cover.jpg'), page % ('<span class=pretty>T</span>itle', 'cover.jpg"'),
+                        page.replace('"info"', '"info" / x=\'\'\'') % ('Ti<br/>tle</br>', '"cover.jpg')):
+            with self.subTest(content=content):
+                self.assertEqual(vars(built_gallery_page(content)), vars(soup_gallery_page(content)))
+        self.assertEqual(built_gallery_page(page % ('Title', 'cover.jpg')).title, 'Title')
+
+    def test_same_as_the_soup_on_broken_pages(self):
+        rng = random.Random(23)
+        for name, count in (('gallery-short.html', 60), ('gallery-webp.html', 60), ('gallery-177013.html', 20)):
+            fixture = read_fixture(name).decode('utf-8')
+            for _ in range(count):
+                content = mutate(fixture, rng)
+                with self.subTest(fixture=name, content=content):
+                    self.assertEqual(outcome(built_gallery_page, content), outcome(soup_gallery_page, content))
+
+    def test_missing_parts(self):
+        for content in ('<div id="cover"></div>', '<div id="info"></div>',
+                        '<div id="info"><h1>t</h1></div><div id="cover"><a><img src="x"></a></div>'):
+            with self.subTest(content=content):
+                self.assertIsNone(parse_doujinshi_page(1, content, scan_gallery_page))
+
+
+if __name__ == '__main__':
+    unittest.main()
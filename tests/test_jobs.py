@@ -0,0 +1,53 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from nhentai.jobs import JobQueue, METADATA, DOWNLOADING, DONE, FAILED
+
+
+class TestJobQueue(unittest.TestCase):
+    def setUp(self) -> None:
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'history.sqlite3')
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def test_enqueue_skips_done(self):
+        # a doujinshi in the download history of an older version counts as done
+        with sqlite3.connect(self.path) as conn:
+            conn.execute('CREATE TABLE download_history (id text)')
+            conn.execute('INSERT INTO download_history VALUES (?)', ['7'])
+
+        with JobQueue(self.path) as jobs:
+            self.assertEqual(jobs.enqueue([5, 7, 3, 5]), [5, 3])
+            jobs.update(5, DONE)
+            self.assertEqual(jobs.enqueue(['3', 9, 5]), [3, 9])
+            self.assertEqual(jobs.counts()['queued'], 2)
+
+    def test_picks_up_after_a_crash(self):
+        jobs = JobQueue(self.path)
+        jobs.enqueue([1, 2, 3, 4])
+        jobs.update(1, METADATA)
+        jobs.update(1, DONE)
+        jobs.update(2, METADATA)
+        jobs.update(2, DOWNLOADING)
+        jobs.update(3, METADATA)
+        jobs.update(3, FAILED, 'no gallery metadata')
+        # the process dies without closing the queue
+
+        with JobQueue(self.path) as jobs:
+            self.assertEqual(jobs.unfinished(), [2, 3, 4])
+            self.assertEqual(jobs.get(2), {'state': DOWNLOADING, 'attempts': 1, 'error': None})
+            self.assertEqual(jobs.get(3), {'state': FAILED, 'attempts': 1, 'error': 'no gallery metadata'})
+            jobs.update(3, METADATA)
+            self.assertEqual(jobs.get(3)['attempts'], 2)
+
+            jobs.clear()
+            self.assertEqual(jobs.unfinished(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
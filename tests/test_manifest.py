@@ -0,0 +1,69 @@
+import os
+import tempfile
+import unittest
+
+from nhentai.manifest import PageManifest, directory_manifest_path, file_digest
+
+
+class TestPageManifest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.folder = tempfile.mkdtemp()
+        self.page = os.path.join(self.folder, '01.jpg')
+        with open(self.page, 'wb') as f:
+            f.write(b'\xff\xd8\xff' + b'\x00' * 100)
+
+    def digest(self, filename, size):
+        path = os.path.join(self.folder, filename)
+        if not os.path.exists(path):
+            return None
+        return os.path.getsize(path), file_digest(path)
+
+    def test_completed_pages_survive_reload(self):
+        manifest = PageManifest(directory_manifest_path(self.folder))
+        manifest.record('01', '01.jpg', os.path.getsize(self.page), file_digest(self.page))
+
+        manifest = PageManifest(directory_manifest_path(self.folder))
+        self.assertTrue(manifest.is_complete('01', self.digest))
+        self.assertFalse(manifest.is_complete('02', self.digest))
+
+    def test_corrupt_page_is_not_complete(self):
+        manifest = PageManifest(directory_manifest_path(self.folder))
+        manifest.record('01', '01.jpg', os.path.getsize(self.page), file_digest(self.page))
+        with open(self.page, 'r+b') as f:
+            f.write(b'\x00')
+        self.assertFalse(manifest.is_complete('01', self.digest))
+
+    def test_missing_page_is_not_complete(self):
+        manifest = PageManifest(directory_manifest_path(self.folder))
+        manifest.record('01', '01.jpg', os.path.getsize(self.page), file_digest(self.page))
+        os.remove(self.page)
+        self.assertFalse(manifest.is_complete('01', self.digest))
+
+    def test_pages_are_appended(self):
+        path = directory_manifest_path(self.folder)
+        manifest = PageManifest(path)
+        for page in ('01', '02', '01'):
+            manifest.record(page, f'{page}.jpg', 10, page)
+        manifest.close()
+        with open(path) as f:
+            self.assertEqual(len(f.readlines()), 3)
+
+        # a crash in the middle of a line loses that line only
+        with open(path, 'a') as f:
+            f.write('{"page":"03","filename":"03.j')
+        manifest = PageManifest(path)
+        self.assertEqual(manifest.pages, {'01': {'filename': '01.jpg', 'size': 10, 'sha1': '01'},
+                                          '02': {'filename': '02.jpg', 'size': 10, 'sha1': '02'}})
+        # replaced and torn lines are dropped when the manifest is opened
+        with open(path) as f:
+            self.assertEqual(len(f.readlines()), 2)
+
+    def test_clear(self):
+        manifest = PageManifest(directory_manifest_path(self.folder))
+        manifest.record('01', '01.jpg', os.path.getsize(self.page), file_digest(self.page))
+        manifest.clear()
+        self.assertEqual(os.listdir(self.folder), ['01.jpg'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+import json
+import os
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from nhentai import constant
+from nhentai.metadata import BackendUnavailable, MetadataBackend, MetadataSource, parse_gallery
+
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
+GALLERY_ID = 551234
+
+
+def read_fixture(name):
+    with open(os.path.join(FIXTURES, name), 'rb') as f:
+        return f.read()
+
+
+class SiteHandler(BaseHTTPRequestHandler):
+    """ The gallery API and the gallery pages of a single doujinshi, the API can be switched off. """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        if self.path == f'/api/gallery/{GALLERY_ID}':
+            if self.server.api:
+                return self.reply(200, 'application/json', read_fixture('gallery-webp.json'))
+            return self.reply(404, 'text/html', b'<html><body>404 - Not Found</body></html>')
+        if self.path.startswith('/api/gallery/'):
+            return self.reply(404, 'application/json', b'{"error": "does not exist"}')
+        if self.path == f'/g/{GALLERY_ID}/':
+            return self.reply(200, 'text/html', read_fixture('gallery-webp.html'))
+        self.reply(404, 'text/html', b'<html><body>404 - Not Found</body></html>')
+
+    def reply(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestMetadataSource(unittest.TestCase):
+    def setUp(self) -> None:
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), SiteHandler)
+        self.server.api = True
+        self.server.requests = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        site = f'http://127.0.0.1:{self.server.server_address[1]}'
+        self.urls = constant.DETAIL_URL, constant.API_DETAIL_URL, constant.CONFIG['proxy']
+        constant.DETAIL_URL, constant.API_DETAIL_URL = f'{site}/g', f'{site}/api/gallery'
+        constant.CONFIG['proxy'] = ''
+        self.source = MetadataSource()
+
+    def tearDown(self) -> None:
+        constant.DETAIL_URL, constant.API_DETAIL_URL, constant.CONFIG['proxy'] = self.urls
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_backends_agree(self):
+        self.source.configure('html')
+        scraped = self.source.fetch(GALLERY_ID)
+        self.source.configure('api')
+        doujinshi = self.source.fetch(GALLERY_ID)
+
+        # the API has the upload time to the second only
+        self.assertEqual((doujinshi.pop('date'), scraped.pop('date')),
+                         ('2024-01-02T08:00:01+00:00', '2024-01-02T08:00:01.000001+00:00'))
+        self.assertEqual(doujinshi, scraped)
+        self.assertEqual(self.server.requests, [f'/g/{GALLERY_ID}/', f'/api/gallery/{GALLERY_ID}'])
+
+    def test_falls_back_to_the_pages(self):
+        self.assertEqual(self.source.current, 'api')
+        self.assertEqual(self.source.fetch(GALLERY_ID)['img_id'], '3191123')
+
+        # a missing gallery says nothing about the API
+        self.assertIsNone(self.source.fetch(1))
+        self.assertEqual(self.source.current, 'api')
+
+        self.server.api = False
+        self.assertEqual(self.source.fetch(GALLERY_ID)['img_id'], '3191123')
+        self.assertEqual(self.source.current, 'html')
+        # the API is not asked again for a while
+        self.assertEqual(self.source.fetch(GALLERY_ID)['pages'], 40)
+        self.assertEqual(self.server.requests, [f'/api/gallery/{GALLERY_ID}', '/api/gallery/1',
+                                                f'/api/gallery/{GALLERY_ID}', f'/g/{GALLERY_ID}/', f'/g/{GALLERY_ID}/'])
+
+        self.source.configure()
+        self.assertEqual(self.source.current, 'api')
+
+    def test_api_is_asked_again(self):
+        self.source = MetadataSource(reprobe=0.2)
+        self.server.api = False
+        self.assertEqual(self.source.fetch(GALLERY_ID)['pages'], 40)
+        self.server.api = True
+        self.assertEqual(self.source.fetch(GALLERY_ID)['pages'], 40)
+        self.assertEqual(self.source.current, 'html')
+
+        time.sleep(0.25)
+        self.assertEqual(self.source.current, 'api')
+        self.assertEqual(self.source.fetch(GALLERY_ID)['pages'], 40)
+        self.assertEqual((self.source.current, self.source.unavailable), ('api', {}))
+        self.assertEqual(self.server.requests, [f'/api/gallery/{GALLERY_ID}', f'/g/{GALLERY_ID}/', f'/g/{GALLERY_ID}/',
+                                                f'/api/gallery/{GALLERY_ID}'])
+
+    def test_chosen_backend_does_not_fall_back(self):
+        self.server.api = False
+        self.source.configure('api')
+        self.assertIsNone(self.source.fetch(GALLERY_ID))
+        self.assertEqual(self.source.current, 'api')
+        self.assertEqual(self.server.requests, [f'/api/gallery/{GALLERY_ID}'])
+
+        with self.assertRaises(ValueError):
+            self.source.configure('lxml')
+
+    def test_backend_needs_fetch(self):
+        class HalfBackend(MetadataBackend):
+            name = 'half'
+
+        with self.assertRaises(TypeError):
+            HalfBackend()
+
+
+class TestParseGallery(unittest.TestCase):
+    def test_gallery(self):
+        doujinshi = parse_gallery(GALLERY_ID, json.loads(read_fixture('gallery-webp.json')))
+        self.assertEqual(doujinshi['ext'][5:8], ['webp', 'png', 'webp'])
+        self.assertEqual((doujinshi['characters'], doujinshi['groups']), ('hina sorasaki, sensei', 'circle & friends'))
+
+    def test_unexpected_format(self):
+        for gallery in ({'error': 'rate limited'}, {'media_id': '1', 'images': {'pages': None}},
+                        {'media_id': '1', 'images': {'pages': []}, 'tags': [{'type': 'tag'}]}):
+            with self.subTest(gallery=gallery):
+                with self.assertRaises(BackendUnavailable):
+                    parse_gallery(1, gallery)
+
+
+if __name__ == '__main__':
+    unittest.main()
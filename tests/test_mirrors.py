@@ -0,0 +1,46 @@
+import os
+import tempfile
+import unittest
+
+from nhentai.mirrors import MirrorScoreboard
+
+HOSTS = ['https://i1.example', 'https://i2.example', 'https://i3.example']
+
+
+class TestMirrorScoreboard(unittest.TestCase):
+    def test_prefers_faster_host(self):
+        board = MirrorScoreboard(hosts=HOSTS)
+        for _ in range(5):
+            board.started(HOSTS[0])
+            board.record(HOSTS[0], 0.8, ok=True)
+            board.started(HOSTS[1])
+            board.record(HOSTS[1], 0.1, ok=True)
+        self.assertEqual(board.route()[0], HOSTS[1])
+
+    def test_load_is_spread(self):
+        board = MirrorScoreboard(hosts=HOSTS)
+        first = board.route()[0]
+        board.started(first)
+        self.assertNotEqual(board.route()[0], first)
+
+    def test_failing_host_is_skipped(self):
+        board = MirrorScoreboard(hosts=HOSTS, failure_threshold=3)
+        for _ in range(3):
+            board.started(HOSTS[0])
+            board.record(HOSTS[0], 0.1, ok=False)
+        self.assertNotIn(HOSTS[0], board.route())
+
+    def test_persisted(self):
+        path = os.path.join(tempfile.mkdtemp(), 'mirrors.json')
+        board = MirrorScoreboard(hosts=HOSTS, path=path)
+        board.started(HOSTS[2])
+        board.record(HOSTS[2], 0.05, ok=True)
+        board.save()
+
+        board = MirrorScoreboard(hosts=HOSTS, path=path)
+        self.assertEqual(board.stats[HOSTS[2]].successes, 1)
+        self.assertEqual(board.route()[0], HOSTS[2])
+
+
+if __name__ == '__main__':
+    unittest.main()
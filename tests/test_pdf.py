@@ -0,0 +1,148 @@
+import os
+import re
+import shutil
+import tempfile
+import unittest
+
+from PIL import Image
+
+from nhentai.downloader import DirectoryStorage
+from nhentai.pdf import png_data_chunks, write_pdf
+
+try:
+    import pypdf
+except ImportError:
+    pypdf = None
+
+
+def media_boxes(filename):
+    with open(filename, 'rb') as f:
+        data = f.read()
+
+    # every object the cross-reference table points at has to be where it says
+    xref = int(re.search(rb'startxref\n(\d+)\n%%EOF\n$', data).group(1))
+    entries = data[xref:].split(b'\n')[2:]
+    count = int(data[xref:].split(b'\n')[1].split()[1])
+    for object_id in range(1, count):
+        offset = int(entries[object_id][:10])
+        assert data[offset:].startswith(b'%d 0 obj' % object_id), object_id
+
+    return [tuple(float(i) for i in box.split()) for box in re.findall(rb'/MediaBox \[0 0 ([\d. ]+)\]', data)]
+
+
+class TestWritePdf(unittest.TestCase):
+    def setUp(self) -> None:
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def page(self, name, width, mode='RGB', color=None):
+        path = os.path.join(self.folder, name)
+        Image.new(mode, (width, 96), color).save(path)
+        return path
+
+    def test_pages_in_order(self):
+        pages = [self.page('1.jpg', 96), self.page('2.png', 192, 'RGBA'), self.page('3.gif', 48, 'P'),
+                 self.page('4.webp', 144, 'L')]
+        filename = os.path.join(self.folder, 'doujinshi.pdf')
+        write_pdf(filename, pages)
+
+        self.assertEqual(media_boxes(filename), [(72, 72), (144, 72), (36, 72), (108, 72)])
+        # JPEG pages are embedded without decoding them
+        with open(pages[0], 'rb') as page, open(filename, 'rb') as pdf:
+            self.assertIn(page.read(), pdf.read())
+
+    def test_png_data_is_embedded(self):
+        page = self.page('1.png', 96)
+        filename = os.path.join(self.folder, 'doujinshi.pdf')
+        write_pdf(filename, [page])
+
+        with open(page, 'rb') as f:
+            data = f.read()
+        (offset, length), = png_data_chunks(page)
+        with open(filename, 'rb') as pdf:
+            self.assertIn(data[offset:offset + length], pdf.read())
+        # a PNG with transparency has to be decoded
+        self.assertIsNone(png_data_chunks(self.page('2.png', 96, 'RGBA')))
+
+    @unittest.skipUnless(pypdf, 'Requires pypdf')
+    def test_read_by_a_pdf_parser(self):
+        pages = [self.page('1.jpg', 96, color=(200, 30, 40)), self.page('2.png', 192, color=(10, 120, 250)),
+                 self.page('3.png', 48, 'RGBA', (0, 200, 0, 255)), self.page('4.png', 144, 'L', 90)]
+        filename = os.path.join(self.folder, 'doujinshi.pdf')
+        write_pdf(filename, pages)
+
+        reader = pypdf.PdfReader(filename, strict=True)
+        self.assertEqual(len(reader.pages), 4)
+        filters = []
+        for page, width, color in zip(reader.pages, (96, 192, 48, 144),
+                                      ((200, 30, 40), (10, 120, 250), (0, 200, 0), 90)):
+            self.assertEqual((float(page.mediabox.width), float(page.mediabox.height)), (width * 0.75, 72))
+            xobjects = page['/Resources']['/XObject']
+            self.assertEqual(len(xobjects), 1)
+            xobject = list(xobjects.values())[0].get_object()
+            self.assertEqual((xobject['/Subtype'], xobject['/Width'], xobject['/Height']), ('/Image', width, 96))
+            filters.append(xobject['/Filter'])
+
+            # the embedded data decodes to the page
+            image, = page.images
+            pixel = image.image.getpixel((0, 0))
+            if isinstance(color, tuple):
+                # JPEG is lossy
+                for value, expected in zip(pixel, color):
+                    self.assertAlmostEqual(value, expected, delta=3)
+            else:
+                self.assertEqual((image.image.mode, pixel), ('L', color))
+        self.assertEqual(filters, ['/DCTDecode', '/FlateDecode', '/FlateDecode', '/FlateDecode'])
+
+    def test_failure_leaves_no_file(self):
+        broken = os.path.join(self.folder, '2.jpg')
+        with open(broken, 'wb') as f:
+            f.write(b'not an image')
+
+        filename = os.path.join(self.folder, 'doujinshi.pdf')
+        with self.assertRaises(OSError):
+            write_pdf(filename, [self.page('1.jpg', 96), broken])
+        self.assertFalse([name for name in os.listdir(self.folder) if '.pdf' in name])
+
+
+class TestPdfDuringDownload(unittest.TestCase):
+    def setUp(self) -> None:
+        self.folder = tempfile.mkdtemp()
+        self.gallery = os.path.join(self.folder, 'gallery')
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def store(self, storage, page, width):
+        path = os.path.join(self.gallery, f'{page}.jpg')
+        Image.new('RGB', (width, 96)).save(path)
+        storage.manifest.record(page, f'{page}.jpg', os.path.getsize(path), 'sha1')
+        return path
+
+    def test_stored_and_new_pages_in_order(self):
+        # page 1 is left by an earlier run, 2 and 3 finish out of order
+        self.store(DirectoryStorage(self.gallery), '1', 96)
+        storage = DirectoryStorage(self.gallery, pdf=f'{self.gallery}.pdf')
+        storage.expect(['2', '3'])
+        for page, width in (('3', 48), ('2', 192)):
+            storage.pdf.queue.put(('page', (page, self.store(storage, page, width))))
+        storage.close()
+
+        self.assertEqual(storage.generated, ['pdf'])
+        self.assertEqual(media_boxes(f'{self.gallery}.pdf'), [(72, 72), (144, 72), (36, 72)])
+
+    def test_failed_page_leaves_pdf_to_post_processing(self):
+        storage = DirectoryStorage(self.gallery, pdf=f'{self.gallery}.pdf')
+        storage.expect(['1', '2'])
+        storage.pdf.queue.put(('page', ('1', self.store(storage, '1', 96))))
+        storage.discard('2')
+        storage.close()
+
+        self.assertEqual(storage.generated, [])
+        self.assertFalse([name for name in os.listdir(self.folder) if '.pdf' in name])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+import asyncio
+import time
+import unittest
+
+from nhentai.ratelimit import RateLimiter, TokenBucket
+from nhentai.utils import parse_size
+
+
+class TestRateLimiter(unittest.TestCase):
+    def test_bucket_reservations(self):
+        bucket = TokenBucket(10, capacity=1)
+        self.assertEqual(bucket.reserve(), 0.0)
+        self.assertAlmostEqual(bucket.reserve(), 0.1, places=2)
+        self.assertAlmostEqual(bucket.reserve(), 0.2, places=2)
+
+    def test_requests_are_spaced_globally(self):
+        limiter = RateLimiter()
+        limiter.configure('image', requests_per_second=50)
+
+        async def worker():
+            for _ in range(5):
+                await limiter.async_wait('image')
+
+        async def run():
+            await asyncio.gather(*(worker() for _ in range(10)))
+
+        start = time.monotonic()
+        asyncio.run(run())
+        # 50 requests at 50 req/s with a burst of 50
+        self.assertLess(time.monotonic() - start, 0.5)
+
+        start = time.monotonic()
+        asyncio.run(run())
+        self.assertGreater(time.monotonic() - start, 0.8)
+
+    def test_bandwidth_debt(self):
+        limiter = RateLimiter()
+        limiter.configure('metadata', bytes_per_second=1000)
+        limiter.consumed('metadata', 1100)
+        start = time.monotonic()
+        limiter.wait('metadata')
+        self.assertGreater(time.monotonic() - start, 0.05)
+
+    def test_bandwidth_waiters_queue_up(self):
+        limiter = RateLimiter()
+        limiter.configure('image', bytes_per_second=1000000)
+        # a first response of 100 KB sets the estimate, what it did not use of the reservation is handed back
+        reservation = limiter.wait('image')
+        limiter.consumed('image', 100000, reservation)
+        limiter.settle(reservation)
+        self.assertAlmostEqual(limiter.classes['image'].bytes.tokens, 900000, delta=5000)
+        self.assertEqual(limiter.classes['image'].estimate, 100000)
+
+        limiter.consumed('image', 1000000)
+        woken = []
+
+        async def worker():
+            reservation = await limiter.async_wait('image')
+            woken.append(time.monotonic())
+            limiter.consumed('image', 100000, reservation)
+            limiter.settle(reservation)
+
+        async def run():
+            await asyncio.gather(*(worker() for _ in range(4)))
+
+        start = time.monotonic()
+        asyncio.run(run())
+        # each waiter sets aside a response worth of bandwidth, they are woken one after the other
+        for woke, expected in zip(woken, (0.2, 0.3, 0.4, 0.5)):
+            self.assertAlmostEqual(woke - start, expected, delta=0.05)
+
+    def test_unconfigured_class_is_unlimited(self):
+        limiter = RateLimiter()
+        start = time.monotonic()
+        for _ in range(100):
+            limiter.wait('metadata')
+        self.assertLess(time.monotonic() - start, 0.05)
+
+    def test_parse_size(self):
+        self.assertEqual(parse_size('512K'), 512 * 1024)
+        self.assertEqual(parse_size('2MB'), 2 * 1024 ** 2)
+        self.assertEqual(parse_size('1000'), 1000)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+import unittest
+
+import httpx
+
+from nhentai import constant
+from nhentai.downloader import IncompleteDownloadError
+from nhentai.retry import RetryPolicy, retry_policy, classify, parse_retry_after, \
+    TIMEOUT, CONNECTION, THROTTLED, SERVER, INCOMPLETE
+from nhentai.utils import request, session_manager
+
+
+class ScriptedResponse(object):
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.content = b''
+
+
+class ScriptedSession(object):
+    def __init__(self, responses):
+        self.headers = {}
+        self.responses = list(responses)
+        self.calls = 0
+
+    def get(self, url, **kwargs):
+        self.calls += 1
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    def close(self):
+        pass
+
+
+class TestRetryPolicy(unittest.TestCase):
+    def setUp(self):
+        self.retry_times = constant.RETRY_TIMES
+        constant.RETRY_TIMES = 3
+
+    def tearDown(self):
+        constant.RETRY_TIMES = self.retry_times
+
+    def test_classify(self):
+        self.assertEqual(classify(httpx.ReadTimeout('slow')), TIMEOUT)
+        self.assertEqual(classify(httpx.ConnectError('refused')), CONNECTION)
+        self.assertEqual(classify(IncompleteDownloadError('short')), INCOMPLETE)
+        self.assertEqual(classify(status=429), THROTTLED)
+        self.assertEqual(classify(status=503), THROTTLED)
+        self.assertEqual(classify(status=502), SERVER)
+        self.assertIsNone(classify(status=404))
+        self.assertIsNone(classify(ValueError('bad json')))
+
+    def test_parse_retry_after(self):
+        self.assertEqual(parse_retry_after('7'), 7.0)
+        self.assertEqual(parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT'), 0.0)
+        self.assertIsNone(parse_retry_after('soon'))
+        self.assertIsNone(parse_retry_after(None))
+
+    def test_delay_is_jittered_and_capped(self):
+        policy = RetryPolicy(base_delay=1, max_delay=4)
+        delays = [policy.delay(10) for _ in range(200)]
+        self.assertTrue(all(0 <= delay <= 4 for delay in delays))
+        self.assertGreater(len(set(delays)), 100)
+
+    def test_retry_after_is_honoured(self):
+        policy = RetryPolicy(base_delay=0.01, max_retry_after=60)
+        self.assertEqual(policy.delay(0, '20'), 20)
+        self.assertEqual(policy.delay(0, '3600'), 60)
+
+    def test_budgets_are_per_error_class(self):
+        policy = RetryPolicy(base_delay=0.01)
+        retry = policy.start('image')
+        for _ in range(3):
+            self.assertIsNotNone(retry.backoff(TIMEOUT))
+        self.assertIsNone(retry.backoff(TIMEOUT))
+        # throttling has its own, larger budget
+        for _ in range(6):
+            self.assertIsNotNone(retry.backoff(THROTTLED))
+        self.assertIsNone(retry.backoff(THROTTLED))
+        self.assertIsNone(retry.backoff(None))
+
+        self.assertEqual(policy.retries[('image', TIMEOUT)], 3)
+        self.assertEqual(policy.retries[('image', THROTTLED)], 6)
+        self.assertEqual(policy.failures['image'], 3)
+        self.assertIn('image 6 throttled, 3 timeout', str(policy))
+
+
+class TestRequestRetries(unittest.TestCase):
+    def setUp(self):
+        self.base_delay = retry_policy.base_delay
+        retry_policy.base_delay = 0.01
+        retry_policy.reset()
+
+    def tearDown(self):
+        retry_policy.base_delay = self.base_delay
+        retry_policy.reset()
+
+    def run_request(self, session):
+        previous = session_manager.replace(session)
+        try:
+            return request('get', 'http://127.0.0.1/g/1/')
+        finally:
+            session_manager.replace(previous)
+
+    def test_throttled_request_is_retried(self):
+        session = ScriptedSession([ScriptedResponse(429, {'Retry-After': '0'}),
+                                   httpx.ConnectError('reset'), ScriptedResponse(200)])
+        self.assertEqual(self.run_request(session).status_code, 200)
+        self.assertEqual(session.calls, 3)
+        self.assertEqual(retry_policy.retries[('metadata', THROTTLED)], 1)
+        self.assertEqual(retry_policy.retries[('metadata', CONNECTION)], 1)
+
+    def test_not_found_is_not_retried(self):
+        session = ScriptedSession([ScriptedResponse(404)])
+        self.assertEqual(self.run_request(session).status_code, 404)
+        self.assertEqual(session.calls, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
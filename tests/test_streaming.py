@@ -0,0 +1,302 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from nhentai import constant
+from nhentai.downloader import CHUNK_SIZE, Downloader, IncompleteDownloadError
+from nhentai.manifest import PageManifest, directory_manifest_path
+
+
+def page_body(path):
+    # a JPEG header and bytes that differ from page to page, a few chunks long
+    return b'\xff\xd8\xff' + path.encode() * 16384
+
+
+class MirrorHandler(BaseHTTPRequestHandler):
+    """
+    Serves every path as a page, pages named 404.jpg are missing. A server with ``stall`` sends
+    the first half of a page and holds back the rest until its ``release`` event is set, a
+    ``delay`` holds back the whole answer. Paths in ``cut`` are cut off halfway the first time.
+
+    With ``ranges`` a Range header is answered with the rest of the page, starting ``shift``
+    bytes early and leaving out the last ``short`` bytes, or with a 416 when it is past the end.
+    A server with ``unsatisfiable`` answers every request with a 416.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        self.server.ranges_asked.append(self.headers.get('Range'))
+        body = page_body(self.path)
+        if self.path.endswith('/404.jpg'):
+            return self.reply(404)
+        if self.server.unsatisfiable:
+            return self.reply(416, {'Content-Range': f'bytes */{len(body)}'})
+        if self.server.delay:
+            self.server.release.wait(self.server.delay)
+
+        headers = {'Content-Type': 'image/jpeg'}
+        status, start, end = 200, 0, len(body)
+        if self.server.ranges and self.headers.get('Range'):
+            start = int(self.headers['Range'][len('bytes='):-len('-')])
+            if start >= len(body):
+                return self.reply(416, {'Content-Range': f'bytes */{len(body)}'})
+            status, start, end = 206, max(0, start - self.server.shift), len(body) - self.server.short
+            headers['Content-Range'] = f'bytes {start}-{end - 1}/{len(body)}'
+        body = body[start:end]
+
+        try:
+            self.reply(status, headers, len(body))
+            if self.path in self.server.cut:
+                self.server.cut.remove(self.path)
+                self.wfile.write(body[:len(body) // 2])
+                self.close_connection = True
+                return
+            if self.server.stall:
+                self.wfile.write(body[:len(body) // 2])
+                self.wfile.flush()
+                self.server.release.wait(5)
+                body = body[len(body) // 2:]
+            self.wfile.write(body)
+        except OSError:
+            # the client gave up on this answer
+            self.close_connection = True
+
+    def reply(self, status, headers=None, length=0):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(length))
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class StreamTestDownloader(Downloader):
+    # Downloader is a singleton, a subclass keeps this instance to the test
+    pass
+
+
+def start_mirror(stall=False, delay=0, cut=(), ranges=False, shift=0, short=0, unsatisfiable=False):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), MirrorHandler)
+    server.requests = []
+    server.ranges_asked = []
+    server.ranges = ranges
+    server.shift = shift
+    server.short = short
+    server.unsatisfiable = unsatisfiable
+    server.stall = stall
+    server.delay = delay
+    server.cut = set(cut)
+    server.release = threading.Event()
+    server.url = f'http://127.0.0.1:{server.server_address[1]}'
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class StreamingTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.servers = []
+        self.image_url, self.image_mirrors = constant.IMAGE_URL, constant.IMAGE_URL_MIRRORS
+        self.output = tempfile.mkdtemp()
+        self.downloader = None
+
+    def tearDown(self) -> None:
+        constant.IMAGE_URL, constant.IMAGE_URL_MIRRORS = self.image_url, self.image_mirrors
+        if self.downloader is not None:
+            self.downloader.shutdown()
+        for server in self.servers:
+            server.release.set()
+            server.shutdown()
+            server.server_close()
+        shutil.rmtree(self.output, ignore_errors=True)
+
+    def mirrors(self, *servers):
+        """ Serve the images from ``servers``, the first one is the main image host. """
+        self.servers.extend(servers)
+        constant.IMAGE_URL = f'{servers[0].url}/galleries'
+        constant.IMAGE_URL_MIRRORS = [f'{server.url}/galleries' for server in servers[1:]]
+
+    def new_downloader(self, **kwargs):
+        StreamTestDownloader._instances.pop(StreamTestDownloader, None)
+        self.downloader = StreamTestDownloader(path=self.output, **kwargs)
+        self.downloader.transport.proxy = ''
+        return self.downloader
+
+    def download(self, pages, folder='gallery'):
+        queue = [f'{constant.IMAGE_URL}/1/{page}' for page in pages]
+        self.downloader.start_download(queue, folder)
+        return os.path.join(self.output, folder)
+
+    def assertNoPartFiles(self, folder):
+        self.assertEqual([name for name in os.listdir(folder) if name.endswith('.part')], [])
+
+
+class TestStreaming(StreamingTestCase):
+    def test_pages_are_streamed_to_part_files(self):
+        server = start_mirror(stall=True)
+        self.mirrors(server)
+        self.new_downloader(threads=2)
+        folder = os.path.join(self.output, 'gallery')
+        body = page_body('/galleries/1/1.jpg')
+
+        download = threading.Thread(target=self.download, args=(['1.jpg'],))
+        download.start()
+        try:
+            part_path = os.path.join(folder, '.1.part')
+            deadline = time.monotonic() + 5
+            while time.monotonic() < deadline and not (os.path.exists(part_path)
+                                                       and os.path.getsize(part_path) >= CHUNK_SIZE):
+                time.sleep(0.01)
+            # the first chunks are on disk, the page itself only shows up once it is complete
+            with open(part_path, 'rb') as f:
+                written = f.read()
+            self.assertTrue(CHUNK_SIZE <= len(written) <= len(body) // 2)
+            self.assertEqual(written, body[:len(written)])
+            self.assertFalse(os.path.exists(os.path.join(folder, '1.jpg')))
+        finally:
+            server.release.set()
+            download.join()
+
+        with open(os.path.join(folder, '1.jpg'), 'rb') as f:
+            self.assertEqual(f.read(), body)
+        # with every page stored the page manifest is removed as well
+        self.assertEqual(os.listdir(folder), ['1.jpg'])
+        self.assertEqual(self.downloader.received_bytes, len(body))
+
+    def test_part_files_are_cleaned_up_after_errors(self):
+        server = start_mirror(cut=['/galleries/1/2.jpg'])
+        self.mirrors(server)
+        self.new_downloader(threads=2)
+
+        folder = self.download(['1.jpg', '2.jpg', '404.jpg'])
+
+        # the cut off page was requested again and written over
+        self.assertEqual(server.requests.count('/galleries/1/2.jpg'), 2)
+        for page in ('1.jpg', '2.jpg'):
+            with open(os.path.join(folder, page), 'rb') as f:
+                self.assertEqual(f.read(), page_body(f'/galleries/1/{page}'))
+        self.assertFalse(os.path.exists(os.path.join(folder, '404.jpg')))
+        self.assertNoPartFiles(folder)
+        # the manifest stays for the page still missing
+        self.assertEqual(sorted(PageManifest(directory_manifest_path(folder)).pages), ['1', '2'])
+
+
+class TestRangeResume(StreamingTestCase):
+    url = '/galleries/1/1.jpg'
+
+    def resume(self, part, **kwargs):
+        """ Download page 1 with ``part`` left in its part file by an earlier run. """
+        server = start_mirror(**kwargs)
+        self.mirrors(server)
+        self.new_downloader(threads=1)
+        folder = os.path.join(self.output, 'gallery')
+        os.makedirs(folder)
+        with open(os.path.join(folder, '.1.part'), 'wb') as f:
+            f.write(part)
+
+        self.download(['1.jpg'])
+        with open(os.path.join(folder, '1.jpg'), 'rb') as f:
+            self.assertEqual(f.read(), page_body(self.url))
+        self.assertNoPartFiles(folder)
+        return server
+
+    def test_rest_is_appended(self):
+        server = self.resume(page_body(self.url)[:1000], ranges=True)
+        self.assertEqual(server.ranges_asked, ['bytes=1000-'])
+        self.assertEqual(self.downloader.received_bytes, len(page_body(self.url)) - 1000)
+
+    def test_range_starting_elsewhere_is_not_appended(self):
+        server = self.resume(page_body(self.url)[:1000], ranges=True, shift=10)
+        # the part file was dropped and the whole page asked for again
+        self.assertEqual(server.ranges_asked, ['bytes=1000-', None])
+
+    def test_whole_page_replaces_the_part(self):
+        server = self.resume(b'stale bytes', ranges=False)
+        self.assertEqual(server.ranges_asked, ['bytes=11-'])
+        self.assertEqual(self.downloader.received_bytes, len(page_body(self.url)))
+
+    def test_part_longer_than_the_page_starts_over(self):
+        server = self.resume(page_body(self.url) + b'junk', ranges=True)
+        self.assertEqual(server.ranges_asked, [f'bytes={len(page_body(self.url)) + 4}-', None])
+
+    def test_complete_part_is_not_downloaded_again(self):
+        server = self.resume(page_body(self.url), ranges=True)
+        self.assertEqual(server.ranges_asked, [f'bytes={len(page_body(self.url))}-'])
+        self.assertEqual(self.downloader.received_bytes, 0)
+
+    def test_short_range_is_incomplete(self):
+        server = start_mirror(ranges=True, short=100)
+        self.mirrors(server)
+        downloader = self.new_downloader(threads=1)
+        part_path = os.path.join(self.output, '.1.part')
+        with open(part_path, 'wb') as f:
+            f.write(page_body(self.url)[:1000])
+
+        with self.assertRaises(IncompleteDownloadError):
+            downloader.run(downloader.fetch(f'{server.url}{self.url}', part_path))
+        # what did arrive stays for the next attempt
+        self.assertEqual(os.path.getsize(part_path), len(page_body(self.url)) - 100)
+
+    def test_unsatisfiable_range_is_started_over_once(self):
+        server = start_mirror(unsatisfiable=True)
+        self.mirrors(server)
+        downloader = self.new_downloader(threads=1)
+        part_path = os.path.join(self.output, '.1.part')
+        with open(part_path, 'wb') as f:
+            f.write(page_body(self.url)[:1000])
+
+        response, _ = downloader.run(downloader.fetch(f'{server.url}{self.url}', part_path))
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(server.ranges_asked, ['bytes=1000-', None])
+        self.assertFalse(os.path.exists(part_path))
+
+
+class TestHedgedFetch(StreamingTestCase):
+    def hedged_downloader(self, primary, backup):
+        downloader = self.new_downloader(threads=1, hedge=95, timeout=10)
+        # a page pending for longer than 50ms is hedged, and the primary host is tried first
+        downloader.mirrors.latencies.extend([0.05] * 20)
+        downloader.mirrors.stats[primary.url].latency = 0.01
+        downloader.mirrors.stats[backup.url].latency = 1.0
+        return downloader
+
+    def test_hedge_wins_over_a_stalled_host(self):
+        slow, fast = start_mirror(stall=True), start_mirror()
+        self.mirrors(slow, fast)
+        downloader = self.hedged_downloader(slow, fast)
+
+        folder = self.download(['1.jpg'])
+
+        self.assertEqual((downloader.hedge.hedges, downloader.hedge.wins), (1, 1))
+        self.assertEqual((slow.requests, fast.requests), (['/galleries/1/1.jpg'], ['/galleries/1/1.jpg']))
+        with open(os.path.join(folder, '1.jpg'), 'rb') as f:
+            self.assertEqual(f.read(), page_body('/galleries/1/1.jpg'))
+        # the stalled request was cancelled, its half written part file is gone
+        self.assertNoPartFiles(folder)
+        self.assertEqual(downloader.mirrors.stats[slow.url].in_flight, 0)
+        self.assertEqual(downloader.mirrors.stats[slow.url].failures, 0)
+
+    def test_primary_wins_over_a_slower_hedge(self):
+        primary, stalled = start_mirror(delay=0.3), start_mirror(stall=True)
+        self.mirrors(primary, stalled)
+        downloader = self.hedged_downloader(primary, stalled)
+
+        folder = self.download(['1.jpg'])
+
+        # the hedge was sent but lost the race
+        self.assertEqual((downloader.hedge.hedges, downloader.hedge.wins), (1, 0))
+        self.assertEqual(stalled.requests, ['/galleries/1/1.jpg'])
+        with open(os.path.join(folder, '1.jpg'), 'rb') as f:
+            self.assertEqual(f.read(), page_body('/galleries/1/1.jpg'))
+        self.assertNoPartFiles(folder)
+        self.assertEqual(downloader.mirrors.stats[stalled.url].in_flight, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
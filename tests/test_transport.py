@@ -0,0 +1,208 @@
+import asyncio
+import os
+import ssl
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from h2.config import H2Configuration
+from h2.connection import H2Connection
+from h2.events import RequestReceived
+
+from nhentai import constant
+from nhentai.downloader import Downloader
+from nhentai.transport import AsyncTransport
+from nhentai.utils import SessionManager, request, session_manager
+
+
+class ImageHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    body = b'\xff\xd8\xff' + b'\x00' * 1024
+    # set by a test to hold every response until it is set
+    gate = None
+
+    def do_GET(self):
+        if self.gate is not None:
+            self.gate.wait(10)
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, *args):
+        pass
+
+
+class Http2TestDownloader(Downloader):
+    # Downloader is a singleton, a subclass keeps this instance to the test
+    pass
+
+
+class TestTransport(unittest.TestCase):
+    def setUp(self) -> None:
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), ImageHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.base_url = f'http://127.0.0.1:{self.server.server_address[1]}'
+
+    def tearDown(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_connection_reuse(self):
+        transport = AsyncTransport(max_connections=2, proxy='')
+
+        async def fetch_all():
+            try:
+                for i in range(10):
+                    response = await transport.request('GET', f'{self.base_url}/galleries/1/{i}.jpg')
+                    self.assertEqual(response.status_code, 200)
+            finally:
+                await transport.aclose()
+
+        asyncio.run(fetch_all())
+        self.assertEqual(transport.stats.requests, 10)
+        self.assertEqual(transport.stats.connections, 1)
+        self.assertEqual(transport.stats.reused, 9)
+
+    def test_pool_is_not_capped_by_http2(self):
+        downloader = Http2TestDownloader(threads=30, http2=True)
+        self.assertEqual(downloader.transport.limits.max_connections, constant.MAX_HTTP2_THREADS)
+
+        # a plain HTTP host is served over HTTP/1.1, one connection per concurrent page
+        transport = downloader.transport
+        transport.proxy = ''
+        gate = threading.Event()
+        ImageHandler.gate = gate
+
+        async def fetch_all():
+            try:
+                pending = [asyncio.ensure_future(transport.request('GET', f'{self.base_url}/galleries/1/{i}.jpg'))
+                           for i in range(20)]
+                while transport.stats.connections < 20:
+                    await asyncio.sleep(0.01)
+                gate.set()
+                return await asyncio.gather(*pending)
+            finally:
+                await transport.aclose()
+
+        try:
+            responses = asyncio.run(asyncio.wait_for(fetch_all(), 10))
+        finally:
+            gate.set()
+            ImageHandler.gate = None
+        self.assertEqual({r.http_version for r in responses}, {'HTTP/1.1'})
+        self.assertEqual(transport.stats.connections, 20)
+
+
+class Http2Protocol(asyncio.Protocol):
+    """ Answers every HTTP/2 stream with ImageHandler's body. """
+
+    def __init__(self, server):
+        self.server = server
+        self.connection = H2Connection(H2Configuration(client_side=False))
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.server.connections += 1
+        self.transport = transport
+        self.connection.initiate_connection()
+        self.transport.write(self.connection.data_to_send())
+
+    def data_received(self, data):
+        for event in self.connection.receive_data(data):
+            if isinstance(event, RequestReceived):
+                self.connection.send_headers(event.stream_id, [(':status', '200'), ('content-type', 'image/jpeg'),
+                                                               ('content-length', str(len(ImageHandler.body)))])
+                self.connection.send_data(event.stream_id, ImageHandler.body, end_stream=True)
+        self.transport.write(self.connection.data_to_send())
+
+
+class Http2Server(object):
+    """ An HTTPS server that only speaks HTTP/2, with the self-signed localhost certificate of the fixtures. """
+
+    def __init__(self):
+        self.connections = 0
+        context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        context.load_cert_chain(os.path.join(os.path.dirname(__file__), 'fixtures', 'localhost.pem'))
+        context.set_alpn_protocols(['h2'])
+        self.loop = asyncio.new_event_loop()
+        self.server = self.loop.run_until_complete(
+            self.loop.create_server(lambda: Http2Protocol(self), '127.0.0.1', 0, ssl=context))
+        self.url = f'https://127.0.0.1:{self.server.sockets[0].getsockname()[1]}'
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+class TestHttp2Transport(unittest.TestCase):
+    def setUp(self) -> None:
+        self.server = Http2Server()
+        self.addCleanup(self.server.close)
+
+    def test_pages_are_multiplexed(self):
+        transport = AsyncTransport(max_connections=100, proxy='', http2=True)
+
+        async def fetch_all():
+            try:
+                return await asyncio.gather(*[transport.request('GET', f'{self.server.url}/galleries/1/{i}.jpg')
+                                              for i in range(20)])
+            finally:
+                await transport.aclose()
+
+        responses = asyncio.run(fetch_all())
+        self.assertEqual({(r.status_code, r.http_version, len(r.content)) for r in responses},
+                         {(200, 'HTTP/2', len(ImageHandler.body))})
+        self.assertEqual((transport.stats.requests, transport.stats.connections, self.server.connections), (20, 1, 1))
+
+
+class StandInResponse(object):
+    def __init__(self, url):
+        self.url = url
+        self.status_code = 200
+        self.content = b''
+
+
+class StandInSession(object):
+    def __init__(self):
+        self.headers = {}
+        self.calls = []
+        self.closed = False
+
+    def get(self, url, **kwargs):
+        self.calls.append(url)
+        return StandInResponse(url)
+
+    def close(self):
+        self.closed = True
+
+
+class TestSessionManager(unittest.TestCase):
+    def test_session_is_shared(self):
+        manager = SessionManager(factory=StandInSession)
+        self.assertIs(manager.get(), manager.get())
+        session = manager.get()
+        manager.close()
+        self.assertTrue(session.closed)
+        self.assertIsNot(manager.get(), session)
+
+    def test_request_uses_managed_session(self):
+        stand_in = StandInSession()
+        previous = session_manager.replace(stand_in)
+        useragent = constant.CONFIG['useragent']
+        try:
+            constant.CONFIG['useragent'] = 'stand-in agent'
+            request('get', 'http://127.0.0.1/g/1/')
+            request('get', 'http://127.0.0.1/g/2/')
+        finally:
+            constant.CONFIG['useragent'] = useragent
+            session_manager.replace(previous)
+
+        self.assertEqual(stand_in.calls, ['http://127.0.0.1/g/1/', 'http://127.0.0.1/g/2/'])
+        self.assertEqual(stand_in.headers['User-Agent'], 'stand-in agent')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import asyncio
+import io
+import os
+import tempfile
+import unittest
+
+from PIL import Image
+
+from nhentai.downloader import WebpConverter, prepare_image_file
+
+
+class TestWebpConverter(unittest.TestCase):
+    def setUp(self) -> None:
+        self.path = os.path.join(tempfile.mkdtemp(), '.01.part')
+        with io.BytesIO() as output:
+            Image.new('RGB', (32, 32), 'red').save(output, format='PNG')
+            with open(self.path, 'wb') as f:
+                f.write(output.getvalue())
+
+    def tearDown(self) -> None:
+        os.remove(self.path)
+        os.rmdir(os.path.dirname(self.path))
+
+    def convert(self, converter):
+        try:
+            converter.start()
+            return asyncio.run(prepare_image_file('01.jpg', self.path, 'image/png', converter))
+        finally:
+            converter.shutdown()
+
+    def assert_webp(self, filename):
+        self.assertEqual(filename, '01.webp')
+        with open(self.path, 'rb') as f:
+            head = f.read(12)
+        self.assertEqual((head[:4], head[8:]), (b'RIFF', b'WEBP'))
+
+    def test_inline(self):
+        self.assert_webp(self.convert(WebpConverter(processes=0)))
+
+    def test_process_pool(self):
+        self.assert_webp(self.convert(WebpConverter(processes=1)))
+
+    def test_without_converter(self):
+        self.assertEqual(asyncio.run(prepare_image_file('01.jpg', self.path, 'image/png')), '01.png')
+
+
+if __name__ == '__main__':
+    unittest.main()
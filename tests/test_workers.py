@@ -0,0 +1,115 @@
+import argparse
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from nhentai.jobs import JobQueue, METADATA, DONE, FAILED
+from nhentai.workers import Shard
+
+
+class TestLeases(unittest.TestCase):
+    def setUp(self) -> None:
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'history.sqlite3')
+        self.jobs = JobQueue(self.path)
+        self.addCleanup(self.jobs.close)
+        self.jobs.enqueue([1, 2, 3, 4, 5])
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def test_claims_do_not_overlap(self):
+        # a second connection stands in for another worker process
+        with JobQueue(self.path) as other:
+            self.assertEqual(self.jobs.claim('a', 2), [1, 2])
+            self.assertEqual(other.claim('b', 2), [3, 4])
+            self.jobs.update(1, DONE)
+            self.assertEqual(other.claim('b', 5), [5])
+            self.assertEqual(self.jobs.claim('a', 5), [])
+            self.assertEqual(self.jobs.leased(exclude='a'), 3)
+
+    def test_expired_and_released_leases_are_claimed_again(self):
+        self.assertEqual(self.jobs.claim('crashed', 2, lease=0.05), [1, 2])
+        self.jobs.update(1, METADATA)
+        self.assertEqual(self.jobs.claim('b', 1), [3])
+        time.sleep(0.1)
+        self.assertEqual(self.jobs.claim('b', 2), [1, 2])
+
+        self.jobs.update(3, FAILED, 'no gallery metadata')
+        self.jobs.release('b')
+        self.assertEqual(self.jobs.claim('c', 5), [1, 2, 4, 5])
+        # a failed doujinshi is only tried again by the next run
+        self.jobs.requeue([3, 4])
+        self.assertEqual(self.jobs.claim('c', 5), [3, 4])
+
+    def test_runs_only_claim_their_own_doujinshi(self):
+        # 1 to 5 are left unfinished by an earlier run
+        with JobQueue(self.path, run='next') as jobs:
+            jobs.enqueue([6, 7])
+            jobs.requeue([6, 7])
+            self.assertEqual(jobs.pending(), 2)
+            self.assertEqual(jobs.claim('a', 5), [6, 7])
+            jobs.update(6, DONE)
+            jobs.update(7, FAILED, 'no gallery metadata')
+            self.assertEqual(jobs.failures(), [(7, 'no gallery metadata')])
+
+        # until a run takes them up again, e.g. with --resume
+        with JobQueue(self.path, run='resumed') as jobs:
+            jobs.requeue(self.jobs.unfinished())
+            self.assertEqual(jobs.claim('b', 10), [1, 2, 3, 4, 5, 7])
+
+    def test_heartbeat_keeps_the_lease(self):
+        self.jobs.claim('a', 1, lease=0.05)
+        time.sleep(0.1)
+        self.jobs.renew('a', lease=60)
+        self.assertEqual(self.jobs.claim('b', 1), [2])
+        self.jobs.report('a', pages=12, received=3400)
+        self.assertEqual([(w['owner'], w['pages'], w['bytes']) for w in self.jobs.workers()], [('a', 12, 3400)])
+
+
+class TestShard(unittest.TestCase):
+    def setUp(self) -> None:
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'history.sqlite3')
+        with JobQueue(self.path) as jobs:
+            jobs.enqueue(range(1, 31))
+        self.downloaded = []
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def work(self, owner):
+        with JobQueue(self.path) as jobs:
+            downloader = argparse.Namespace(pages_saved=0, received_bytes=0)
+
+            def run_batch(ids):
+                for doujinshi_id in ids:
+                    time.sleep(0.005)
+                    self.downloaded.append(doujinshi_id)
+                    downloader.pages_saved += 1
+                    jobs.update(doujinshi_id, DONE)
+
+            Shard(jobs, downloader, owner=owner, batch=2, lease=1).run(run_batch)
+
+    def test_workers_share_the_queue(self):
+        # a worker that died left doujinshi 1 and 2 leased to it
+        with JobQueue(self.path) as jobs:
+            jobs.claim('crashed', 2, lease=0.3)
+
+        workers = [threading.Thread(target=self.work, args=(f'worker-{i}',)) for i in range(3)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join(10)
+
+        self.assertEqual(sorted(self.downloaded), list(range(1, 31)))
+        with JobQueue(self.path) as jobs:
+            self.assertEqual(jobs.counts()[DONE], 30)
+            self.assertEqual(sum(worker['pages'] for worker in jobs.workers()), 30)
+
+
+if __name__ == '__main__':
+    unittest.main()